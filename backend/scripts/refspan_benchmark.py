@@ -0,0 +1,217 @@
+"""
+Times the replacement of the cite and ref tokens of citation dense paragraphs by the TEI to JSON converters
+(`tei_to_json.paragraph_from_tokens`) against the baseline converter, which made a pass per token type and
+shifted every later span for each span. The time per citation of the converter should stay flat.
+
+    python scripts/refspan_benchmark.py
+    python scripts/refspan_benchmark.py --citations 10 100 1000 --repeat 20
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from doc2json.grobid2json.tei_to_json import paragraph_from_tokens
+
+
+# frozen copy of the baseline span replacement, kept to compare against
+
+
+def baseline_replace_refspans(
+    spans_to_replace: List[Tuple[int, int, str, str]],
+    full_string: str,
+    pre_padding: str = "",
+    post_padding: str = "",
+    btwn_padding: str = ", "
+) -> str:
+    """
+    For each span within the full string, replace that span with new text
+    :param spans_to_replace: list of tuples of form (start_ind, end_ind, span_text, new_substring)
+    :param full_string:
+    :param pre_padding:
+    :param post_padding:
+    :param btwn_padding:
+    :return:
+    """
+    # assert all spans are equal to full_text span
+    assert all([full_string[start:end] == span for start, end, span, _ in spans_to_replace])
+
+    # assert none of the spans start with the same start ind
+    start_inds = [rep[0] for rep in spans_to_replace]
+    assert len(set(start_inds)) == len(start_inds)
+
+    # sort by start index
+    spans_to_replace.sort(key=lambda x: x[0])
+
+    # form strings for each span group
+    for i, entry in enumerate(spans_to_replace):
+        start, end, span, new_string = entry
+
+        # skip empties
+        if end <= 0:
+            continue
+
+        # compute shift amount
+        shift_amount = len(new_string) - len(span) + len(pre_padding) + len(post_padding)
+
+        # shift remaining appropriately
+        for ind in range(i + 1, len(spans_to_replace)):
+            next_start, next_end, next_span, next_string = spans_to_replace[ind]
+            # skip empties
+            if next_end <= 0:
+                continue
+            # if overlap between ref span and current ref span, remove from replacement
+            if next_start < end:
+                next_start = 0
+                next_end = 0
+                next_string = ""
+            # if ref span abuts previous reference span
+            elif next_start == end:
+                next_start += shift_amount
+                next_end += shift_amount
+                next_string = btwn_padding + pre_padding + next_string + post_padding
+            # if ref span starts after, shift starts and ends
+            elif next_start > end:
+                next_start += shift_amount
+                next_end += shift_amount
+                next_string = pre_padding + next_string + post_padding
+            # save adjusted span
+            spans_to_replace[ind] = (next_start, next_end, next_span, next_string)
+
+    spans_to_replace = [entry for entry in spans_to_replace if entry[1] > 0]
+    spans_to_replace.sort(key=lambda x: x[0])
+
+    # apply shifts in series
+    for start, end, span, new_string in spans_to_replace:
+        assert full_string[start:end] == span
+        full_string = full_string[:start] + new_string + full_string[end:]
+
+    return full_string
+
+
+def baseline_sub_spans_and_update_indices(
+    spans_to_replace: List[Tuple[int, int, str, str]],
+    full_string: str
+) -> Tuple[str, List]:
+    """
+    Replace all spans and recompute indices
+    :param spans_to_replace:
+    :param full_string:
+    :return:
+    """
+    # TODO: check no spans overlapping
+    # TODO: check all spans well-formed
+
+    # assert all spans are equal to full_text span
+    assert all([full_string[start:end] == token for start, end, token, _ in spans_to_replace])
+
+    # assert none of the spans start with the same start ind
+    start_inds = [rep[0] for rep in spans_to_replace]
+    assert len(set(start_inds)) == len(start_inds)
+
+    # sort by start index
+    spans_to_replace.sort(key=lambda x: x[0])
+
+    # compute offsets for each span
+    new_spans = [[start, end, token, surface, 0] for start, end, token, surface in spans_to_replace]
+    for i, entry in enumerate(spans_to_replace):
+        start, end, token, surface = entry
+        new_end = start + len(surface)
+        offset = new_end - end
+        new_spans[i][1] += offset
+        for new_span_entry in new_spans[i+1:]:
+            new_span_entry[4] += offset
+
+    # generate new text and create final spans
+    new_text = baseline_replace_refspans(spans_to_replace, full_string, btwn_padding="")
+    new_spans = [(start + offset, end + offset, token, surface) for start, end, token, surface, offset in new_spans]
+
+    return new_text, new_spans
+
+
+def baseline_paragraph_from_tokens(text: str, cite_map: Dict, ref_map: Dict, section_names: List[Tuple]) -> Dict:
+    para_text = re.sub(r'\s+', ' ', text)
+    para_text = re.sub(r'\s', ' ', para_text)
+
+    all_spans_to_replace = []
+    for span in re.finditer(r'(CITETOKEN\d+)', para_text):
+        uniq_token = span.group()
+        ref_id, surface_text = cite_map[uniq_token]
+        all_spans_to_replace.append((span.start(), span.start() + len(uniq_token), uniq_token, surface_text))
+    for span in re.finditer(r'(REFTOKEN\d+)', para_text):
+        uniq_token = span.group()
+        ref_id, surface_text, ref_type = ref_map[uniq_token]
+        all_spans_to_replace.append((span.start(), span.start() + len(uniq_token), uniq_token, surface_text))
+
+    para_text, all_spans_to_replace = baseline_sub_spans_and_update_indices(all_spans_to_replace, para_text)
+
+    cite_span_blobs = [{"start": start, "end": end, "text": surface, "ref_id": cite_map[token][0]}
+                       for start, end, token, surface in all_spans_to_replace if token.startswith('CITETOKEN')]
+    ref_span_blobs = [{"start": start, "end": end, "text": surface, "ref_id": ref_map[token][0]}
+                      for start, end, token, surface in all_spans_to_replace if token.startswith('REFTOKEN')]
+    for blob in cite_span_blobs + ref_span_blobs:
+        assert para_text[blob["start"]:blob["end"]] == blob["text"]
+
+    return {
+        'text': para_text,
+        'cite_spans': cite_span_blobs,
+        'ref_spans': ref_span_blobs,
+        'eq_spans': [],
+        'section': section_names
+    }
+
+
+def citation_dense_paragraph(citations: int, seed: int = 0) -> Tuple[str, Dict, Dict]:
+    """
+    Paragraph of related work with `citations` cite and ref tokens, some of them abutting, as the converters
+    make them
+    :param citations:
+    :param seed:
+    :return: paragraph text with its tokens, cite map and ref map
+    """
+    rng = random.Random(seed)
+    pieces = []
+    cite_map = {}
+    ref_map = {}
+    for i in range(citations):
+        words = '' if rng.random() < 0.3 else ' '.join(rng.choice(['deep', 'networks', 'of', 'the', 'models'])
+                                                         for _ in range(rng.randint(1, 12))) + ' '
+        if rng.random() < 0.8:
+            token = f'CITETOKEN{i}'
+            cite_map[token] = (f'BIBREF{i}', rng.choice(['[1]', '[12]', '(Smith et al., 2020)', '[3, 4]', '2']))
+        else:
+            token = f'REFTOKEN{i}'
+            ref_map[token] = (f'FIGREF{i}', rng.choice(['Fig. 1', 'Table 2', '3b']), 'figure')
+        pieces += [words, token]
+    pieces.append('.')
+    return ''.join(pieces), cite_map, ref_map
+
+
+def time_paragraph(convert, citations: int, repeat: int) -> float:
+    """ Seconds per paragraph """
+    text, cite_map, ref_map = citation_dense_paragraph(citations)
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        convert(text, cite_map, ref_map, [])
+    return (time.perf_counter() - start_time) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the span replacement of citation dense paragraphs")
+    parser.add_argument("--citations", type=int, nargs='+', default=[10, 50, 100, 200, 400, 800])
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    for count in args.citations:
+        paragraph = citation_dense_paragraph(count)
+        assert paragraph_from_tokens(*paragraph, []) == baseline_paragraph_from_tokens(*paragraph, []), \
+            f"different paragraphs with {count} citations"
+        baseline = time_paragraph(baseline_paragraph_from_tokens, count, args.repeat)
+        current = time_paragraph(paragraph_from_tokens, count, args.repeat)
+        print(f"{count} citations: baseline {round(baseline * 1000, 3)}ms, converter {round(current * 1000, 3)}ms, "
+              f"{round(current / count * 1e6, 2)}us per citation")
@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, List, Optional
+
+from database.db import DynamoDBGateway
+from utils.constants import (ANSWER_CACHE_ENABLED, ANSWER_CACHE_MAX_ENTRIES,
+                             ANSWER_CACHE_TTL_SECONDS, DB_ANSWER_CACHE)
+
+# same grouping as `nlp.ask_text_stream_buffered`, so a replayed answer renders like a live one
+REPLAY_WORDS_PER_CHUNK = 5
+
+
+def normalize_question(question: str) -> str:
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?.!")
+
+
+def digest(data) -> str:
+    if not isinstance(data, str):
+        data = json.dumps(data, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def history_digest(message_history: list) -> str:
+    return digest([[message.sender, message.text] for message in message_history])
+
+
+def paper_content_key(paper) -> str:
+    """
+    Identifies the text a question is asked on: the digest of the paper as it is rendered for the LLM.
+    A selection of sections, or the same PDF converted again, only shares answers when the text is the same.
+    """
+    content = digest([paper.abstract, paper.context_units()])
+    if not paper.hash:
+        return content
+    return f"{paper.hash}:{content}"
+
+
+def stored_paper_key(paper_hash: str, content_digest: str, sections: Optional[list]) -> str:
+    """
+    Identifies the text a question on a stored paper is asked on, without rendering the paper.
+    :param content_digest: digest of the stored paper JSON, or of its header while the paper is converted
+    :param sections: the frontend section selection, None for the whole paper
+    """
+    return f"{paper_hash}:{digest([content_digest, sections])}"
+
+
+def answer_cache_key(content_key: str, question: str, prompt: str, message_history: list) -> str:
+    """
+    :param content_key: identifies what is being asked, e.g. the paper hash plus the selected sections
+    :param prompt: the prompt template, so that prompt changes don't serve stale answers
+    """
+    return digest([content_key, normalize_question(question), digest(prompt), history_digest(message_history)])
+
+
+class LRUCache:
+    """
+    Thread safe in-process LRU with a per entry expiry.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, expires_at: Optional[float] = None):
+        with self._lock:
+            self._entries[key] = (value, expires_at or time.time() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class PaperContentKeys:
+    """
+    `paper_content_key` of the papers sent in full by older clients, memoized per paper hash.
+    The digest of the paper JSON is part of the memo key, a client can send another text under the same hash.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS):
+        self.memory = LRUCache(max_entries, ttl_seconds)
+
+    def get(self, paper, paper_json: str) -> str:
+        if not paper.hash:
+            return paper_content_key(paper)
+        memo_key = f"{paper.hash}:{digest(paper_json)}"
+        content_key = self.memory.get(memo_key)
+        if content_key is None:
+            content_key = paper_content_key(paper)
+            self.memory.set(memo_key, content_key)
+        return content_key
+
+
+class AnswerCache:
+    """
+    Two tier answer cache: an in-process LRU in front of a DynamoDB table.
+    DynamoDB items carry an `expires_at` epoch attribute, used as the table TTL attribute.
+    Failures of the DynamoDB tier are logged and treated as misses, the cache must never fail a question.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(max_entries, ttl_seconds)
+        self._gateway = None
+
+    @property
+    def gateway(self) -> DynamoDBGateway:
+        if self._gateway is None:
+            self._gateway = DynamoDBGateway(DB_ANSWER_CACHE)
+        return self._gateway
+
+    def _read_from_dynamo(self, key: str) -> Optional[dict]:
+        try:
+            return self.gateway.read('id', key, attributes=['answer', 'expires_at'])
+        except Exception as e:
+            print(f"ERROR: Failed to read answer cache: {e}")
+            return None
+
+    def _write_to_dynamo(self, key: str, answer: str, expires_at: int):
+        try:
+            self.gateway.write({'id': key, 'answer': answer, 'expires_at': expires_at})
+        except Exception as e:
+            print(f"ERROR: Failed to write answer cache: {e}")
+
+    async def get(self, key: str) -> Optional[str]:
+        if not ANSWER_CACHE_ENABLED:
+            return None
+
+        answer = self.memory.get(key)
+        if answer is not None:
+            print("Answer cache hit (memory)")
+            return answer
+
+        item = await asyncio.get_running_loop().run_in_executor(None, self._read_from_dynamo, key)
+        # dynamo only deletes expired items eventually, so check the expiry ourselves
+        if item is None or int(item.get('expires_at', 0)) < time.time():
+            print("Answer cache miss")
+            return None
+
+        print("Answer cache hit (dynamo)")
+        self.memory.set(key, item['answer'], expires_at=int(item['expires_at']))
+        return item['answer']
+
+    async def set(self, key: str, answer: str):
+        if not ANSWER_CACHE_ENABLED:
+            return
+
+        expires_at = int(time.time() + self.ttl_seconds)
+        self.memory.set(key, answer, expires_at=expires_at)
+        await asyncio.get_running_loop().run_in_executor(None, self._write_to_dynamo, key, answer, expires_at)
+
+    async def replay(self, answer: str) -> AsyncGenerator[str, None]:
+        words = answer.split(" ")
+        for i in range(0, len(words), REPLAY_WORDS_PER_CHUNK):
+            end = i + REPLAY_WORDS_PER_CHUNK
+            yield " ".join(words[i:end]) + (" " if end < len(words) else "")
+
+    async def record(self, key: str, answer_stream: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """
+        Pass the live answer stream through and cache it once it completed.
+        An interrupted or failed stream is not cached.
+        """
+        tokens: List[str] = []
+        async for token in answer_stream:
+            tokens.append(token)
+            yield token
+
+        answer = "".join(tokens)
+        if answer.strip():
+            await self.set(key, answer)
+
+
+cache = AnswerCache()
+content_keys = PaperContentKeys()
@@ -1,31 +1,43 @@
+import asyncio
 import datetime
+import hmac
 import json
 import os
-import os.path
 import re
+import threading
 import time
 import uuid
 from functools import wraps
-from typing import Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from urllib.parse import unquote
 
+import answer_cache
 import aws
 import middleware
 import nlp
+import papers
+import retrieval
 from botocore.exceptions import ClientError
 from database.db import DynamoDBGateway
 from database.users import (DiscordUsersGateway, GuestUsersGateway,
                             PromptAlreadyExistsException,
                             UserDoesNotExistException)
-from doc2json.grobid2json.process_pdf import process_pdf_file
+from doc2json.grobid2json.grobid.grobid_client import get_grobid_client
+from doc2json.grobid2json.grobid.retry import CircuitOpenError
+from doc2json.grobid2json.process_pdf import convert_tei_text
 from fastapi import (BackgroundTasks, FastAPI, HTTPException, Request,
                      Response, UploadFile)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import parse_obj_as
 from utils.constants import (ASK_PAPER_BANNER_IMG, DB_EMAILS_SENT, DB_FEEDBACK,
-                             DB_JSON_PAPERS, EMAIL_SENDER, ENVIRONMENT,
-                             FILESYSTEM_BASE)
+                             DB_JSON_PAPERS, EMAIL_SENDER,
+                             LAMBDA_EVENTS_PATH, LAMBDA_EVENTS_SECRET,
+                             LAMBDA_FUNCTION_NAME,
+                             PAPER_PROCESSING_POLL_SECONDS,
+                             TEI_CONVERSION_ENGINE, TEI_CONVERSION_PROFILE,
+                             UPLOAD_JOB_EVENTS_MAX_SECONDS)
 
 app = FastAPI()
 
@@ -69,33 +81,97 @@ def get_paper_from_url(url: str) -> bytes:
     return response.content
 
 
-def process_paper(pdf_file_content, pdf_file_name) -> dict:
-    pdf_file_name = pdf_file_name.lower()
-    pdf_file_name = pdf_file_name.replace(' ', '')
-    output_location = f"{FILESYSTEM_BASE}/processing_output"
-    if not os.path.exists(output_location):
-        os.mkdir(output_location)
-        print("created dir")
-    with open(f"{output_location}/{pdf_file_name}", "wb") as f:
-        f.write(pdf_file_content)
-        print("created file")
+def paper_id_of(pdf_file_name: str) -> str:
+    # same paper id as when the PDF went through a file named after the upload
+    return os.path.splitext(pdf_file_name.lower().replace(' ', ''))[0]
 
-    pdf_file_name = pdf_file_name.replace('.pdf', '')
-    output_file = process_pdf_file(input_file=f'{output_location}/{pdf_file_name}.pdf',
-                                   temp_dir=output_location, output_dir=output_location,
-                                   grobid_config={
-                                       'grobid_url': os.getenv('GROBID_URL', 'https://kermitt2-grobid.hf.space')})
-    with open(os.path.abspath(output_file), 'r') as f:
-        f = json.load(f)
-    print(f['title'])
 
-    if ENVIRONMENT != 'dev':
-        os.remove(f"{output_location}/{pdf_file_name}.pdf")
-        os.remove(f"{output_location}/{pdf_file_name}.tei.xml")
-        os.remove(f"{output_location}/{pdf_file_name}.json")
-        print("Removed files")
+def process_paper_header(pdf_file_content: bytes, pdf_file_name: str, paper_hash: str):
+    """
+    Stores the header of the paper (title, authors, abstract), which Grobid extracts much faster than
+    the full text, so that the paper can be shown and asked before its conversion is over.
+    """
+    try:
+        paper_id = paper_id_of(pdf_file_name)
+        tei_text = get_grobid_client(papers.GROBID_CONFIG).process_pdf_stream(
+            paper_id, pdf_file_content, None, "processHeaderDocument")
+        if not tei_text:
+            return
+        json_header = papers.conversion_pool.convert(
+            convert_tei_text, tei_text, paper_id, paper_hash, TEI_CONVERSION_ENGINE, TEI_CONVERSION_PROFILE)
+        papers.set_processing_header(paper_hash, json_header)
+    except Exception as e:
+        # only a shortcut, the full text conversion goes on
+        print(f"ERROR: Failed to process the header of paper {paper_hash}: {e}")
+
+
+def process_paper(pdf_file_content: bytes, pdf_file_name: str, paper_hash: str,
+                  on_stage: Callable[[str], None] = lambda stage: None) -> dict:
+    paper_id = paper_id_of(pdf_file_name)
+    tei_text = get_grobid_client(papers.GROBID_CONFIG).process_pdf_stream(
+        paper_id, pdf_file_content, None, "processFulltextDocument", tei_cache=papers.tei_cache)
+    if not tei_text:
+        raise RuntimeError(f"Grobid failed to process {pdf_file_name}")
+    on_stage(papers.STAGE_GROBID_DONE)
+    json_paper = papers.conversion_pool.convert(
+        convert_tei_text, tei_text, paper_id, paper_hash, papers.tei_conversion_engine(tei_text),
+        TEI_CONVERSION_PROFILE)
+    print(json_paper['title'])
+    on_stage(papers.STAGE_PARSED)
+    return json_paper
+
+
+def store_pdf(paper_hash: str, pdf_file_content: bytes, stage: str):
+    """
+    :param stage: STAGE_STORED when an upload job will convert the paper, STAGE_RUNNING when this worker does
+    """
+    aws.store_paper_in_s3(pdf_file_content, f"{paper_hash}.pdf")
+    papers.set_processing_stage(paper_hash, stage)
+
+
+def convert_and_store_paper(pdf_file_content: bytes, pdf_file_name: str, paper_hash: str, email: str,
+                            with_header: bool = False) -> dict:
+    """
+    Converts a paper claimed by this worker, recording each stage on its processing marker, then stores it,
+    which replaces the marker.
+    :param with_header: extract the header in parallel, for clients that don't wait for the full paper
+    """
+    def on_stage(stage: str):
+        papers.set_processing_stage(paper_hash, stage)
+
+    if with_header:
+        # not waited for, the full paper replaces the header anyway
+        threading.Thread(target=process_paper_header, args=(pdf_file_content, pdf_file_name, paper_hash),
+                         daemon=True).start()
+    json_paper = process_paper(pdf_file_content, pdf_file_name, paper_hash, on_stage)
+    paper = nlp.Paper(**json_paper)
+    index_paper(paper_hash, paper)
+    on_stage(papers.STAGE_INDEXED)
+
+    print("Writing paper to DynamoDB")
+    print("using email :", email)
+    papers.paper_store.put(paper_hash, json_paper, {
+        'paper_title': json_paper['title'],
+        'chunk_plan': nlp.ChunkPlan.build(paper.context_units()).json(),
+        'email': email,
+    })
+    return json_paper
+
+
+def index_paper(paper_hash: str, paper: nlp.Paper):
+    try:
+        retrieval.store_paper_index(
+            paper_hash, retrieval.BM25Index.build(paper.context_blocks()))
+    except Exception as e:
+        print(f"ERROR: Failed to index paper {paper_hash}: {e}")
 
-    return f
+
+def load_chunk_plan(paper_hash: str) -> Optional[nlp.ChunkPlan]:
+    item = DynamoDBGateway(DB_JSON_PAPERS).read(
+        'id', paper_hash, attributes=['chunk_plan'])
+    if item is None or 'chunk_plan' not in item:
+        return None
+    return nlp.ChunkPlan.parse_raw(item['chunk_plan'])
 
 
 async def streamer():
@@ -118,7 +194,11 @@ async def test_stream():
 
 @app.get('/health')
 async def health(request: Request):
-    return {'status': 'ok'}
+    return {
+        'status': 'ok',
+        'grobid': get_grobid_client(papers.GROBID_CONFIG).metrics(),
+        'conversion': papers.conversion_pool.metrics(),
+    }
 
 
 @discord_authenticated
@@ -247,6 +327,205 @@ async def send_answer_email(request: Request, background_tasks: BackgroundTasks)
     return {'message': f"Email sent! Message ID: {response['MessageId']}"}
 
 
+# conversions running in this worker, by paper hash
+papers_in_flight: Dict[str, asyncio.Task] = {}
+
+
+async def get_or_process_paper(pdf_file_content: bytes, pdf_file_name: str, paper_hash: str, email: str) -> dict:
+    """
+    Returns the JSON of the paper, converting it first if it's new.
+    Concurrent uploads of the same paper share a single conversion: within a worker by awaiting the same task,
+    across workers through the processing marker of the paper in Dynamo.
+    """
+    task = papers_in_flight.get(paper_hash)
+    if task is None:
+        task = asyncio.ensure_future(
+            _get_or_process_paper(pdf_file_content, pdf_file_name, paper_hash, email))
+        papers_in_flight[paper_hash] = task
+        task.add_done_callback(lambda _: papers_in_flight.pop(paper_hash, None))
+    else:
+        print(f"Paper {paper_hash} is already being processed, waiting for it")
+    # shielded, a client going away must not cancel the conversion others are waiting for
+    json_paper = await asyncio.shield(task)
+    # shallow copy, callers add keys (e.g. `hash`) to it
+    return dict(json_paper)
+
+
+async def _get_or_process_paper(pdf_file_content: bytes, pdf_file_name: str, paper_hash: str, email: str) -> dict:
+    json_paper = await run_in_threadpool(papers.paper_store.get_json, paper_hash)
+    if json_paper is not None:
+        print("Paper already exists!")
+        return json_paper
+
+    while not await run_in_threadpool(papers.claim_processing, paper_hash):
+        print(f"Paper {paper_hash} is being processed by another worker, waiting for it")
+        await asyncio.sleep(PAPER_PROCESSING_POLL_SECONDS)
+        json_paper = await run_in_threadpool(papers.paper_store.get_json, paper_hash)
+        if json_paper is not None:
+            return json_paper
+
+    print("Creating new paper in S3 and DynamoDB")
+    try:
+        await run_in_threadpool(store_pdf, paper_hash, pdf_file_content, papers.STAGE_RUNNING)
+        return await run_in_threadpool(convert_and_store_paper, pdf_file_content, pdf_file_name, paper_hash, email)
+    except Exception as e:
+        await run_in_threadpool(papers.fail_processing, paper_hash, str(e) or type(e).__name__)
+        raise
+
+
+async def run_upload_job(paper_hash: str, pdf_file_content: Optional[bytes] = None) -> dict:
+    """
+    Converts a paper queued by `/upload-jobs`. Without its content, the PDF is read from S3.
+    """
+    if not await run_in_threadpool(papers.start_upload_job, paper_hash):
+        # already converted, run by another worker (an asynchronous invocation can be delivered twice),
+        # or not an upload job
+        print(f"Upload job {paper_hash} is not waiting to run")
+        json_paper = await run_in_threadpool(papers.paper_store.get_json, paper_hash)
+        if json_paper is None:
+            raise RuntimeError(f"Upload job {paper_hash} is not waiting to run")
+        return json_paper
+
+    # the job is this worker's, a failure is recorded on it
+    try:
+        item = await run_in_threadpool(
+            DynamoDBGateway(DB_JSON_PAPERS).read, 'id', paper_hash, ['email', 'pdf_file_name'])
+        if pdf_file_content is None:
+            pdf_file_content = await run_in_threadpool(aws.read_bytes_from_s3, f"papers/{paper_hash}.pdf")
+            if pdf_file_content is None:
+                raise RuntimeError("PDF not found")
+        return await run_in_threadpool(
+            convert_and_store_paper, pdf_file_content, item['pdf_file_name'], paper_hash, item['email'], True)
+    except Exception as e:
+        await run_in_threadpool(papers.fail_processing, paper_hash, str(e) or type(e).__name__)
+        raise
+
+
+async def dispatch_upload_job(paper_hash: str, pdf_file_content: bytes):
+    if LAMBDA_FUNCTION_NAME:
+        # the execution environment is frozen once the response is sent, a background task wouldn't make progress
+        if not LAMBDA_EVENTS_SECRET:
+            raise RuntimeError("LAMBDA_EVENTS_SECRET is not set, the upload job would be rejected")
+        await run_in_threadpool(
+            aws.invoke_lambda_async, LAMBDA_FUNCTION_NAME, {'upload_job': paper_hash, 'secret': LAMBDA_EVENTS_SECRET})
+        return
+
+    task = asyncio.ensure_future(run_upload_job(paper_hash, pdf_file_content))
+    papers_in_flight[paper_hash] = task
+
+    def on_done(done: asyncio.Task):
+        papers_in_flight.pop(paper_hash, None)
+        if not done.cancelled() and done.exception() is not None:
+            print(f"ERROR: Upload job {paper_hash} failed: {done.exception()}")
+
+    task.add_done_callback(on_done)
+
+
+@app.post(LAMBDA_EVENTS_PATH)
+async def lambda_event(request: Request):
+    """
+    Invocations of the function that are not HTTP requests, posted by the Lambda web adapter.
+    Also reachable from the outside, so events must carry LAMBDA_EVENTS_SECRET.
+    """
+    event = await request.json()
+    if not isinstance(event, dict):
+        raise HTTPException(status_code=400, detail="Unknown event")
+    if not LAMBDA_EVENTS_SECRET or not hmac.compare_digest(
+            str(event.get('secret', '')).encode(), LAMBDA_EVENTS_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    paper_hash = event.get('upload_job')
+    if not isinstance(paper_hash, str) or not papers.PAPER_HASH_REGEX.fullmatch(paper_hash):
+        raise HTTPException(status_code=400, detail="Unknown event")
+    try:
+        await run_upload_job(paper_hash)
+    except Exception as e:
+        # recorded on the job, retrying the invocation wouldn't help
+        print(f"ERROR: Upload job {paper_hash} failed: {e}")
+    return {'status': 'ok'}
+
+
+@app.post("/upload-jobs")
+async def create_upload_job(pdf_file: UploadFile, request: Request):
+    """
+    Queues the conversion of a paper and returns right away with the id of the job (the hash of the paper).
+    Follow the job with `/upload-jobs/{job_id}` or `/upload-jobs/{job_id}/events`, then get the paper
+    from `/papers/{paper_hash}`.
+    """
+    try:
+        email = request.headers['Email']
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail="Missing data: " + str(e))
+
+    pdf_file_name = pdf_file.filename
+    pdf_file_content = await pdf_file.read()
+    paper_hash = generate_hash(pdf_file_content)
+    print(f"Upload job {paper_hash} for {pdf_file_name}")
+
+    status = await run_in_threadpool(papers.processing_status, paper_hash)
+    if status is None or status['stage'] == papers.STAGE_FAILED:
+        claimed = await run_in_threadpool(
+            papers.claim_processing, paper_hash, {'email': email, 'pdf_file_name': pdf_file_name})
+        if claimed:
+            try:
+                await run_in_threadpool(store_pdf, paper_hash, pdf_file_content, papers.STAGE_STORED)
+                await dispatch_upload_job(paper_hash, pdf_file_content)
+            except Exception as e:
+                await run_in_threadpool(papers.fail_processing, paper_hash, str(e) or type(e).__name__)
+                raise HTTPException(status_code=500, detail=f"Failed to queue the paper: {e}")
+            status = {'stage': papers.STAGE_STORED}
+        else:
+            # queued by someone else in the meantime
+            status = await run_in_threadpool(papers.processing_status, paper_hash) or {'stage': papers.STAGE_QUEUED}
+
+    return {'job_id': paper_hash, 'paper_hash': paper_hash, **status}
+
+
+@app.get("/upload-jobs/{job_id}")
+async def get_upload_job(job_id: str):
+    status = None
+    if papers.PAPER_HASH_REGEX.fullmatch(job_id):
+        status = await run_in_threadpool(papers.processing_status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+    return {'job_id': job_id, 'paper_hash': job_id, **status}
+
+
+@app.get("/upload-jobs/{job_id}/events")
+async def upload_job_events(job_id: str):
+    """
+    Server-sent events with the stage of the job, each time it changes, until it's done or failed.
+    """
+    job = await get_upload_job(job_id)
+
+    async def events():
+        last_job = None
+        deadline = time.monotonic() + UPLOAD_JOB_EVENTS_MAX_SECONDS
+        while True:
+            current_job = job if last_job is None else await get_upload_job(job_id)
+            if current_job != last_job:
+                yield f"event: stage\ndata: {json.dumps(current_job)}\n\n"
+                last_job = current_job
+            if current_job['stage'] in [papers.STAGE_DONE, papers.STAGE_FAILED] or time.monotonic() > deadline:
+                return
+            await asyncio.sleep(PAPER_PROCESSING_POLL_SECONDS)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/papers/{paper_hash}")
+async def get_paper(paper_hash: str):
+    """
+    The paper, or while it's converted and once its header is available, a `partial` paper with its abstract.
+    """
+    json_paper = await run_in_threadpool(papers.paper_store.get_json, paper_hash)
+    if json_paper is None:
+        json_paper = await run_in_threadpool(papers.read_header_paper_json, paper_hash)
+    if json_paper is None:
+        raise HTTPException(status_code=404, detail="Paper not found")
+    json_paper['hash'] = paper_hash
+    return json_paper
+
+
 @app.post("/upload-paper")
 async def upload_paper(pdf_file: UploadFile, request: Request, response: Response, background_tasks: BackgroundTasks):
 
@@ -263,28 +542,11 @@ async def upload_paper(pdf_file: UploadFile, request: Request, response: Respons
 
     paper_hash = generate_hash(pdf_file_content)
 
-    existing_paper = DynamoDBGateway(DB_JSON_PAPERS).read('id', paper_hash)
-    if existing_paper is None:
-        print("Creating new paper in S3 and DynamoDB")
-        json_paper = process_paper(pdf_file_content, pdf_file_name)
-        aws.store_paper_in_s3(pdf_file_content, f"{paper_hash}.pdf")
-
-        print("Writing paper to DynamoDB")
-        try:
-            print("using email :", email)
-            DynamoDBGateway(DB_JSON_PAPERS).write({
-                'id': paper_hash,
-                'paper_title': json_paper['title'],
-                'paper_json': json.dumps(json_paper),
-                'email': email,
-            })
-        except ClientError as e:
-            print(
-                f"ERROR: Failed to write paper to Dynamo: {e.response['Error']['Message']}")
-
-    else:
-        print("Paper already exists in DynamoDB!")
-        json_paper = json.loads(existing_paper['paper_json'])
+    try:
+        json_paper = await get_or_process_paper(pdf_file_content, pdf_file_name, paper_hash, email)
+    except CircuitOpenError:
+        raise HTTPException(
+            status_code=503, detail="Paper processing is overloaded, please try again in a minute")
 
     json_paper['hash'] = paper_hash
 
@@ -377,6 +639,34 @@ async def delete_custom_prompt(title: str, request: Request):
     return {'message': "done"}
 
 
+async def resolve_paper(data: dict) -> Tuple[nlp.Paper, str]:
+    """
+    Papers are referenced by `paper_hash`, with the frontend section selection in `sections`.
+    The full paper JSON in `paper` is still accepted for older clients.
+    :return: the paper and the answer cache key of its text
+    """
+    if not data.get('paper_hash'):
+        paper_json = data['paper']
+        paper = nlp.Paper(**json.loads(paper_json))
+        return paper, await run_in_threadpool(answer_cache.content_keys.get, paper, paper_json)
+
+    paper, content_digest = await run_in_threadpool(papers.paper_store.get_with_digest, data['paper_hash'])
+    if paper is None:
+        # still being converted, answer from its abstract meanwhile
+        json_paper = await run_in_threadpool(papers.read_header_paper_json, data['paper_hash'])
+        if json_paper is None:
+            raise HTTPException(status_code=404, detail="Paper not found, please upload it again")
+        paper = nlp.Paper(**json_paper)
+        paper.hash = data['paper_hash']
+        content_digest = 'header'
+
+    sections = None
+    if 'sections' in data:
+        sections = parse_obj_as(List[Tuple[str, Optional[str]]], json.loads(data['sections']))
+        paper = paper.select_sections(sections)
+    return paper, answer_cache.stored_paper_key(data['paper_hash'], content_digest, sections)
+
+
 @app.post("/ask-paper")
 async def ask_paper(request: Request):
     data = await request.json()
@@ -384,12 +674,25 @@ async def ask_paper(request: Request):
         question = data['question']
         history = parse_obj_as(
             List[nlp.ChatMessage], json.loads(data.get('history', '[]')))
-        paper = nlp.Paper(**json.loads(data['paper']))
+        paper, content_key = await resolve_paper(data)
 
     except KeyError as e:
         raise HTTPException(status_code=400, detail="Missing data: " + str(e))
 
-    return StreamingResponse(content=nlp.ask_paper(question=question, message_history=history, paper=paper), media_type="text/plain")
+    cache_key = answer_cache.answer_cache_key(content_key, question, nlp.ASK_PAPER_PROMPT, history)
+    cached_answer = await answer_cache.cache.get(cache_key)
+    if cached_answer is not None:
+        return StreamingResponse(content=answer_cache.cache.replay(cached_answer), media_type="text/plain")
+
+    index, chunk_plan = None, None
+    if paper.hash:
+        index, chunk_plan = await asyncio.gather(
+            run_in_threadpool(retrieval.load_paper_index, paper.hash),
+            run_in_threadpool(load_chunk_plan, paper.hash))
+
+    answer = nlp.ask_paper(question=question, message_history=history,
+                           paper=paper, index=index, chunk_plan=chunk_plan)
+    return StreamingResponse(content=answer_cache.cache.record(cache_key, answer), media_type="text/plain")
 
 
 @app.post("/ask-context")
@@ -404,7 +707,14 @@ async def ask_context(request: Request):
     except KeyError as e:
         raise HTTPException(status_code=400, detail="Missing data: " + str(e))
 
-    return StreamingResponse(content=nlp.ask_context(question, context, history), media_type="text/plain")
+    cache_key = answer_cache.answer_cache_key(
+        generate_hash(context), question, nlp.build_context_prompt("{question}", "{context}"), history)
+    cached_answer = await answer_cache.cache.get(cache_key)
+    if cached_answer is not None:
+        return StreamingResponse(content=answer_cache.cache.replay(cached_answer), media_type="text/plain")
+
+    answer = nlp.ask_context(question, context, history)
+    return StreamingResponse(content=answer_cache.cache.record(cache_key, answer), media_type="text/plain")
 
 
 @app.post("/store-feedback")
@@ -423,8 +733,6 @@ async def store_feedback(request: Request):
 
 
 if __name__ == "__main__":
-    import asyncio
-
     from hypercorn.asyncio import serve
     from hypercorn.config import Config
     asyncio.run(serve(app, Config()))
@@ -1,8 +1,14 @@
+import gzip
+import json
+from typing import Optional, Union
+
 import boto3
 from botocore.exceptions import ClientError
-from utils.aws_client import aws_resource, AWSResource
+from utils.aws_client import aws_client, aws_resource, AWSResource
 from utils.constants import ENVIRONMENT, S3_BUCKET_NAME
 
+GZIP_MAGIC = b'\x1f\x8b'
+
 def ses_send_email(recipient: str, subject: str, html_body: str, sender: str):
     # TODO: https://docs.localstack.cloud/user-guide/aws/ses/
     if ENVIRONMENT not in ['production', 'sandbox']:
@@ -36,6 +42,16 @@ def ses_send_email(recipient: str, subject: str, html_body: str, sender: str):
     )
 
 
+def invoke_lambda_async(function_name: str, payload: dict):
+    """ Queues an invocation of the function with `payload` as its event, without waiting for it. """
+    client = aws_client.get(ENVIRONMENT)(AWSResource.LAMBDA)
+    try:
+        client.invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(payload).encode())
+    except ClientError as e:
+        print(f"Error invoking {function_name}")
+        raise e
+
+
 def store_paper_in_s3(pdf_file: bytes, pdf_file_name: str):
     if ENVIRONMENT not in ['dev', 'production', 'sandbox']:
         print("Not storing paper in S3 because not in dev, production or sandbox")
@@ -51,4 +67,67 @@ def store_paper_in_s3(pdf_file: bytes, pdf_file_name: str):
         s3.Bucket(S3_BUCKET_NAME).put_object(Key=f"papers/{pdf_file_name}", Body=pdf_file)
     except ClientError as e:
         print(f'Error putting file onto {S3_BUCKET_NAME}')
-        raise e
\ No newline at end of file
+        raise e
+
+
+def store_text_in_s3(text: str, key: str, content_type: str, compress: bool = False):
+    """
+    :param compress: gzip the object, `read_text_from_s3` decompresses it transparently
+    """
+    if ENVIRONMENT not in ['dev', 'production', 'sandbox']:
+        print("Not storing object in S3 because not in dev, production or sandbox")
+        return
+
+    body = text.encode()
+    extra_args = {}
+    if compress:
+        body = gzip.compress(body)
+        extra_args['ContentEncoding'] = 'gzip'
+
+    resource = aws_resource.get(ENVIRONMENT)
+    s3 = resource(AWSResource.S3)
+    try:
+        s3.Bucket(S3_BUCKET_NAME).put_object(Key=key, Body=body, ContentType=content_type, **extra_args)
+    except ClientError as e:
+        print(f'Error putting {key} onto {S3_BUCKET_NAME}')
+        raise e
+
+
+def store_json_in_s3(data: Union[dict, str], key: str, compress: bool = False):
+    """
+    :param data: a dict, or an already serialized JSON string
+    :param compress: gzip the object, `read_json_from_s3` decompresses it transparently
+    """
+    text = data if isinstance(data, str) else json.dumps(data)
+    store_text_in_s3(text, key, 'application/json', compress)
+
+
+def read_bytes_from_s3(key: str) -> Optional[bytes]:
+    if ENVIRONMENT not in ['dev', 'production', 'sandbox']:
+        return None
+
+    resource = aws_resource.get(ENVIRONMENT)
+    s3 = resource(AWSResource.S3)
+    try:
+        return s3.Object(S3_BUCKET_NAME, key).get()['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['NoSuchKey', '404']:
+            print(f"Error reading {key} from {S3_BUCKET_NAME}: {e.response['Error']['Message']}")
+        return None
+
+
+def read_text_from_s3(key: str) -> Optional[str]:
+    body = read_bytes_from_s3(key)
+    if body is None:
+        return None
+
+    if body[:2] == GZIP_MAGIC:
+        body = gzip.decompress(body)
+    return body.decode()
+
+
+def read_json_from_s3(key: str) -> Optional[dict]:
+    text = read_text_from_s3(key)
+    if text is None:
+        return None
+    return json.loads(text)
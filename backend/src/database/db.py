@@ -1,4 +1,5 @@
 import datetime
+from typing import Iterator, List, Optional
 
 from botocore.exceptions import ClientError
 from utils.aws_client import AWSResource, aws_resource
@@ -16,13 +17,13 @@ class DynamoDBGateway:
         resource = aws_resource.get(ENVIRONMENT)
         self.table = resource(AWSResource.DYNAMODB).Table(table_name)
 
-    def read(self, key_name: str, key_value: str):
+    def read(self, key_name: str, key_value: str, attributes: Optional[List[str]] = None):
 
-        response = self._read_from_dynamo_key(key_name, key_value)
+        response = self._read_from_dynamo_key(key_name, key_value, attributes)
         if response and 'Item' in response:
             result = response['Item']
         else:
-            response = self._read_from_dynamo_index(key_name, key_value)
+            response = self._read_from_dynamo_index(key_name, key_value, attributes)
             if response and 'Items' in response and len(response['Items']) > 0:
                 result = response['Items'][0]
             else:
@@ -45,13 +46,99 @@ class DynamoDBGateway:
             print('Fail putting item on dynamodb')
             raise e
 
-    def _read_from_dynamo_key(self, key_name: str, key_value: str):
+    def write_if(self, data: dict, condition: str, values: dict) -> bool:
+        """
+        Like `write`, but only when `condition` holds for the current item.
+        Returns False when it doesn't.
+        """
+        if 'created_at' not in data:
+            data['created_at'] = str(datetime.datetime.utcnow())
+
+        data['latest_commit_id'] = LATEST_COMMIT_ID
+        try:
+            self.table.put_item(
+                Item=data,
+                ConditionExpression=condition,
+                # dynamo rejects an empty map
+                **({'ExpressionAttributeValues': values} if values else {}))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            print('Fail putting item on dynamodb')
+            raise e
+
+    def update_if(self, key_name: str, key_value: str, data: dict, condition: str,
+                  values: Optional[dict] = None) -> bool:
+        """
+        Sets the attributes of `data` on the item only when `condition` holds for it. Returns False when it doesn't.
+        `condition` can refer to the attributes of `data` as `#attribute`, and to `values` by their placeholders.
+        """
+        try:
+            self.table.update_item(
+                Key={key_name: key_value},
+                UpdateExpression='SET ' + ', '.join([f"#{attribute} = :{attribute}" for attribute in data]),
+                ExpressionAttributeNames={f"#{attribute}": attribute for attribute in data},
+                ExpressionAttributeValues={
+                    **{f":{attribute}": value for attribute, value in data.items()}, **(values or {})},
+                ConditionExpression=condition)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            print(f"fail updating dynamodb {e.response['Error']['Message']}")
+            raise e
+
+    def delete_if(self, key_name: str, key_value: str, condition: str) -> bool:
+        """
+        Deletes the item only when `condition` holds for it. Returns False when it doesn't.
+        """
+        try:
+            self.table.delete_item(
+                Key={key_name: key_value},
+                ConditionExpression=condition)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            print(f"fail deleting from dynamodb {e.response['Error']['Message']}")
+            raise e
+
+    def scan(self, segment: int = 0, total_segments: int = 1, attributes: Optional[List[str]] = None) -> Iterator[dict]:
+        """
+        Items of one segment of the table, page by page. Segments can be scanned in parallel.
+        """
+        kwargs = {'Segment': segment, 'TotalSegments': total_segments, **self._projection(attributes)}
+        while True:
+            response = self.table.scan(**kwargs)
+            yield from response.get('Items', [])
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def batch_writer(self):
+        """
+        Groups `put_item`s in batches of 25, retrying unprocessed items. Not thread safe.
+        Unlike `write`, items are put as they are.
+        """
+        return self.table.batch_writer()
+
+    def _projection(self, attributes: Optional[List[str]]) -> dict:
+        if not attributes:
+            return {}
+        return {
+            'ProjectionExpression': ', '.join([f"#{attribute}" for attribute in attributes]),
+            'ExpressionAttributeNames': {f"#{attribute}": attribute for attribute in attributes}
+        }
+
+    def _read_from_dynamo_key(self, key_name: str, key_value: str, attributes: Optional[List[str]] = None):
         print(self.table_name, ': Reading from dynamo key')
         try:
             result = self.table.get_item(
                 Key={
                     key_name: key_value
-                }
+                },
+                **self._projection(attributes)
             )
             return result
         except ClientError as e:
@@ -59,15 +146,19 @@ class DynamoDBGateway:
                 f"fail reading from dynamodb via key {e.response['Error']['Message']}")
             return
 
-    def _read_from_dynamo_index(self, key_name: str, key_value: str):
+    def _read_from_dynamo_index(self, key_name: str, key_value: str, attributes: Optional[List[str]] = None):
         print(self.table_name, ': Reading from dynamo index')
+        projection = self._projection(attributes)
+        if projection:
+            projection['ExpressionAttributeNames'][f"#{key_name}"] = key_name
         try:
             result = self.table.query(
                 IndexName=f"{key_name}-index",
-                KeyConditionExpression=f"{key_name} = :{key_name}",
+                KeyConditionExpression=f"#{key_name} = :{key_name}" if projection else f"{key_name} = :{key_name}",
                 ExpressionAttributeValues={
                     f':{key_name}': key_value
-                }
+                },
+                **projection
             )
             return result
         except ClientError as e:
@@ -0,0 +1,118 @@
+"""
+Process pool for CPU bound document conversions (TEI, JATS or LaTeX XML to JSON)
+"""
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional, Tuple
+
+
+def _timed_call(fn: Callable, args: tuple, kwargs: dict) -> Tuple[object, float]:
+    start_time = time.time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start_time
+
+
+class ConversionPool(object):
+    """
+    Runs conversions in worker processes, so that they use every core and don't hold the GIL of the process
+    serving requests. Functions and their arguments must be picklable (module level functions).
+
+    The processes are started on first use. Where they can't be (no /dev/shm, e.g. on AWS Lambda) or with
+    `max_workers=0`, conversions run in the calling thread. A pool whose worker died (e.g. out of memory)
+    is replaced on the next conversion.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = multiprocessing.cpu_count() if max_workers is None else max_workers
+        self._executor = None
+        self._inline = max_workers == 0
+        self._metrics = Counter()
+        self._in_flight = 0
+        self._seconds = 0.0
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> Optional[ProcessPoolExecutor]:
+        with self._lock:
+            if self._executor is None and not self._inline:
+                try:
+                    # spawned rather than forked, the process serving requests runs threads
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+                except (OSError, NotImplementedError) as e:
+                    print(f"No process pool available, converting in the calling thread: {e}")
+                    self._inline = True
+            return self._executor
+
+    def _discard_executor(self, executor: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._metrics['pools_broken'] += 1
+        executor.shutdown(wait=False)
+
+    def _submit(self, fn: Callable, args: tuple, kwargs: dict) -> Tuple[Future, Optional[ProcessPoolExecutor]]:
+        executor = self._get_executor()
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(_timed_call(fn, args, kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future, None
+        try:
+            return executor.submit(_timed_call, fn, args, kwargs), executor
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            return self._submit(fn, args, kwargs)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """ Future of `fn(*args, **kwargs)`, run in a worker process. """
+        with self._lock:
+            self._metrics['submitted'] += 1
+            self._in_flight += 1
+
+        result = Future()
+        future, executor = self._submit(fn, args, kwargs)
+
+        def on_done(future: Future):
+            error = future.exception()
+            with self._lock:
+                self._in_flight -= 1
+                self._metrics['failed' if error is not None else 'completed'] += 1
+                if error is None:
+                    self._seconds += future.result()[1]
+            if isinstance(error, BrokenProcessPool) and executor is not None:
+                self._discard_executor(executor)
+            if error is not None:
+                result.set_exception(error)
+            else:
+                result.set_result(future.result()[0])
+
+        future.add_done_callback(on_done)
+        return result
+
+    def convert(self, fn: Callable, *args, **kwargs):
+        """ Blocks the calling thread, not the process, until the conversion is done. """
+        return self.submit(fn, *args, **kwargs).result()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            completed = self._metrics['completed']
+            return {
+                **self._metrics,
+                'workers': 0 if self._inline else self.max_workers,
+                'in_flight': self._in_flight,
+                # conversions waiting for a free worker
+                'queued': 0 if self._inline else max(0, self._in_flight - self.max_workers),
+                'average_seconds': round(self._seconds / completed, 3) if completed else None,
+            }
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
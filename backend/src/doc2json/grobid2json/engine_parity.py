@@ -0,0 +1,196 @@
+"""
+Checks that the TEI to JSON engines give the same JSON, byte for byte, and compares their speed.
+TEI files are converted as they are, PDFs go through Grobid first.
+
+    python -m doc2json.grobid2json.engine_parity ../../tests/e2e/tests/fixtures/*.pdf --tei-cache temp/tei_cache
+    python -m doc2json.grobid2json.engine_parity temp/
+
+The TEI of the PDF fixtures of the end to end tests, which the parity tests convert without Grobid, is written by
+
+    python -m doc2json.grobid2json.engine_parity ../../tests/e2e/tests/fixtures/*.pdf --save-tei tests/fixtures/tei/pdf
+
+Exits with status 1 when the engines disagree on any document, or any of them raises.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from doc2json.grobid2json import tei_to_json
+from doc2json.grobid2json.grobid.grobid_client import get_grobid_client
+from doc2json.grobid2json.process_pdf import ENGINE_BS4, ENGINES, PROFILE_FULL, PROFILES, convert_tei_text
+from doc2json.grobid2json.tei_cache import DiskTeiCache, TeiCache
+
+
+class EngineResult(NamedTuple):
+    # release JSON without its header (generation date), or the exception raised
+    output: str
+    seconds: float
+
+
+class ParityResult(NamedTuple):
+    name: str
+    results: Dict[str, EngineResult]
+    difference: Optional[str]
+
+
+def _convert(tei_text: str, engine: str, profile: str) -> EngineResult:
+    start_time = time.time()
+    try:
+        # the converters print the unknown tags they meet
+        with contextlib.redirect_stdout(io.StringIO()):
+            paper = convert_tei_text(tei_text, 'paper', 'hash', engine, profile)
+        paper.pop('header')
+        output = json.dumps(paper, sort_keys=False)
+    except Exception as e:
+        output = f"raised {type(e).__name__}: {e}"
+    return EngineResult(output, time.time() - start_time)
+
+
+def _raised(result: EngineResult) -> bool:
+    return result.output.startswith('raised ')
+
+
+def first_difference(reference, other, path: str = '') -> Optional[str]:
+    """
+    Path and values of the first difference between two JSON values, None when they are the same
+    """
+    if type(reference) != type(other):
+        return f"{path or '/'}: {json.dumps(reference)[:200]} != {json.dumps(other)[:200]}"
+    if isinstance(reference, dict):
+        if list(reference) != list(other):
+            return f"{path or '/'}: keys {list(reference)[:20]} != {list(other)[:20]}"
+        for key in reference:
+            difference = first_difference(reference[key], other[key], f"{path}/{key}")
+            if difference:
+                return difference
+        return None
+    if isinstance(reference, list):
+        for index, (reference_item, other_item) in enumerate(zip(reference, other)):
+            difference = first_difference(reference_item, other_item, f"{path}/{index}")
+            if difference:
+                return difference
+        if len(reference) != len(other):
+            return f"{path or '/'}: {len(reference)} != {len(other)} items"
+        return None
+    if reference != other:
+        return f"{path or '/'}: {json.dumps(reference)[:200]} != {json.dumps(other)[:200]}"
+    return None
+
+
+def compare_engines(name: str, tei_text: str, engines: List[str] = ENGINES,
+                    profile: str = PROFILE_FULL) -> ParityResult:
+    """
+    Convert a TEI with every engine and compare their JSON with the one of the first engine. An engine raising
+    is a failure, even when the others raise the same way.
+    :param name: name of the document, for the report
+    :param tei_text: TEI XML
+    :param engines:
+    :param profile: conversion profile, one of PROFILES
+    :return:
+    """
+    results = {engine: _convert(tei_text, engine, profile) for engine in engines}
+    raised = [f"{engine} {result.output[:200]}" for engine, result in results.items() if _raised(result)]
+    if raised:
+        return ParityResult(name, results, ', '.join(raised))
+    reference = results[engines[0]].output
+    for engine in engines[1:]:
+        output = results[engine].output
+        if output == reference:
+            continue
+        difference = first_difference(json.loads(reference), json.loads(output))
+        # same values, different bytes (e.g. key order)
+        return ParityResult(name, results, f"{engine}: {difference or 'serialized differently'}")
+    return ParityResult(name, results, None)
+
+
+def iter_documents(paths: List[str]) -> List[str]:
+    documents = []
+    for path in paths:
+        if os.path.isdir(path):
+            documents += sorted(
+                os.path.join(root, file_name) for root, _, file_names in os.walk(path) for file_name in file_names
+                if file_name.endswith('.xml') or file_name.lower().endswith('.pdf'))
+        else:
+            documents.append(path)
+    return documents
+
+
+def read_tei(path: str, grobid_config: Optional[Dict] = None, tei_cache: Optional[TeiCache] = None) -> str:
+    """
+    TEI of a document: the content of a TEI file, or the output of Grobid for a PDF
+    """
+    if not path.lower().endswith('.pdf'):
+        with open(path, 'r', encoding='utf8') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        tei_text = get_grobid_client(grobid_config).process_pdf_stream(
+            path, f.read(), None, "processFulltextDocument", tei_cache=tei_cache)
+    if not tei_text:
+        raise RuntimeError(f"Grobid failed to process {path}")
+    return tei_text
+
+
+def check_parity(paths: List[str], grobid_config: Optional[Dict] = None,
+                 tei_cache: Optional[TeiCache] = None, profile: str = PROFILE_FULL,
+                 save_tei: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Compare the engines on TEI files and PDFs, print a report
+    :param paths: TEI files, PDFs or directories of them
+    :param grobid_config:
+    :param tei_cache: TEI of PDFs already processed by Grobid
+    :param profile: conversion profile, one of PROFILES
+    :param save_tei: directory where the TEI of the PDFs is written, as <PDF name>.tei.xml
+    :return: number of documents compared and number of documents on which the engines disagree or raise
+    """
+    seconds = {engine: 0.0 for engine in ENGINES}
+    compared = mismatches = 0
+    for path in iter_documents(paths):
+        try:
+            tei_text = read_tei(path, grobid_config, tei_cache)
+        except Exception as e:
+            print(f"SKIPPED {path}: {e}")
+            continue
+        if save_tei and path.lower().endswith('.pdf'):
+            os.makedirs(save_tei, exist_ok=True)
+            tei_file = os.path.join(save_tei, os.path.splitext(os.path.basename(path))[0] + '.tei.xml')
+            with open(tei_file, 'w', encoding='utf8') as f:
+                f.write(tei_text)
+        result = compare_engines(path, tei_text, profile=profile)
+        compared += 1
+        for engine, engine_result in result.results.items():
+            seconds[engine] += engine_result.seconds
+        timings = ', '.join(f"{engine} {round(r.seconds, 3)}s" for engine, r in result.results.items())
+        if result.difference:
+            mismatches += 1
+            print(f"MISMATCH {path} ({timings}): {result.difference}")
+        else:
+            print(f"OK {path} ({timings})")
+
+    print(f"{compared} documents, {mismatches} mismatches")
+    for engine in ENGINES:
+        speedup = f", {round(seconds[ENGINE_BS4] / seconds[engine], 1)}x" if seconds[engine] else ""
+        print(f"{engine}: {round(seconds[engine], 3)}s{speedup}")
+    return compared, mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the JSON of the TEI to JSON engines")
+    parser.add_argument("paths", nargs='+', help="TEI files, PDFs or directories of them")
+    parser.add_argument("--grobid-url", default=None, help="Grobid server for the PDFs")
+    parser.add_argument("--tei-cache", default=None, help="directory caching the Grobid TEI of already processed PDFs")
+    parser.add_argument("--save-tei", default=None, help="directory where the Grobid TEI of the PDFs is written")
+    parser.add_argument("--verify-spans", action='store_true',
+                        help="check the cite and ref spans of every paragraph against its text")
+    parser.add_argument("-p", "--profile", default=PROFILE_FULL, choices=PROFILES, help="conversion profile")
+    args = parser.parse_args()
+    tei_to_json.VERIFY_SPANS = tei_to_json.VERIFY_SPANS or args.verify_spans
+
+    config = {'grobid_url': args.grobid_url} if args.grobid_url else None
+    _, mismatched = check_parity(args.paths, config, DiskTeiCache(args.tei_cache) if args.tei_cache else None,
+                                 args.profile, args.save_tei)
+    sys.exit(1 if mismatched else 0)
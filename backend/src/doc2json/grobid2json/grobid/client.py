@@ -2,6 +2,7 @@
 from copy import deepcopy
 import json
 import requests
+from requests.adapters import HTTPAdapter
 
 try:
     from urlparse import urljoin
@@ -25,7 +26,8 @@ class ApiClient(object):
             username=None,
             api_key=None,
             status_endpoint=None,
-            timeout=60
+            timeout=60,
+            pool_maxsize=10
     ):
         """ Initialise client.
 
@@ -33,7 +35,9 @@ class ApiClient(object):
             base_url (str): The base URL to the service being used.
             username (str): The username to authenticate with.
             api_key (str): The API key to authenticate with.
-            timeout (int): Maximum time before timing out.
+            timeout (int or tuple): Default maximum time before timing out,
+                either a single value or a (connect, read) tuple.
+            pool_maxsize (int): Number of keep-alive connections kept per host.
         """
         self.base_url = base_url
         self.username = username
@@ -41,6 +45,13 @@ class ApiClient(object):
         self.status_endpoint = urljoin(self.base_url, status_endpoint)
         self.timeout = timeout
 
+        # one session per client, so connections (and TLS handshakes) are reused across calls.
+        # requests sessions can be shared by threads as long as their settings aren't changed.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
     @staticmethod
     def encode(request, data):
         """ Add request content data to request body, set Content-type header.
@@ -111,7 +122,7 @@ class ApiClient(object):
             params (dict or None): Query-string parameters.
             data (dict or None): Request body contents for POST or PUT requests.
             files (dict or None: Files to be passed to the request.
-            timeout (int): Maximum time before timing out.
+            timeout (int or tuple): Maximum time before timing out, defaults to the client timeout.
 
         Returns:
             ResultParser or ErrorParser.
@@ -123,14 +134,14 @@ class ApiClient(object):
         files = files or {}
         #if self.username is not None and self.api_key is not None:
         #    params.update(self.get_credentials())
-        r = requests.request(
+        r = self.session.request(
             method,
             url,
             headers=headers,
             params=params,
             files=files,
             data=data,
-            timeout=timeout,
+            timeout=timeout if timeout is not None else self.timeout,
         )
 
         return r, r.status_code
@@ -2,24 +2,30 @@ import os
 import io
 import json
 import argparse
+import itertools
 import time
-import glob
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+import requests
 from doc2json.grobid2json.grobid.client import ApiClient
+from doc2json.grobid2json.grobid.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+from doc2json.grobid2json.tei_cache import TeiCache, tei_cache_key
 import ntpath
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional
 
 '''
-This version uses the standard ProcessPoolExecutor for parallelizing the concurrent calls to the GROBID services.
-Given the limits of ThreadPoolExecutor (input stored in memory, blocking Executor.map until the whole input
-is acquired), it works with batches of PDF of a size indicated in the config.json file (default is 1000 entries).
-We are moving from first batch to the second one only when the first is entirely processed - which means it is
-slightly sub-optimal, but should scale better. However acquiring a list of million of files in directories would
-require something scalable too, which is not implemented for the moment.
+PDFs of a directory are processed concurrently by a pool of `max_workers` threads. PDFs are fed to the pool
+as they are discovered, with at most a few of them waiting per worker, so that processing starts right away
+and memory stays bounded whatever the size of the directory. Progress and throughput are printed every
+`report_every` PDFs.
 '''
 
 DEFAULT_GROBID_CONFIG = {
     "grobid_url": "http://localhost:8070",
     "batch_size": 1000,
+    "report_every": 50,
     "sleep_time": 5,
     "generateIDs": False,
     "consolidate_header": False,
@@ -27,14 +33,73 @@ DEFAULT_GROBID_CONFIG = {
     "include_raw_citations": True,
     "include_raw_affiliations": False,
     "max_workers": 2,
+    "connect_timeout": 10,
+    "read_timeout": 180,
+    "pool_maxsize": 10,
+    # 503s and connection errors are retried with a jittered exponential backoff starting at `sleep_time`
+    "max_attempts": 5,
+    "retry_max_delay": 60,
+    "retry_deadline": 300,
+    # consecutive failures after which calls fail fast, for `circuit_reset_timeout` seconds
+    "circuit_failure_threshold": 5,
+    "circuit_reset_timeout": 30,
+    # a batch PDF rejected by the open circuit waits for it at most this many times, and not past `retry_deadline`
+    "max_circuit_waits": 20,
 }
 
+
+class Throughput(object):
+    """ Thread safe progress counter, printing the processing rate every `report_every` items. """
+
+    def __init__(self, name: str, report_every: int = 50):
+        self.name = name
+        self.report_every = report_every
+        self.done = 0
+        self.failed = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, ok: bool = True):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            if self.done % self.report_every == 0:
+                self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print(f"{self.name}: {self.done} done ({self.failed} failed) in {round(elapsed, 1)}s, "
+              f"{round(self.done / elapsed, 2)}/s")
+
+
+class GrobidResult(NamedTuple):
+    pdf_file: str
+    # None when Grobid failed to process the PDF
+    tei_file: Optional[str]
+    seconds: float
+    error: Optional[str]
+
+
+def tei_file_path(pdf_file: str, output: str) -> str:
+    # we use ntpath here to be sure it will work on Windows too
+    pdf_file_name = ntpath.basename(pdf_file)
+    return os.path.join(output, os.path.splitext(pdf_file_name)[0] + '.tei.xml')
+
+
+def iter_pdf_files(input: str) -> Iterator[str]:
+    # lazily, a directory can hold millions of PDFs
+    with os.scandir(input) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.pdf'):
+                yield entry.path
+
+
 class GrobidClient(ApiClient):
 
     def __init__(self, config=None):
-        self.config = DEFAULT_GROBID_CONFIG
-        if config:
-            self.config.update(config)
+        # merged into a copy, DEFAULT_GROBID_CONFIG is shared by every client
+        self.config = MappingProxyType({**DEFAULT_GROBID_CONFIG, **(config or {})})
         self.generate_ids = self.config["generateIDs"]
         self.consolidate_header = self.config["consolidate_header"]
         self.consolidate_citations = self.config["consolidate_citations"]
@@ -43,41 +108,150 @@ class GrobidClient(ApiClient):
         self.max_workers = self.config["max_workers"]
         self.grobid_url = self.config["grobid_url"]
         self.sleep_time = self.config["sleep_time"]
+        super().__init__(
+            self.grobid_url,
+            timeout=(self.config["connect_timeout"], self.config["read_timeout"]),
+            pool_maxsize=self.config["pool_maxsize"]
+        )
+        self.retry_policy = RetryPolicy(
+            max_attempts=self.config["max_attempts"],
+            base_delay=self.sleep_time,
+            max_delay=self.config["retry_max_delay"],
+            deadline=self.config["retry_deadline"]
+        )
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=self.config["circuit_failure_threshold"],
+            reset_timeout=self.config["circuit_reset_timeout"]
+        )
+        self._metrics = Counter()
+        self._metrics_lock = threading.Lock()
         print(self.grobid_url)
 
-    def process(self, input: str, output: str, service: str):
-        batch_size_pdf = self.config['batch_size']
-        pdf_files = []
-
-        for pdf_file in glob.glob(input + "/*.pdf"):
-            pdf_files.append(pdf_file)
-
-            if len(pdf_files) == batch_size_pdf:
-                self.process_batch(pdf_files, output, service)
-                pdf_files = []
-
-        # last batch
-        if len(pdf_files) > 0:
-            self.process_batch(pdf_files, output, service)
-
-    def process_batch(self, pdf_files: List[str], output: str, service: str) -> None:
-        print(len(pdf_files), "PDF files to process")
-        for pdf_file in pdf_files:
-            self.process_pdf(pdf_file, output, service)
-
-    def process_pdf_stream(self, pdf_file: str, pdf_strm: bytes, output: str, service: str) -> str:
-        # process the stream
-        files = {
-            'input': (
-                pdf_file,
-                pdf_strm,
-                'application/pdf',
-                {'Expires': '0'}
-            )
-        }
-
-        the_url = self.get_service_url(service)
+    def _count(self, metric: str):
+        with self._metrics_lock:
+            self._metrics[metric] += 1
+
+    def metrics(self) -> Dict:
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics['circuit_state'] = self.circuit_breaker.state
+        metrics['circuit_opened'] = self.circuit_breaker.times_opened
+        return metrics
+
+    def _call_timeout(self, timeout, deadline_at):
+        timeout = timeout if timeout is not None else self.timeout
+        if deadline_at is None:
+            return timeout
+        # don't let a single call run past the retry deadline
+        remaining = max(deadline_at - time.monotonic(), 1)
+        if isinstance(timeout, tuple):
+            return tuple(min(value, remaining) for value in timeout)
+        return min(timeout, remaining)
+
+    def post_with_retries(self, timeout=None, **kwargs):
+        """
+        POST to Grobid, retrying 503s and connection errors according to `retry_policy`.
+        Once retries are exhausted, returns the last 503 response or raises the last connection error.
+        Raises CircuitOpenError without calling Grobid while it is known to be saturated.
+        """
+        deadline_at = self.retry_policy.start()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.circuit_breaker.before_call()
+            except CircuitOpenError:
+                self._count('circuit_rejections')
+                raise
 
+            self._count('calls')
+            error, res, status = None, None, None
+            try:
+                res, status = self.post(timeout=self._call_timeout(timeout, deadline_at), **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception:
+                # still report the outcome, or a half open circuit would wait for its trial call forever
+                self.circuit_breaker.record_failure()
+                raise
+
+            if error is None and status != 503:
+                # other errors are about the document, not about Grobid being saturated
+                self.circuit_breaker.record_success()
+                return res, status
+
+            self.circuit_breaker.record_failure()
+            self._count('errors' if error is not None else 'saturated')
+            delay = self.retry_policy.next_delay(attempt, deadline_at)
+            if delay is None:
+                self._count('gave_up')
+                if error is not None:
+                    raise error
+                return res, status
+
+            self._count('retries')
+            time.sleep(delay)
+
+    def process(self, input: str, output: str, service: str,
+                on_tei: Optional[Callable[[GrobidResult], None]] = None,
+                tei_cache: Optional[TeiCache] = None) -> Throughput:
+        """
+        Process every PDF of the `input` directory, writing TEI files to `output`.
+        :param on_tei: called from the worker threads with the result of each PDF,
+            e.g. to start converting it while the other PDFs are still being processed
+        """
+        return self.process_batch(iter_pdf_files(input), output, service, on_tei, tei_cache)
+
+    def process_batch(self, pdf_files: Iterable[str], output: str, service: str,
+                      on_tei: Optional[Callable[[GrobidResult], None]] = None,
+                      tei_cache: Optional[TeiCache] = None) -> Throughput:
+        throughput = Throughput("Grobid", self.config['report_every'])
+        # bounds the PDFs waiting for a worker, the iterable is consumed as workers free up
+        pending = threading.BoundedSemaphore(self.max_workers * 2)
+
+        def process_one(pdf_file: str):
+            start_time = time.time()
+            tei_file, error = None, None
+            deadline_at = self.retry_policy.start()
+            try:
+                for circuit_waits in itertools.count():
+                    try:
+                        tei_file = self.process_pdf(pdf_file, output, service, tei_cache)
+                        break
+                    except CircuitOpenError:
+                        # Grobid is saturated, not failing on this PDF: wait for the circuit to let calls
+                        # through again and submit the PDF again, unless Grobid stays down
+                        retry_after = self.circuit_breaker.retry_after()
+                        if circuit_waits >= self.config['max_circuit_waits'] or \
+                                (deadline_at is not None and time.monotonic() + retry_after >= deadline_at):
+                            self._count('circuit_gave_up')
+                            error = f"Grobid circuit still open after {circuit_waits} waits"
+                            break
+                        self._count('circuit_waits')
+                        time.sleep(retry_after)
+                if tei_file is None and error is None:
+                    error = "Grobid failed to process the PDF"
+            except Exception as e:
+                print(f"Processing {pdf_file} failed: {e}")
+                error = str(e) or type(e).__name__
+            finally:
+                pending.release()
+            throughput.add(ok=tei_file is not None)
+            if on_tei is not None:
+                try:
+                    on_tei(GrobidResult(pdf_file, tei_file, time.time() - start_time, error))
+                except Exception as e:
+                    print(f"Handling the TEI of {pdf_file} failed: {e}")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for pdf_file in pdf_files:
+                pending.acquire()
+                executor.submit(process_one, pdf_file)
+
+        throughput.report()
+        return throughput
+
+    def grobid_parameters(self) -> Dict[str, str]:
         # set the GROBID parameters
         the_data = {}
         if self.generate_ids:
@@ -105,19 +279,56 @@ class GrobidClient(ApiClient):
         else:
             the_data['includeRawCitations'] = '0'
 
-        res, status = self.post(
+        return the_data
+
+    def process_pdf_stream(self, pdf_file: str, pdf_strm: bytes, output: str, service: str, timeout=None,
+                           tei_cache: Optional[TeiCache] = None) -> str:
+        """
+        :param tei_cache: when given, Grobid is only called for PDFs (and flags) it hasn't seen yet
+        """
+        the_data = self.grobid_parameters()
+
+        cache_key = None
+        if tei_cache is not None:
+            cache_key = tei_cache_key(pdf_strm, service, the_data)
+            tei_text = tei_cache.get(cache_key)
+            if tei_text:
+                self._count('tei_cache_hits')
+                return tei_text
+            self._count('tei_cache_misses')
+
+        tei_text = self._process_pdf_stream(pdf_file, pdf_strm, output, service, the_data, timeout)
+        if tei_text and tei_cache is not None:
+            tei_cache.put(cache_key, tei_text)
+        return tei_text
+
+    def _process_pdf_stream(self, pdf_file: str, pdf_strm: bytes, output: str, service: str, the_data: Dict[str, str],
+                            timeout=None) -> str:
+        # process the stream
+        files = {
+            'input': (
+                pdf_file,
+                pdf_strm,
+                'application/pdf',
+                {'Expires': '0'}
+            )
+        }
+
+        the_url = self.get_service_url(service)
+
+        res, status = self.post_with_retries(
             url=the_url,
             files=files,
             data=the_data,
-            headers={'Accept': 'text/plain'}
+            headers={'Accept': 'text/plain'},
+            timeout=timeout
         )
 
-        if status == 503:
-            time.sleep(self.sleep_time)
-            return self.process_pdf_stream(pdf_file, pdf_strm, service)
-        elif status != 200:
-            with open(os.path.join(output, "failed.log"), "a+") as failed:
-                failed.write(pdf_file.strip(".pdf") + "\n")
+        if status != 200:
+            # no output dir when processing in memory, nowhere to log the failure to
+            if output:
+                with open(os.path.join(output, "failed.log"), "a+") as failed:
+                    failed.write(pdf_file.strip(".pdf") + "\n")
             print('Processing failed with error ' + str(status))
             return ""
         else:
@@ -126,24 +337,28 @@ class GrobidClient(ApiClient):
     def get_service_url(self, service: str):
         return self.grobid_url + "/api/" + service
 
-    def process_pdf(self, pdf_file: str, output: str, service: str) -> None:
+    def process_pdf(self, pdf_file: str, output: str, service: str, tei_cache: Optional[TeiCache] = None) -> Optional[str]:
+        """
+        Returns the path of the TEI file, None when Grobid failed to process the PDF.
+        """
         # check if TEI file is already produced
-        # we use ntpath here to be sure it will work on Windows too
-        pdf_file_name = ntpath.basename(pdf_file)
-        filename = os.path.join(output, os.path.splitext(pdf_file_name)[0] + '.tei.xml')
+        filename = tei_file_path(pdf_file, output)
         if os.path.isfile(filename):
-            return
+            return filename
 
         print(pdf_file)
-        pdf_strm = open(pdf_file, 'rb').read()
-        tei_text = self.process_pdf_stream(pdf_file, pdf_strm, output, service)
+        with open(pdf_file, 'rb') as f:
+            pdf_strm = f.read()
+        tei_text = self.process_pdf_stream(pdf_file, pdf_strm, output, service, tei_cache=tei_cache)
 
         # writing TEI file
         if tei_text:
             with io.open(filename, 'w+', encoding='utf8') as tei_file:
                 tei_file.write(tei_text)
+            return filename
+        return None
 
-    def process_citation(self, bib_string: str, log_file: str) -> str:
+    def process_citation(self, bib_string: str, log_file: str, timeout=None) -> str:
         # process citation raw string and return corresponding dict
         the_data = {
             'citations': bib_string,
@@ -152,50 +367,46 @@ class GrobidClient(ApiClient):
 
         the_url = self.get_service_url('processCitation')
 
-        for _ in range(5):
-            try:
-                res, status = self.post(
-                    url=the_url,
-                    data=the_data,
-                    headers={'Accept': 'text/plain'}
-                )
-                if status == 503:
-                    time.sleep(self.sleep_time)
-                    continue
-                elif status != 200:
-                    with open(log_file, "a+") as failed:
-                        failed.write("-- BIBSTR --\n")
-                        failed.write(bib_string + "\n\n")
-                    break
-                else:
-                    return res.text
-            except Exception:
-                continue
+        try:
+            res, status = self.post_with_retries(
+                url=the_url,
+                data=the_data,
+                headers={'Accept': 'text/plain'},
+                timeout=timeout
+            )
+        except Exception as e:
+            print(f"Processing citation failed: {e}")
+            return None
+
+        if status != 200:
+            with open(log_file, "a+") as failed:
+                failed.write("-- BIBSTR --\n")
+                failed.write(bib_string + "\n\n")
+        else:
+            return res.text
 
-    def process_header_names(self, header_string: str, log_file: str) -> str:
+    def process_header_names(self, header_string: str, log_file: str, timeout=None) -> str:
         # process author names from header string
         the_data = {
             'names': header_string
         }
         the_url = self.get_service_url('processHeaderNames')
 
-        res, status = self.post(
+        res, status = self.post_with_retries(
             url=the_url,
             data=the_data,
-            headers={'Accept': 'text/plain'}
+            headers={'Accept': 'text/plain'},
+            timeout=timeout
         )
 
-        if status == 503:
-            time.sleep(self.sleep_time)
-            return self.process_header_names(header_string, log_file)
-        elif status != 200:
+        if status != 200:
             with open(log_file, "a+") as failed:
                 failed.write("-- AUTHOR --\n")
                 failed.write(header_string + "\n\n")
         else:
             return res.text
 
-    def process_affiliations(self, aff_string: str, log_file: str) -> str:
+    def process_affiliations(self, aff_string: str, log_file: str, timeout=None) -> str:
         # process affiliation from input string
         the_data = {
             'affiliations': aff_string
@@ -203,16 +414,14 @@ class GrobidClient(ApiClient):
 
         the_url = self.get_service_url('processAffiliations')
 
-        res, status = self.post(
+        res, status = self.post_with_retries(
             url=the_url,
             data=the_data,
-            headers={'Accept': 'text/plain'}
+            headers={'Accept': 'text/plain'},
+            timeout=timeout
         )
 
-        if status == 503:
-            time.sleep(self.sleep_time)
-            return self.process_affiliations(aff_string, log_file)
-        elif status != 200:
+        if status != 200:
             with open(log_file, "a+") as failed:
                 failed.write("-- AFFILIATION --\n")
                 failed.write(aff_string + "\n\n")
@@ -220,6 +429,22 @@ class GrobidClient(ApiClient):
             return res.text
 
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_grobid_client(config: Optional[Dict] = None) -> GrobidClient:
+    """
+    Returns a long lived client for the given config, shared by every caller using the same config,
+    so that Grobid connections are pooled across requests. The client is safe to use from several threads.
+    """
+    key = json.dumps(config or {}, sort_keys=True)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = GrobidClient(config)
+        return _clients[key]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Client for GROBID services")
     parser.add_argument("service", help="one of [processFulltextDocument, processHeaderDocument, processReferences]")
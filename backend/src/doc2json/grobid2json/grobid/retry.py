@@ -0,0 +1,104 @@
+""" Retry policy and circuit breaker for calls to a saturated service """
+import random
+import threading
+import time
+from typing import Optional
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of calling the service while the circuit is open. """
+
+
+class RetryPolicy(object):
+    """ Capped, jittered exponential backoff.
+
+    Attempt ``n`` (starting at 1) waits a random time between 0 and
+    ``min(max_delay, base_delay * 2 ** (n - 1))`` ("full jitter"), so that
+    workers throttled at the same time don't all come back at the same time.
+    No attempt is started once ``deadline`` seconds have passed since the first one.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0, deadline: Optional[float] = 300.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def start(self) -> Optional[float]:
+        """ Returns the monotonic time past which no attempt is started, if any. """
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def next_delay(self, attempt: int, deadline_at: Optional[float]) -> Optional[float]:
+        """ Returns how long to wait before the next attempt, or None when giving up. """
+        if attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+            return None
+        return delay
+
+
+class CircuitBreaker(object):
+    """ Fails fast while the service is saturated.
+
+    The circuit opens after ``failure_threshold`` consecutive failures. While open,
+    calls are rejected without reaching the service. After ``reset_timeout`` seconds a
+    single trial call is let through (half open): its success closes the circuit,
+    its failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return
+            raise CircuitOpenError("Circuit open, the service is saturated")
+
+    def retry_after(self) -> float:
+        """ Returns how long to wait before a call may be let through again. """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            if self.state == self.OPEN:
+                return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+            # half open, the trial call of another worker is running
+            return min(self.reset_timeout, 1.0)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
@@ -0,0 +1,110 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+# a PDF goes through these stages in order, its stage is the last one it reached
+STAGE_GROBID = 'grobid'
+STAGE_TEI = 'tei'
+STAGE_JSON = 'json'
+
+
+class ManifestEntry(NamedTuple):
+    path: str
+    sha256: Optional[str]
+    stage: str
+    grobid_seconds: Optional[float]
+    convert_seconds: Optional[float]
+    error: Optional[str]
+    updated_at: float
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Manifest(object):
+    """
+    SQLite record of a batch run: for each PDF, its hash, the last stage it reached, the time spent in
+    Grobid and in the TEI to JSON conversion, and the error that stopped it, if any.
+    Updates are committed right away, so an interrupted run can resume exactly where it stopped.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS pdfs (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT,
+                stage TEXT NOT NULL,
+                grobid_seconds REAL,
+                convert_seconds REAL,
+                error TEXT,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._connection.commit()
+
+    def _execute(self, query: str, parameters: tuple = ()):
+        with self._lock:
+            self._connection.execute(query, parameters)
+            self._connection.commit()
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM pdfs WHERE path = ?", (path,)).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def start(self, path: str, sha256: Optional[str]):
+        self._execute("""
+            INSERT INTO pdfs (path, sha256, stage, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                sha256 = excluded.sha256, stage = excluded.stage, grobid_seconds = NULL,
+                convert_seconds = NULL, error = NULL, updated_at = excluded.updated_at
+        """, (path, sha256, STAGE_GROBID, time.time()))
+
+    def tei_done(self, path: str, seconds: float):
+        self._execute(
+            "UPDATE pdfs SET stage = ?, grobid_seconds = ?, error = NULL, updated_at = ? WHERE path = ?",
+            (STAGE_TEI, seconds, time.time(), path))
+
+    def json_done(self, path: str, seconds: float):
+        self._execute(
+            "UPDATE pdfs SET stage = ?, convert_seconds = ?, error = NULL, updated_at = ? WHERE path = ?",
+            (STAGE_JSON, seconds, time.time(), path))
+
+    def failed(self, path: str, error: str):
+        """ Records the error of the PDF at its current stage. """
+        self._execute(
+            "UPDATE pdfs SET error = ?, updated_at = ? WHERE path = ?",
+            (error, time.time(), path))
+
+    def failures(self, stage: Optional[str] = None) -> List[ManifestEntry]:
+        query, parameters = "SELECT * FROM pdfs WHERE error IS NOT NULL", ()
+        if stage is not None:
+            query, parameters = query + " AND stage = ?", (stage,)
+        with self._lock:
+            rows = self._connection.execute(query, parameters).fetchall()
+        return [ManifestEntry(*row) for row in rows]
+
+    def summary(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._connection.execute("""
+                SELECT CASE WHEN error IS NULL THEN stage ELSE stage || '_failed' END, COUNT(*)
+                FROM pdfs GROUP BY 1
+            """).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -3,50 +3,135 @@ import json
 import argparse
 import time
 from bs4 import BeautifulSoup
-from typing import Optional, Dict
+from typing import Optional, Dict, Tuple
 
-from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.conversion_pool import ConversionPool
+from doc2json.s2orc import Paper
+from doc2json.grobid2json.grobid.grobid_client import GrobidResult, Throughput, get_grobid_client, iter_pdf_files, tei_file_path
+from doc2json.grobid2json.manifest import STAGE_JSON, STAGE_TEI, Manifest, file_sha256
+from doc2json.grobid2json.tei_cache import DiskTeiCache, TeiCache
 from doc2json.grobid2json.tei_to_json import convert_tei_xml_file_to_s2orc_json, convert_tei_xml_soup_to_s2orc_json
+from doc2json.grobid2json import tei_to_json_lxml, tei_to_json_stream
 
 BASE_TEMP_DIR = 'temp'
 BASE_OUTPUT_DIR = 'output'
 BASE_LOG_DIR = 'log'
 
+# TEI to JSON converters, all give the same JSON: BeautifulSoup (reference), lxml (faster) or lxml streaming
+# the TEI section by section (bounded memory, for very long documents)
+ENGINE_BS4 = 'bs4'
+ENGINE_LXML = 'lxml'
+ENGINE_LXML_STREAM = 'lxml-stream'
+ENGINES = [ENGINE_BS4, ENGINE_LXML, ENGINE_LXML_STREAM]
 
-def process_pdf_stream(input_file: str, sha: str, input_stream: bytes, grobid_config: Optional[Dict] = None) -> Dict:
+# what the conversion extracts: everything (full), or what answering questions on the paper uses (qa), without
+# parsing the bibliography nor linking citations to it, citations are left as text and bib_entries is empty
+PROFILE_FULL = 'full'
+PROFILE_QA = 'qa'
+PROFILES = [PROFILE_FULL, PROFILE_QA]
+
+
+def links_citations(profile: str) -> bool:
     """
-    Process PDF stream
-    :param input_file:
-    :param sha:
-    :param input_stream:
+    Whether the conversion profile parses the bibliography and links citations to it
+    :param profile: one of PROFILES
+    :return:
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown conversion profile {profile}, expected one of {PROFILES}")
+    return profile == PROFILE_FULL
+
+
+def process_pdf_stream(input_file: str, sha: str, input_stream: bytes, grobid_config: Optional[Dict] = None,
+                       tei_cache: Optional[TeiCache] = None, engine: str = ENGINE_BS4,
+                       profile: str = PROFILE_FULL) -> Dict:
+    """
+    Process PDF stream, fully in memory
+    :param input_file: name of the PDF, used as paper id
+    :param sha: hash of the PDF
+    :param input_stream: content of the PDF
+    :param tei_cache: TEI of PDFs already processed by Grobid
+    :param engine: TEI to JSON converter, one of ENGINES
+    :param profile: what the conversion extracts, one of PROFILES
     :return:
     """
+    # fail before the Grobid call
+    links_citations(profile)
     # process PDF through Grobid -> TEI.XML
-    client = GrobidClient(grobid_config)
-    tei_text = client.process_pdf_stream(input_file, input_stream, 'temp', "processFulltextDocument")
+    client = get_grobid_client(grobid_config)
+    tei_text = client.process_pdf_stream(input_file, input_stream, None, "processFulltextDocument", tei_cache=tei_cache)
+    if not tei_text:
+        raise RuntimeError(f"Grobid failed to process {input_file}")
+
+    return convert_tei_text(tei_text, input_file, sha, engine, profile)
 
-    # make soup
-    soup = BeautifulSoup(tei_text, "xml")
 
-    # get paper
-    paper = convert_tei_xml_soup_to_s2orc_json(soup, input_file, sha)
+def convert_tei_text(tei_text: str, paper_id: str, sha: str, engine: str = ENGINE_BS4,
+                     profile: str = PROFILE_FULL) -> Dict:
+    """
+    Convert the TEI XML produced by Grobid to the JSON representation of the paper
+    :param tei_text: TEI XML
+    :param paper_id:
+    :param sha: hash of the PDF
+    :param engine: TEI to JSON converter, one of ENGINES
+    :param profile: what the conversion extracts, one of PROFILES
+    :return:
+    """
+    link_citations = links_citations(profile)
+    if engine == ENGINE_LXML:
+        paper = tei_to_json_lxml.convert_tei_xml_to_s2orc_json(tei_text, paper_id, sha, link_citations)
+    elif engine == ENGINE_LXML_STREAM:
+        paper = tei_to_json_stream.convert_tei_xml_stream_to_s2orc_json(
+            tei_text.encode('utf-8'), paper_id, sha, link_citations)
+    elif engine == ENGINE_BS4:
+        # make soup
+        soup = BeautifulSoup(tei_text, "xml")
+        paper = convert_tei_xml_soup_to_s2orc_json(soup, paper_id, sha, link_citations)
+    else:
+        raise ValueError(f"Unknown TEI to JSON engine {engine}, expected one of {ENGINES}")
 
     return paper.release_json('pdf')
 
 
+def convert_tei_file_to_paper(tei_file: str, engine: str = ENGINE_BS4, profile: str = PROFILE_FULL) -> Paper:
+    """
+    Convert a TEI XML file with the given engine, one of ENGINES
+    :param tei_file:
+    :param engine:
+    :param profile: one of PROFILES
+    :return:
+    """
+    link_citations = links_citations(profile)
+    if engine == ENGINE_LXML:
+        return tei_to_json_lxml.convert_tei_xml_file_to_s2orc_json(tei_file, link_citations=link_citations)
+    if engine == ENGINE_LXML_STREAM:
+        return tei_to_json_stream.convert_tei_xml_file_stream_to_s2orc_json(tei_file, link_citations=link_citations)
+    if engine == ENGINE_BS4:
+        return convert_tei_xml_file_to_s2orc_json(tei_file, link_citations=link_citations)
+    raise ValueError(f"Unknown TEI to JSON engine {engine}, expected one of {ENGINES}")
+
+
 def process_pdf_file(
         input_file: str,
         temp_dir: str = BASE_TEMP_DIR,
         output_dir: str = BASE_OUTPUT_DIR,
-        grobid_config: Optional[Dict] = None
+        grobid_config: Optional[Dict] = None,
+        tei_cache: Optional[TeiCache] = None,
+        engine: str = ENGINE_BS4,
+        profile: str = PROFILE_FULL
 ) -> str:
     """
     Process a PDF file and get JSON representation
     :param input_file:
     :param temp_dir:
     :param output_dir:
+    :param tei_cache: TEI of PDFs already processed by Grobid
+    :param engine: TEI to JSON converter, one of ENGINES
+    :param profile: what the conversion extracts, one of PROFILES
     :return:
     """
+    # fail before the Grobid calls
+    links_citations(profile)
     os.makedirs(temp_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
 
@@ -62,14 +147,14 @@ def process_pdf_file(
         print(f'{output_file} already exists!')
 
     # process PDF through Grobid -> TEI.XML
-    client = GrobidClient(grobid_config)
+    client = get_grobid_client(grobid_config)
     # TODO: compute PDF hash
     # TODO: add grobid version number to output
-    client.process_pdf(input_file, temp_dir, "processFulltextDocument")
+    client.process_pdf(input_file, temp_dir, "processFulltextDocument", tei_cache)
 
     # process TEI.XML -> JSON
     assert os.path.exists(tei_file)
-    paper = convert_tei_xml_file_to_s2orc_json(tei_file)
+    paper = convert_tei_file_to_paper(tei_file, engine, profile)
 
     # write to file
     with open(output_file, 'w') as outf:
@@ -78,12 +163,141 @@ def process_pdf_file(
     return output_file
 
 
+def convert_tei_file(tei_file: str, output_dir: str, engine: str = ENGINE_BS4, profile: str = PROFILE_FULL) -> str:
+    """
+    Convert a TEI XML file to a JSON file, returns the path of the JSON file
+    :param tei_file:
+    :param output_dir:
+    :param engine: TEI to JSON converter, one of ENGINES
+    :param profile: what the conversion extracts, one of PROFILES
+    :return:
+    """
+    paper_id = '.'.join(tei_file.split('/')[-1].split('.')[:-2])
+    output_file = os.path.join(output_dir, f'{paper_id}.json')
+    paper = convert_tei_file_to_paper(tei_file, engine, profile)
+    with open(output_file, 'w') as outf:
+        json.dump(paper.release_json(), outf, indent=4, sort_keys=False)
+    return output_file
+
+
+def _timed_convert_tei_file(tei_file: str, output_dir: str, engine: str, profile: str) -> Tuple[str, float]:
+    start_time = time.time()
+    output_file = convert_tei_file(tei_file, output_dir, engine, profile)
+    return output_file, time.time() - start_time
+
+
+def process_pdf_dir(
+        input_dir: str,
+        temp_dir: str = BASE_TEMP_DIR,
+        output_dir: str = BASE_OUTPUT_DIR,
+        grobid_config: Optional[Dict] = None,
+        conversion_workers: Optional[int] = None,
+        manifest_path: Optional[str] = None,
+        retry_failed: bool = False,
+        tei_cache: Optional[TeiCache] = None,
+        engine: str = ENGINE_BS4,
+        profile: str = PROFILE_FULL
+) -> Throughput:
+    """
+    Process every PDF of a directory. PDFs are sent to Grobid concurrently (`max_workers` of the Grobid config)
+    and each TEI file is converted to JSON in a process pool as soon as it is produced, in parallel with the
+    remaining Grobid calls.
+    With a manifest, the progress of every PDF is recorded and a re-run resumes where the previous one stopped:
+    converted PDFs are skipped, PDFs with a TEI file only go through the conversion, and failed PDFs are
+    skipped unless `retry_failed` is set. PDFs whose content changed since they were recorded are processed again.
+    :param input_dir:
+    :param temp_dir:
+    :param output_dir:
+    :param grobid_config:
+    :param conversion_workers: size of the conversion process pool, defaults to the number of CPUs
+    :param manifest_path: path of the SQLite manifest, created if needed
+    :param retry_failed: process again the PDFs that failed in a previous run
+    :param tei_cache: TEI of PDFs already processed by Grobid
+    :param engine: TEI to JSON converter, one of ENGINES
+    :param profile: what the conversion extracts, one of PROFILES
+    :return: throughput of the conversions
+    """
+    # fail before the Grobid calls
+    links_citations(profile)
+    os.makedirs(temp_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+
+    client = get_grobid_client(grobid_config)
+    manifest = Manifest(manifest_path) if manifest_path else None
+    throughput = Throughput("TEI to JSON", client.config['report_every'])
+
+    def on_converted(pdf_file: str, future):
+        error = future.exception()
+        if error is not None:
+            print(f"Conversion of {pdf_file} failed: {error}")
+            if manifest:
+                manifest.failed(pdf_file, str(error) or type(error).__name__)
+        elif manifest:
+            manifest.json_done(pdf_file, future.result()[1])
+        throughput.add(ok=error is None)
+
+    pool = ConversionPool(conversion_workers)
+    try:
+        def convert(pdf_file: str, tei_file: str):
+            pool.submit(_timed_convert_tei_file, tei_file, output_dir, engine, profile).add_done_callback(
+                lambda future: on_converted(pdf_file, future))
+
+        def on_tei(result: GrobidResult):
+            if result.tei_file is None:
+                if manifest:
+                    manifest.failed(result.pdf_file, result.error)
+                return
+            if manifest:
+                manifest.tei_done(result.pdf_file, result.seconds)
+            convert(result.pdf_file, result.tei_file)
+
+        def pdfs_to_process():
+            for pdf_file in iter_pdf_files(input_dir):
+                if manifest:
+                    entry = manifest.get(pdf_file)
+                    sha256 = file_sha256(pdf_file)
+                    tei_file = tei_file_path(pdf_file, temp_dir)
+                    if entry is not None and entry.sha256 is not None and entry.sha256 != sha256:
+                        # replaced in place since the previous run, its TEI file is the one of the old PDF
+                        print(f"{pdf_file} changed since the previous run, processing it again")
+                        entry = None
+                        if os.path.isfile(tei_file):
+                            os.remove(tei_file)
+                    if entry is not None and entry.error is not None and not retry_failed:
+                        continue
+                    if entry is not None and entry.error is None and entry.stage == STAGE_JSON:
+                        continue
+                    if entry is not None and entry.stage in [STAGE_TEI, STAGE_JSON] and os.path.isfile(tei_file):
+                        convert(pdf_file, tei_file)
+                        continue
+                    manifest.start(pdf_file, sha256)
+                yield pdf_file
+
+        client.process_batch(pdfs_to_process(), temp_dir, "processFulltextDocument", on_tei, tei_cache)
+    finally:
+        pool.shutdown()
+
+    throughput.report()
+    print(f"Conversion pool: {pool.metrics()}")
+    if manifest:
+        print(f"Manifest: {manifest.summary()}")
+        manifest.close()
+    return throughput
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run S2ORC PDF2JSON")
-    parser.add_argument("-i", "--input", default=None, help="path to the input PDF file")
+    parser.add_argument("-i", "--input", default=None, help="path to the input PDF file, or to a directory of PDF files")
     parser.add_argument("-t", "--temp", default=BASE_TEMP_DIR, help="path to the temp dir for putting tei xml files")
     parser.add_argument("-o", "--output", default=BASE_OUTPUT_DIR, help="path to the output dir for putting json files")
     parser.add_argument("-k", "--keep", action='store_true')
+    parser.add_argument("-w", "--workers", type=int, default=None, help="TEI to JSON conversion processes, for directories")
+    parser.add_argument("-m", "--manifest", default=None, help="path to the SQLite manifest used to resume directory runs")
+    parser.add_argument("--retry-failed", action='store_true', help="process again the PDFs that failed in a previous run")
+    parser.add_argument("--tei-cache", default=None, help="directory caching the Grobid TEI of already processed PDFs")
+    parser.add_argument("-e", "--engine", default=ENGINE_BS4, choices=ENGINES, help="TEI to JSON converter")
+    parser.add_argument("-p", "--profile", default=PROFILE_FULL, choices=PROFILES,
+                        help="what the conversion extracts, qa skips the bibliography and citation links")
 
     args = parser.parse_args()
 
@@ -96,8 +310,15 @@ if __name__ == '__main__':
 
     os.makedirs(temp_path, exist_ok=True)
     os.makedirs(output_path, exist_ok=True)
+    tei_cache = DiskTeiCache(args.tei_cache) if args.tei_cache else None
 
-    process_pdf_file(input_path, temp_path, output_path)
+    if os.path.isdir(input_path):
+        process_pdf_dir(input_path, temp_path, output_path, conversion_workers=args.workers,
+                        manifest_path=args.manifest, retry_failed=args.retry_failed, tei_cache=tei_cache,
+                        engine=args.engine, profile=args.profile)
+    else:
+        process_pdf_file(input_path, temp_path, output_path, tei_cache=tei_cache, engine=args.engine,
+                         profile=args.profile)
 
     runtime = round(time.time() - start_time, 3)
     print("runtime: %s seconds " % (runtime))
@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+
+def tei_cache_key(pdf_strm: bytes, service: str, parameters: Dict[str, str]) -> str:
+    """
+    Key of the TEI produced by Grobid for a PDF: the hash of the PDF plus a digest of
+    everything that changes the output (service and Grobid flags).
+    :param pdf_strm: content of the PDF
+    :param service: Grobid service, e.g. processFulltextDocument
+    :param parameters: Grobid form parameters
+    :return:
+    """
+    return tei_cache_key_for_hash(hashlib.sha256(pdf_strm).hexdigest(), service, parameters)
+
+
+def tei_cache_key_for_hash(pdf_hash: str, service: str, parameters: Dict[str, str]) -> str:
+    """
+    Same as `tei_cache_key`, for a PDF known by its SHA-256 only
+    """
+    flags = json.dumps({'service': service, **parameters}, sort_keys=True)
+    return f"{pdf_hash}.{hashlib.sha256(flags.encode()).hexdigest()[:16]}"
+
+
+class TeiCache(object):
+    """
+    Store of raw Grobid TEI XML, so that a converter change only costs the TEI to JSON step.
+    Implementations must not raise: a failing cache behaves as an empty one.
+    """
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def put(self, key: str, tei_text: str):
+        raise NotImplementedError
+
+
+class DiskTeiCache(TeiCache):
+    """ TEI files in a local directory. """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.tei.xml")
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            with open(self._path(key), 'r', encoding='utf8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key: str, tei_text: str):
+        # write then rename, so a concurrent reader never sees a partial file
+        temp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf8') as f:
+                f.write(tei_text)
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            print(f"Failed to cache TEI {key}: {e}")
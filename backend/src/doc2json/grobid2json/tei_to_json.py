@@ -5,14 +5,13 @@ import sys
 import bs4
 import re
 from bs4 import BeautifulSoup, NavigableString
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 
 from doc2json.s2orc import Paper
 
 from doc2json.utils.grobid_util import parse_bib_entry, extract_paper_metadata_from_grobid_xml
 from doc2json.utils.citation_util import SINGLE_BRACKET_REGEX, BRACKET_REGEX, BRACKET_STYLE_THRESHOLD
 from doc2json.utils.citation_util import is_expansion_string, _clean_empty_and_duplicate_authors_from_grobid_parse
-from doc2json.utils.refspan_util import sub_spans_and_update_indices
 
 REPLACE_TABLE_TOKS = {
     "<row>": "<tr>",
@@ -25,6 +24,13 @@ REPLACE_TABLE_TOKS = {
     "cols=": "colspan="
 }
 
+WHITESPACE_REGEX = re.compile(r'\s+')
+SPAN_TOKEN_REGEX = re.compile(r'CITETOKEN\d+|REFTOKEN\d+')
+
+# check the cite and ref spans of every paragraph against its text, environment variable so that conversion
+# processes see it too
+VERIFY_SPANS = os.getenv("DOC2JSON_VERIFY_SPANS", "") == "1"
+
 
 class UniqTokenGenerator:
     """
@@ -405,11 +411,23 @@ def process_citations_in_paragraph(para_el: BeautifulSoup, sp: BeautifulSoup, bi
     return cite_map
 
 
+def process_citations_as_text(para_el: BeautifulSoup, sp: BeautifulSoup) -> Dict:
+    """
+    Replace all citations in paragraph with their surface form, without cite spans
+    :param para_el:
+    :param sp:
+    :return:
+    """
+    for rtag in para_el.find_all('ref'):
+        rtag.replace_with(sp.new_string(f" {rtag.text.strip()} "))
+    return dict()
+
+
 def process_paragraph(
         sp: BeautifulSoup,
         para_el: bs4.element.Tag,
         section_names: List[Tuple],
-        bib_dict: Dict,
+        bib_dict: Optional[Dict],
         ref_dict: Dict,
         bracket: bool
 ) -> Dict:
@@ -418,7 +436,7 @@ def process_paragraph(
     :param sp:
     :param para_el:
     :param section_names:
-    :param bib_dict:
+    :param bib_dict: bibliography entries, None to leave citations as text
     :param ref_dict:
     :param bracket: if bracket style, expand and clean up citations
     :return:
@@ -440,55 +458,58 @@ def process_paragraph(
     ref_map = process_references_in_paragraph(para_el, sp, ref_dict)
 
     # generate citation map for paragraph element (keep only cite spans with bib entry or unlinked)
-    cite_map = process_citations_in_paragraph(para_el, sp, bib_dict, bracket)
+    if bib_dict is None:
+        cite_map = process_citations_as_text(para_el, sp)
+    else:
+        cite_map = process_citations_in_paragraph(para_el, sp, bib_dict, bracket)
 
-    # substitute space characters
-    para_text = re.sub(r'\s+', ' ', para_el.text)
-    para_text = re.sub(r'\s', ' ', para_text)
+    return paragraph_from_tokens(para_el.text, cite_map, ref_map, section_names)
 
-    # get all cite and ref spans
-    all_spans_to_replace = []
-    for span in re.finditer(r'(CITETOKEN\d+)', para_text):
-        uniq_token = span.group()
-        ref_id, surface_text = cite_map[uniq_token]
-        all_spans_to_replace.append((
-            span.start(),
-            span.start() + len(uniq_token),
-            uniq_token,
-            surface_text
-        ))
-    for span in re.finditer(r'(REFTOKEN\d+)', para_text):
+
+def paragraph_from_tokens(text: str, cite_map: Dict, ref_map: Dict, section_names: List[Tuple]) -> Dict:
+    """
+    Create the paragraph dict from its text, in which cite and ref spans are still unique tokens
+    :param text: text of the paragraph element
+    :param cite_map: surface form and ref id of each CITETOKEN
+    :param ref_map: surface form, ref id and type of each REFTOKEN
+    :param section_names:
+    :return:
+    """
+    # substitute space characters
+    para_text = WHITESPACE_REGEX.sub(' ', text)
+
+    # replace cite and ref tokens with their surface form and create json blobs, in one scan of the text
+    pieces = []
+    cite_span_blobs = []
+    ref_span_blobs = []
+    # end of the last token in para_text, and length of the new text so far
+    position = 0
+    length = 0
+    for span in SPAN_TOKEN_REGEX.finditer(para_text):
         uniq_token = span.group()
-        ref_id, surface_text, ref_type = ref_map[uniq_token]
-        all_spans_to_replace.append((
-            span.start(),
-            span.start() + len(uniq_token),
-            uniq_token,
-            surface_text
-        ))
-
-    # replace cite and ref spans and create json blobs
-    para_text, all_spans_to_replace = sub_spans_and_update_indices(all_spans_to_replace, para_text)
-
-    cite_span_blobs = [{
-        "start": start,
-        "end": end,
-        "text": surface,
-        "ref_id": cite_map[token][0]
-    } for start, end, token, surface in all_spans_to_replace if token.startswith('CITETOKEN')]
-
-    ref_span_blobs = [{
-        "start": start,
-        "end": end,
-        "text": surface,
-        "ref_id": ref_map[token][0]
-    } for start, end, token, surface in all_spans_to_replace if token.startswith('REFTOKEN')]
-
-    for cite_blob in cite_span_blobs:
-        assert para_text[cite_blob["start"]:cite_blob["end"]] == cite_blob["text"]
-
-    for ref_blob in ref_span_blobs:
-        assert para_text[ref_blob["start"]:ref_blob["end"]] == ref_blob["text"]
+        if uniq_token.startswith('CITETOKEN'):
+            ref_id, surface_text = cite_map[uniq_token]
+            span_blobs = cite_span_blobs
+        else:
+            ref_id, surface_text, ref_type = ref_map[uniq_token]
+            span_blobs = ref_span_blobs
+        pieces.append(para_text[position:span.start()])
+        length += span.start() - position
+        span_blobs.append({
+            "start": length,
+            "end": length + len(surface_text),
+            "text": surface_text,
+            "ref_id": ref_id
+        })
+        pieces.append(surface_text)
+        length += len(surface_text)
+        position = span.end()
+    pieces.append(para_text[position:])
+    para_text = ''.join(pieces)
+
+    if VERIFY_SPANS:
+        for span_blob in cite_span_blobs + ref_span_blobs:
+            assert para_text[span_blob["start"]:span_blob["end"]] == span_blob["text"]
 
     return {
         'text': para_text,
@@ -703,12 +724,18 @@ def extract_back_matter_from_tei_xml(
     return back_text
 
 
-def convert_tei_xml_soup_to_s2orc_json(soup: BeautifulSoup, paper_id: str, pdf_hash: str) -> Paper:
+def convert_tei_xml_soup_to_s2orc_json(
+        soup: BeautifulSoup,
+        paper_id: str,
+        pdf_hash: str,
+        link_citations: bool = True
+) -> Paper:
     """
     Convert Grobid TEI XML to S2ORC json format
     :param soup: BeautifulSoup of XML file content
     :param paper_id: name of file
     :param pdf_hash: hash of PDF
+    :param link_citations: parse the bibliography and link citations to it, else citations are left as text
     :return:
     """
     # extract metadata
@@ -717,10 +744,15 @@ def convert_tei_xml_soup_to_s2orc_json(soup: BeautifulSoup, paper_id: str, pdf_h
     metadata['authors'] = _clean_empty_and_duplicate_authors_from_grobid_parse(metadata['authors'])
 
     # parse bibliography entries (removes empty bib entries)
-    biblio_entries = parse_bibliography(soup)
-    bibkey_map = {
-        normalize_grobid_id(bib['ref_id']): bib for bib in biblio_entries
-    }
+    if link_citations:
+        biblio_entries = parse_bibliography(soup)
+        bibkey_map = {
+            normalize_grobid_id(bib['ref_id']): bib for bib in biblio_entries
+        }
+    else:
+        if soup.listBibl is not None:
+            soup.listBibl.decompose()
+        bibkey_map = None
 
     # # process formulas and replace with text
     # extract_formulas_from_tei_xml(soup)
@@ -729,7 +761,7 @@ def convert_tei_xml_soup_to_s2orc_json(soup: BeautifulSoup, paper_id: str, pdf_h
     refkey_map = extract_figures_and_tables_from_tei_xml(soup)
 
     # get bracket style
-    is_bracket_style = check_if_citations_are_bracket_style(soup)
+    is_bracket_style = check_if_citations_are_bracket_style(soup) if link_citations else False
 
     # substitute all note tags with p tags
     soup = sub_all_note_tags(soup)
@@ -751,21 +783,22 @@ def convert_tei_xml_soup_to_s2orc_json(soup: BeautifulSoup, paper_id: str, pdf_h
         abstract=abstract_entries,
         body_text=body_entries,
         back_matter=back_matter,
-        bib_entries=bibkey_map,
+        bib_entries=bibkey_map if bibkey_map is not None else dict(),
         ref_entries=refkey_map
     )
 
 
-def convert_tei_xml_file_to_s2orc_json(tei_file: str, pdf_hash: str = "") -> Paper:
+def convert_tei_xml_file_to_s2orc_json(tei_file: str, pdf_hash: str = "", link_citations: bool = True) -> Paper:
     """
     Convert a TEI XML file to S2ORC JSON
     :param tei_file:
     :param pdf_hash:
+    :param link_citations:
     :return:
     """
     if not os.path.exists(tei_file):
         raise FileNotFoundError("Input TEI XML file doesn't exist")
     paper_id = tei_file.split('/')[-1].split('.')[0]
     soup = BeautifulSoup(open(tei_file, "rb").read(), "xml")
-    paper = convert_tei_xml_soup_to_s2orc_json(soup, paper_id, pdf_hash)
+    paper = convert_tei_xml_soup_to_s2orc_json(soup, paper_id, pdf_hash, link_citations)
     return paper
@@ -0,0 +1,1105 @@
+"""
+Grobid TEI XML to S2ORC JSON on top of lxml.etree, a faster engine than tei_to_json.
+
+The conversion goes through the same steps as tei_to_json, on an lxml tree instead of a soup, and must give the
+same `Paper.release_json()` for the same TEI, quirks included: tei_to_json is the reference and any difference is
+a bug of this module. `python -m doc2json.grobid2json.engine_parity` compares both engines.
+
+Elements are matched by local name, as BeautifulSoup does, so TEI without the TEI namespace converts the same.
+"""
+import os
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Union
+
+from lxml import etree
+
+from doc2json.s2orc import Paper
+from doc2json.grobid2json.tei_to_json import REPLACE_TABLE_TOKS, UniqTokenGenerator, normalize_grobid_id, \
+    paragraph_from_tokens
+from doc2json.utils.citation_util import SINGLE_BRACKET_REGEX, BRACKET_REGEX, BRACKET_STYLE_THRESHOLD
+from doc2json.utils.citation_util import is_expansion_string, _clean_empty_and_duplicate_authors_from_grobid_parse
+from doc2json.utils.grobid_util import SUBSTITUTE_TAGS
+
+XML_ID = '{http://www.w3.org/XML/1998/namespace}id'
+XML_NAMESPACE = 'http://www.w3.org/XML/1998/namespace'
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# as the BeautifulSoup "xml" builder: broken TEI is recovered rather than rejected
+PARSER = etree.XMLParser(recover=True, remove_comments=True, remove_pis=True, encoding='utf-8')
+
+
+def _any_ns(name: str) -> str:
+    return '{*}' + name
+
+
+def _local_name(el: etree._Element) -> str:
+    # as etree.QName(el).localname, without building a QName
+    return el.tag.rpartition('}')[2]
+
+
+def _find(el: etree._Element, name: str) -> Optional[etree._Element]:
+    """ First descendant named `name`, as `tag.name` on a soup """
+    return next(el.iterdescendants(_any_ns(name)), None)
+
+
+def _find_all(el: etree._Element, name: str) -> List[etree._Element]:
+    return list(el.iterdescendants(_any_ns(name)))
+
+
+def _find_next(el: etree._Element, name: str) -> Optional[etree._Element]:
+    """ First element named `name` after the start of `el`, in document order, as `tag.find_next` """
+    tag = _any_ns(name)
+    found = next(el.iterdescendants(tag), None)
+    while found is None and el is not None:
+        for sibling in el.itersiblings():
+            found = next(sibling.iter(tag), None)
+            if found is not None:
+                break
+        el = el.getparent()
+    return found
+
+
+def _text(el: etree._Element) -> str:
+    return ''.join(el.itertext())
+
+
+def _strings_before(el: etree._Element) -> str:
+    previous = el.getprevious()
+    return (previous.tail if previous is not None else el.getparent().text) or ''
+
+
+def _clear_strings_before(el: etree._Element):
+    previous = el.getprevious()
+    if previous is not None:
+        previous.tail = None
+    else:
+        el.getparent().text = None
+
+
+def _replace_with_text(el: etree._Element, text: str):
+    """ Replace the element with a string, as `tag.replace_with(sp.new_string(text))` """
+    parent = el.getparent()
+    if parent is None:
+        raise ValueError("Cannot replace an element which is not part of a tree")
+    text = text + (el.tail or '')
+    previous = el.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+    parent.remove(el)
+
+
+def _decompose(el: etree._Element):
+    _replace_with_text(el, '')
+
+
+def _contents_length(el: etree._Element) -> int:
+    """ Number of children of the element, strings included, as `len(tag.contents)` """
+    return (1 if el.text else 0) + sum(1 + (1 if child.tail else 0) for child in el)
+
+
+def _attribute_name(el: etree._Element, name: str) -> str:
+    if not name.startswith('{'):
+        return name
+    qname = etree.QName(name)
+    if qname.namespace == XML_NAMESPACE:
+        return f'xml:{qname.localname}'
+    prefixes = {namespace: prefix for prefix, namespace in el.nsmap.items()}
+    return f'{prefixes[qname.namespace]}:{qname.localname}' if prefixes.get(qname.namespace) else qname.localname
+
+
+def _escape(text: str) -> str:
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quoted_attribute_value(value: str) -> str:
+    value = _escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"' + value.replace('"', '&quot;') + '"'
+        return "'" + value + "'"
+    return '"' + value + '"'
+
+
+def _serialize(el: etree._Element, contents: Optional[List] = None) -> str:
+    """ XML of the element as `str(tag)` of a soup (no namespace declarations, `<tag/>` when empty) """
+    if contents is None:
+        contents = _contents(el)
+    name = _local_name(el)
+    attributes = ''.join(
+        f' {_attribute_name(el, key)}={_quoted_attribute_value(value)}' for key, value in el.attrib.items())
+    if not contents:
+        return f'<{name}{attributes}/>'
+    inner = ''.join(_escape(node) if isinstance(node, str) else _serialize(node) for node in contents)
+    return f'<{name}{attributes}>{inner}</{name}>'
+
+
+def _contents(el: etree._Element) -> List[Union[str, etree._Element]]:
+    contents = [el.text] if el.text else []
+    for child in el:
+        contents.append(child)
+        if child.tail:
+            contents.append(child.tail)
+    return contents
+
+
+def _get_author_names(raw_xml: etree._Element) -> List[Dict]:
+    """ get_author_names_from_grobid_xml """
+    names = []
+    for author in _find_all(raw_xml, 'author'):
+        persname = _find(author, 'persName')
+        if persname is None:
+            continue
+
+        first = ""
+        middle = []
+        last = ""
+        for forename in _find_all(persname, 'forename'):
+            if forename.attrib["type"] == "first":
+                if not first:
+                    first = _text(forename)
+                else:
+                    middle.append(_text(forename))
+            elif forename.attrib["type"] == "middle":
+                middle.append(_text(forename))
+
+        surnames = _find_all(persname, 'surname')
+        if len(surnames) > 1:
+            for surname in surnames[:-1]:
+                middle.append(_text(surname))
+            last = _text(surnames[-1])
+        elif len(surnames) == 1:
+            last = _text(surnames[0])
+
+        # the suffixes are never read by grobid_util
+        names.append({
+            "first": first,
+            "middle": middle,
+            "last": last,
+            "suffix": ""
+        })
+    return names
+
+
+def _get_affiliation(raw_xml: etree._Element) -> Dict:
+    """ get_affiliation_from_grobid_xml """
+    location_dict = dict()
+    laboratory_name = ""
+    institution_name = ""
+
+    affiliation = _find(raw_xml, 'affiliation')
+    if affiliation is not None:
+        for child in affiliation:
+            child_name = _local_name(child)
+            if child_name == "orgName":
+                if child.get("type") == "laboratory":
+                    laboratory_name = _text(child)
+                elif child.get("type") == "institution":
+                    institution_name = _text(child)
+            elif child_name == "address":
+                for grandchild in child:
+                    if _text(grandchild):
+                        name = _local_name(grandchild)
+                        # the names grobid_util lowercased in the soup
+                        location_dict[name.lower() if name in SUBSTITUTE_TAGS else name] = _text(grandchild)
+
+        if laboratory_name or institution_name:
+            return {
+                "laboratory": laboratory_name,
+                "institution": institution_name,
+                "location": location_dict
+            }
+
+    return {}
+
+
+def _get_author_data(raw_xml: etree._Element) -> List[Dict]:
+    """ get_author_data_from_grobid_xml """
+    authors = []
+    for author in _find_all(raw_xml, 'author'):
+        first = ""
+        middle = []
+        last = ""
+
+        persname = _find(author, 'persName')
+        if persname is not None:
+            for forename in _find_all(persname, 'forename'):
+                if forename.get("type") == "first":
+                    if not first:
+                        first = _text(forename)
+                    else:
+                        middle.append(_text(forename))
+                elif forename.get("type") == "middle":
+                    middle.append(_text(forename))
+
+            surnames = _find_all(persname, 'surname')
+            if len(surnames) > 1:
+                for surname in surnames[:-1]:
+                    middle.append(_text(surname))
+                last = _text(surnames[-1])
+            elif len(surnames) == 1:
+                last = _text(surnames[0])
+
+        email = _find(author, 'email')
+        authors.append({
+            "first": first,
+            "middle": middle,
+            "last": last,
+            "suffix": "",
+            "affiliation": _get_affiliation(author),
+            "email": _text(email) if email is not None else ""
+        })
+    return authors
+
+
+def extract_paper_metadata(file_desc: etree._Element) -> Dict:
+    """
+    Extract paper metadata (title, authors, year) from the fileDesc element, as extract_paper_metadata_from_grobid_xml
+    :param file_desc:
+    :return:
+    """
+    return {
+        "title": _text(_find(_find(file_desc, 'titleStmt'), 'title')),
+        "authors": _get_author_data(file_desc),
+        # grobid_util looks publicationStmt up once it lowercased its name: the year is always empty
+        "year": ""
+    }
+
+
+def _get_title(raw_xml: etree._Element) -> str:
+    titles = _find_all(raw_xml, 'title')
+    for title_entry in titles:
+        if title_entry.get("level") == "a":
+            return _text(title_entry)
+    return _text(titles[0]) if titles else ""
+
+
+def _get_year(raw_xml: etree._Element) -> Optional[int]:
+    date = _find(raw_xml, 'date')
+    if date is not None and date.get("when") is not None:
+        year_match = re.match(r"((19|20)\d{2})", date.get("when"))
+        if year_match:
+            year = year_match.group(0)
+            if year and year.isnumeric() and len(year) == 4:
+                return int(year)
+    return None
+
+
+def _get_venue(raw_xml: etree._Element, title_text: str) -> str:
+    title_names = []
+    keep_types = ["j", "m", "s"]
+    for title_entry in _find_all(raw_xml, 'title'):
+        if title_entry.get("level") in keep_types and _text(title_entry) != title_text:
+            title_names.append((title_entry.get("level"), _text(title_entry)))
+    if title_names:
+        title_names.sort(key=lambda x: keep_types.index(x[0]))
+        return title_names[0][1]
+    return ""
+
+
+def _get_bibl_scope(raw_xml: etree._Element, unit: str) -> str:
+    for bibl_entry in _find_all(raw_xml, 'biblScope'):
+        if bibl_entry.get("unit") == unit:
+            return _text(bibl_entry)
+    return ""
+
+
+def _get_pages(raw_xml: etree._Element) -> str:
+    for bibl_entry in _find_all(raw_xml, 'biblScope'):
+        if bibl_entry.get("unit") == "page" and bibl_entry.get("from") is not None:
+            if bibl_entry.get("to") is not None:
+                return f'{bibl_entry.get("from")}--{bibl_entry.get("to")}'
+            return bibl_entry.get("from")
+    return ""
+
+
+def _get_other_ids(raw_xml: etree._Element) -> Dict[str, List]:
+    other_ids = defaultdict(list)
+    for idno_entry in _find_all(raw_xml, 'idno'):
+        if idno_entry.get("type") is not None and _text(idno_entry):
+            other_ids[idno_entry.get("type")].append(_text(idno_entry))
+    return other_ids
+
+
+def _get_raw_bib_text(raw_xml: etree._Element) -> str:
+    for note in _find_all(raw_xml, 'note'):
+        if note.get("type") == "raw_reference":
+            return _text(note)
+    return ""
+
+
+def parse_bib_entry(bib_entry: etree._Element) -> Dict:
+    """
+    Parse one biblStruct element, as grobid_util.parse_bib_entry
+    :param bib_entry:
+    :return:
+    """
+    title = _get_title(bib_entry)
+    return {
+        'ref_id': bib_entry.get(XML_ID),
+        'title': title,
+        'authors': _get_author_names(bib_entry),
+        'year': _get_year(bib_entry),
+        'venue': _get_venue(bib_entry, title),
+        'volume': _get_bibl_scope(bib_entry, "volume"),
+        'issue': _get_bibl_scope(bib_entry, "issue"),
+        'pages': _get_pages(bib_entry),
+        'other_ids': _get_other_ids(bib_entry),
+        'raw_text': _get_raw_bib_text(bib_entry),
+        'urls': []
+    }
+
+
+def parse_bibliography(root: etree._Element) -> List[Dict]:
+    """
+    Finds all bibliography entries in a grobid xml.
+    """
+    bibliography = _find(root, 'listBibl')
+    if bibliography is None:
+        return []
+
+    structured_entries = parse_list_bibl(bibliography)
+    _decompose(bibliography)
+
+    return structured_entries
+
+
+def parse_list_bibl(bibliography: etree._Element) -> List[Dict]:
+    """
+    Parse the entries of a listBibl element, the ones without title are left out
+    :param bibliography:
+    :return:
+    """
+    structured_entries = []
+    for entry in _find_all(bibliography, 'biblStruct'):
+        bib_entry = parse_bib_entry(entry)
+        # add bib entry only if it has a title
+        if bib_entry['title']:
+            structured_entries.append(bib_entry)
+    return structured_entries
+
+
+def table_to_html(table: etree._Element) -> str:
+    """
+    Sub table tags with html table tags
+    :param table:
+    :return:
+    """
+    if table is None:
+        raise TypeError("'NoneType' object is not iterable")
+    # tei_to_json removes the children other than rows while iterating over them, which skips the child
+    # following each removed one
+    contents = _contents(table)
+    index = 0
+    while index < len(contents):
+        tag = contents[index]
+        if isinstance(tag, str) or _local_name(tag) != 'row':
+            if not isinstance(tag, str):
+                print(f'Unknown table subtag: {_local_name(tag)}')
+            del contents[index]
+        index += 1
+    table_str = _serialize(table, contents)
+    for token, subtoken in REPLACE_TABLE_TOKS.items():
+        table_str = table_str.replace(token, subtoken)
+    return table_str
+
+
+def extract_figures_and_tables(root: etree._Element) -> Dict[str, Dict]:
+    """
+    Generate figure and table dicts
+    :param root:
+    :return:
+    """
+    ref_map = dict()
+
+    for fig in _find_all(root, 'figure'):
+        try:
+            if fig.get(XML_ID):
+                if fig.get('type') == 'table':
+                    ref_map[normalize_grobid_id(fig.get(XML_ID))] = table_entry(fig)
+                else:
+                    head = _find_next(fig, 'head')
+                    if head is None:
+                        raise AttributeError("no head after the figure")
+                    ref_map[normalize_grobid_id(fig.get(XML_ID))] = figure_entry(fig, _find_next(head, 'label'))
+        except AttributeError:
+            continue
+        _decompose(fig)
+
+    return ref_map
+
+
+def table_entry(fig: etree._Element) -> Dict:
+    """
+    Table dict of a figure of type table
+    :param fig:
+    :return:
+    """
+    fig_desc = _find(fig, 'figDesc')
+    head = _find(fig, 'head')
+    return {
+        "text": _text(fig_desc).strip() if fig_desc is not None else _text(head).strip() if head is not None else "",
+        "latex": None,
+        "type": "table",
+        "content": table_to_html(_find(fig, 'table')),
+        "fig_num": fig.get(XML_ID)
+    }
+
+
+def figure_entry(fig: etree._Element, label: Optional[etree._Element]) -> Dict:
+    """
+    Figure dict of a figure, numbered by the first label following its head
+    :param fig:
+    :param label:
+    :return:
+    """
+    if label is None:
+        raise TypeError("'NoneType' object is not iterable")
+    if len(label):
+        # tei_to_json calls isdigit on every child of the label, which fails on tags
+        raise TypeError("'NoneType' object is not callable")
+    fig_desc = _find(fig, 'figDesc')
+    return {
+        "text": _text(fig_desc).strip() if fig_desc is not None else "",
+        "latex": None,
+        "type": "figure",
+        "content": "",
+        "fig_num": label.text if label.text and label.text.isdigit() else None
+    }
+
+
+def check_if_citations_are_bracket_style(root: etree._Element) -> bool:
+    """
+    Check if the document has bracket style citations
+    :param root:
+    :return:
+    """
+    body = _find(root, 'body')
+    if body is None:
+        return False
+
+    cite_strings = []
+    for div in _find_all(body, 'div'):
+        if _find(div, 'head') is not None:
+            continue
+        for rtag in _find_all(div, 'ref'):
+            if rtag.get('type') == 'bibr':
+                cite_strings.append(_text(rtag).strip())
+
+    return is_bracket_style(cite_strings)
+
+
+def is_bracket_style(cite_strings: List[str]) -> bool:
+    """
+    Check if enough of the citation strings are bracket style
+    :param cite_strings:
+    :return:
+    """
+    bracket_style = [bool(BRACKET_REGEX.match(cite_str)) for cite_str in cite_strings]
+    return sum(bracket_style) > BRACKET_STYLE_THRESHOLD
+
+
+def sub_all_note_tags(root: etree._Element):
+    """
+    Sub all note tags with p tags
+    :param root:
+    :return:
+    """
+    for ntag in _find_all(root, 'note'):
+        sub_note_tag(ntag)
+
+
+def sub_note_tag(ntag: etree._Element) -> etree._Element:
+    """
+    Sub a note tag with a p tag holding its text
+    :param ntag:
+    :return: the p tag
+    """
+    p_tag = etree.Element(etree.QName(etree.QName(ntag).namespace, 'p') if etree.QName(ntag).namespace else 'p')
+    p_tag.text = _text(ntag).strip()
+    p_tag.tail = ntag.tail
+    if ntag.getparent() is None:
+        raise ValueError("Cannot replace an element which is not part of a tree")
+    ntag.getparent().replace(ntag, p_tag)
+    return p_tag
+
+
+def _find_formulas_and_refs(para_el: etree._Element) -> Tuple[List[etree._Element], List[etree._Element]]:
+    """ Formulas and refs of the paragraph, in one walk of its descendants """
+    formulas = []
+    refs = []
+    for el in para_el.iterdescendants(_any_ns('formula'), _any_ns('ref')):
+        (formulas if _local_name(el) == 'formula' else refs).append(el)
+    return formulas, refs
+
+
+def _is_descendant(el: etree._Element, ancestor: etree._Element) -> bool:
+    return any(parent is ancestor for parent in el.iterancestors())
+
+
+def process_formulas_in_paragraph(para_el: etree._Element, ftags: Optional[List[etree._Element]] = None):
+    """
+    Replace all formulas of the paragraph with their text and label
+    :param para_el:
+    :param ftags: formulas of the paragraph, looked up when not given
+    :return:
+    """
+    for ftag in _find_all(para_el, 'formula') if ftags is None else ftags:
+        # get label if exists and insert a space between formula and label
+        label_el = _find(ftag, 'label')
+        if label_el is not None:
+            label = ' ' + _text(label_el)
+            _decompose(label_el)
+        else:
+            label = ''
+        _replace_with_text(ftag, f'{_text(ftag).strip()}{label}')
+
+
+def process_references_in_paragraph(para_el: etree._Element, refs: Dict,
+                                    rtags: Optional[List[etree._Element]] = None) -> Dict:
+    """
+    Process all references in paragraph and generate a dict that contains (type, ref_id, surface_form)
+    :param para_el:
+    :param refs:
+    :param rtags: refs of the paragraph, looked up when not given
+    :return:
+    """
+    tokgen = UniqTokenGenerator('REFTOKEN')
+    ref_dict = dict()
+    for rtag in _find_all(para_el, 'ref') if rtags is None else rtags:
+        ref_type = rtag.get('type')
+        # skip if citation
+        if ref_type == 'bibr':
+            continue
+        if ref_type == 'table' or ref_type == 'figure':
+            ref_id = rtag.get('target')
+            if ref_id and normalize_grobid_id(ref_id) in refs:
+                # normalize reference string
+                rtag_string = normalize_grobid_id(ref_id)
+            else:
+                rtag_string = None
+            # add to ref set
+            ref_key = tokgen.next()
+            ref_dict[ref_key] = (rtag_string, _text(rtag).strip(), ref_type)
+            _replace_with_text(rtag, f" {ref_key} ")
+        else:
+            # replace with surface form
+            _replace_with_text(rtag, _text(rtag).strip())
+    return ref_dict
+
+
+def _get_surface_range(start_surface: str, end_surface: str) -> Optional[Tuple[int, int]]:
+    span1_match = SINGLE_BRACKET_REGEX.match(start_surface)
+    span2_match = SINGLE_BRACKET_REGEX.match(end_surface)
+    if span1_match and span2_match:
+        # get numbers corresponding to citations
+        span1_num = int(span1_match.group(1))
+        span2_num = int(span2_match.group(1))
+        # expand if range is between 1 and 20
+        if 1 < span2_num - span1_num < 20:
+            return span1_num, span2_num
+    return None
+
+
+def _create_ref_id_range(start_ref_id: str, end_ref_id: str) -> List[str]:
+    start_ref_num = int(start_ref_id[6:])
+    end_ref_num = int(end_ref_id[6:])
+    return [f'BIBREF{curr_ref_num}' for curr_ref_num in range(start_ref_num, end_ref_num + 1)]
+
+
+def _create_surface_range(start_number: int, end_number: int) -> List[str]:
+    return [f'[{n}]' for n in range(start_number, end_number + 1)]
+
+
+def _previous_ref(rtag: etree._Element) -> etree._Element:
+    previous_rtag = next(rtag.itersiblings(_any_ns('ref'), preceding=True), None)
+    if previous_rtag is None:
+        raise AttributeError("no ref before the citation")
+    return previous_rtag
+
+
+def process_citations_in_paragraph(para_el: etree._Element, bibs: Dict, bracket: bool,
+                                   rtags: Optional[List[etree._Element]] = None) -> Dict:
+    """
+    Process all citations in paragraph and generate a dict for surface forms
+    :param para_el:
+    :param bibs:
+    :param bracket:
+    :param rtags: refs of the paragraph, looked up when not given
+    :return:
+    """
+    cite_map = dict()
+    tokgen = UniqTokenGenerator('CITETOKEN')
+
+    for rtag in _find_all(para_el, 'ref') if rtags is None else rtags:
+        try:
+            # get surface span, e.g. [3]
+            surface_span = _text(rtag).strip()
+
+            if not rtag.get('target'):
+                cite_key = tokgen.next()
+                _replace_with_text(rtag, f" {cite_key} ")
+                cite_map[cite_key] = (None, surface_span)
+                continue
+
+            # normalize reference string (#b2 -> BIBREF2)
+            rtag_ref_id = normalize_grobid_id(rtag.get('target'))
+
+            # skip if rtag ref_id not in bibliography
+            if rtag_ref_id not in bibs:
+                cite_key = tokgen.next()
+                _replace_with_text(rtag, f" {cite_key} ")
+                cite_map[cite_key] = (None, surface_span)
+                continue
+
+            # not bracket, add cite span and move on
+            if not bracket:
+                cite_key = tokgen.next()
+                _replace_with_text(rtag, f" {cite_key} ")
+                cite_map[cite_key] = (rtag_ref_id, surface_span)
+                continue
+
+            # if bracket style, only keep if surface form is bracket
+            if not (surface_span and (surface_span[0] == '[' or surface_span[-1] == ']' or surface_span[-1] == ',')):
+                _replace_with_text(rtag, f" {surface_span} ")
+                continue
+
+            # look backward for range marker, e.g. [1]-*[3]*
+            if is_expansion_string(_strings_before(rtag)):
+                previous_rtag = _previous_ref(rtag)
+                surface_num_range = _get_surface_range(_text(previous_rtag).strip(), surface_span)
+                # if the surface number range is reasonable (range < 20, in order), EXPAND
+                if surface_num_range:
+                    # delete previous ref tag and anything in between (i.e. delete "-" and extra spaces)
+                    _clear_strings_before(rtag)
+                    previous_rtag = _previous_ref(rtag)
+                    previous_rtag_ref_id = normalize_grobid_id(previous_rtag.get('target'))
+                    _decompose(previous_rtag)
+
+                    # replace this ref tag with the full range expansion, e.g. [3] (#b2 -> BID1 BID2)
+                    id_range = _create_ref_id_range(previous_rtag_ref_id, rtag_ref_id)
+                    surface_range = _create_surface_range(surface_num_range[0], surface_num_range[1])
+                    replace_string = ''
+                    for range_ref_id, range_surface_form in zip(id_range, surface_range):
+                        # only replace if ref id is in bibliography, else add none
+                        cite_key = tokgen.next()
+                        cite_map[cite_key] = (range_ref_id if range_ref_id in bibs else None, range_surface_form)
+                        replace_string += cite_key + ' '
+                    _replace_with_text(rtag, f" {replace_string} ")
+                # ELSE do not expand backwards and replace previous and current rtag with appropriate ref id
+                else:
+                    previous_rtag_ref_id = normalize_grobid_id(previous_rtag.get('target'))
+                    previous_rtag_surface = _text(previous_rtag).strip()
+                    cite_key = tokgen.next()
+                    _replace_with_text(previous_rtag, f" {cite_key} ")
+                    cite_map[cite_key] = (previous_rtag_ref_id, previous_rtag_surface)
+
+                    cite_key = tokgen.next()
+                    _replace_with_text(rtag, f" {cite_key} ")
+                    cite_map[cite_key] = (rtag_ref_id, surface_span)
+            # look forward for range marker, e.g. *[1]*-[3]: the range is expanded at its second value
+            elif not is_expansion_string(rtag.tail or ''):
+                cite_key = tokgen.next()
+                _replace_with_text(rtag, f" {cite_key} ")
+                cite_map[cite_key] = (rtag_ref_id, surface_span)
+        except AttributeError:
+            continue
+
+    return cite_map
+
+
+def process_citations_as_text(rtags: List[etree._Element]) -> Dict:
+    """
+    Replace all citations in paragraph with their surface form, without cite spans
+    :param rtags: refs of the paragraph
+    :return:
+    """
+    for rtag in rtags:
+        _replace_with_text(rtag, f" {_text(rtag).strip()} ")
+    return dict()
+
+
+def process_paragraph(
+        para_el: etree._Element,
+        section_names: List[Tuple],
+        bib_dict: Optional[Dict],
+        ref_dict: Dict,
+        bracket: bool
+) -> Dict:
+    """
+    Process one paragraph
+    :param para_el:
+    :param section_names:
+    :param bib_dict: bibliography entries, None to leave citations as text
+    :param ref_dict:
+    :param bracket: if bracket style, expand and clean up citations
+    :return:
+    """
+    # return empty paragraph if no text
+    if not _text(para_el):
+        return {
+            'text': "",
+            'cite_spans': [],
+            'ref_spans': [],
+            'eq_spans': [],
+            'section': section_names
+        }
+
+    # a single walk of the paragraph, the refs removed by each step are left out of the next one
+    formulas, rtags = _find_formulas_and_refs(para_el)
+    process_formulas_in_paragraph(para_el, formulas)
+    rtags = [rtag for rtag in rtags if _is_descendant(rtag, para_el)] if formulas else rtags
+    ref_map = process_references_in_paragraph(para_el, ref_dict, rtags)
+    rtags = [rtag for rtag in rtags if _is_descendant(rtag, para_el)]
+    if bib_dict is None:
+        cite_map = process_citations_as_text(rtags)
+    else:
+        cite_map = process_citations_in_paragraph(para_el, bib_dict, bracket, rtags)
+
+    return paragraph_from_tokens(_text(para_el), cite_map, ref_map, section_names)
+
+
+def extract_abstract(root: etree._Element, bib_dict: Dict, ref_dict: Dict, cleanup_bracket: bool) -> List[Dict]:
+    """
+    Parse abstract
+    :param root:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    abstract = _find(root, 'abstract')
+    if abstract is None:
+        return []
+    abstract_text = extract_abstract_from_element(abstract, bib_dict, ref_dict, cleanup_bracket)
+    _decompose(abstract)
+    return abstract_text
+
+
+def extract_abstract_from_element(
+        abstract: etree._Element,
+        bib_dict: Dict,
+        ref_dict: Dict,
+        cleanup_bracket: bool
+) -> List[Dict]:
+    """
+    Parse the paragraphs of an abstract element
+    :param abstract:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    abstract_text = []
+    section = [(None, "Abstract")]
+    # process all divs
+    if _find(abstract, 'div') is not None:
+        for div in _find_all(abstract, 'div'):
+            if _text(div):
+                if _find(div, 'p') is not None:
+                    for para in _find_all(div, 'p'):
+                        if _text(para):
+                            abstract_text.append(process_paragraph(para, section, bib_dict, ref_dict, cleanup_bracket))
+                else:
+                    abstract_text.append(process_paragraph(div, section, bib_dict, ref_dict, cleanup_bracket))
+    # process all paragraphs
+    elif _find(abstract, 'p') is not None:
+        for para in _find_all(abstract, 'p'):
+            if _text(para):
+                abstract_text.append(process_paragraph(para, section, bib_dict, ref_dict, cleanup_bracket))
+    # else just try to get the text
+    elif _text(abstract):
+        abstract_text.append(process_paragraph(abstract, section, bib_dict, ref_dict, cleanup_bracket))
+    return abstract_text
+
+
+def extract_body_text_from_div(
+        div: etree._Element,
+        sections: List[Tuple],
+        bib_dict: Dict,
+        ref_dict: Dict,
+        cleanup_bracket: bool
+) -> List[Dict]:
+    """
+    Parse body text from a div
+    :param div:
+    :param sections:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    chunks = []
+    # check if nested divs; recursively process
+    if _find(div, 'div') is not None:
+        for subdiv in _find_all(div, 'div'):
+            chunks += extract_body_text_from_subdiv(subdiv, sections, bib_dict, ref_dict, cleanup_bracket)
+
+    # keep divs with no tags, like outer headings
+    if _contents_length(div) == 1 and sections != [] and _text(div) == sections[-1][1]:
+        chunks.append({
+            'text': '',
+            'cite_spans': [],
+            'ref_spans': [],
+            'eq_spans': [],
+            'section': sections[-1][1],
+            'sec_num': sections[-1][0],
+        })
+
+    # process tags individuals
+    for tag in list(div):
+        chunk = extract_body_text_from_tag(tag, sections, bib_dict, ref_dict, cleanup_bracket)
+        if chunk is not None:
+            chunks.append(chunk)
+
+    return chunks
+
+
+def extract_body_text_from_subdiv(
+        subdiv: etree._Element,
+        sections: List[Tuple],
+        bib_dict: Dict,
+        ref_dict: Dict,
+        cleanup_bracket: bool
+) -> List[Dict]:
+    """
+    Parse body text from a div nested in the one of `sections`, adding its head to the sections
+    :param subdiv:
+    :param sections:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    head = _find(subdiv, 'head')
+    # no header, process with same section list
+    if head is None:
+        return extract_body_text_from_div(subdiv, sections, bib_dict, ref_dict, cleanup_bracket)
+
+    # has header, add to section list and process
+    chunks = extract_body_text_from_div(
+        subdiv, sections + [(head.get('n', None), _text(head).strip())], bib_dict, ref_dict, cleanup_bracket
+    )
+    # looked up again, as tei_to_json does
+    _decompose(_find(subdiv, 'head'))
+    return chunks
+
+
+def extract_body_text_from_tag(
+        tag: etree._Element,
+        sections: List[Tuple],
+        bib_dict: Dict,
+        ref_dict: Dict,
+        cleanup_bracket: bool
+) -> Optional[Dict]:
+    """
+    Parse a child of a div: paragraph or formula, None for other tags
+    :param tag:
+    :param sections:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    tag_name = _local_name(tag)
+    if tag_name == 'p':
+        if _text(tag):
+            return process_paragraph(tag, sections, bib_dict, ref_dict, cleanup_bracket)
+    elif tag_name == 'formula':
+        label_el = _find(tag, 'label')
+        if label_el is None:
+            # a formula without label is processed as a paragraph
+            if _text(tag):
+                return process_paragraph(tag, sections, bib_dict, ref_dict, cleanup_bracket)
+            return None
+        # e.g. <formula xml:id="formula_0">Y = W T X.<label>(1)</label></formula>
+        label = _text(label_el)
+        _decompose(label_el)
+        return {
+            'text': 'EQUATION',
+            'cite_spans': [],
+            'ref_spans': [],
+            'eq_spans': [
+                {
+                    "start": 0,
+                    "end": 8,
+                    "text": "EQUATION",
+                    "ref_id": "EQREF",
+                    "raw_str": _text(tag),
+                    "eq_num": label
+                }
+            ],
+            'section': sections
+        }
+    return None
+
+
+def extract_body_text(root: etree._Element, bib_dict: Dict, ref_dict: Dict, cleanup_bracket: bool) -> List[Dict]:
+    """
+    Parse body text
+    :param root:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    body = _find(root, 'body')
+    if body is None:
+        return []
+    body_text = extract_body_text_from_div(body, [], bib_dict, ref_dict, cleanup_bracket)
+    _decompose(body)
+    return body_text
+
+
+def extract_back_matter(root: etree._Element, bib_dict: Dict, ref_dict: Dict, cleanup_bracket: bool) -> List[Dict]:
+    """
+    Parse back matter
+    :param root:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    back_text = []
+    back = _find(root, 'back')
+    if back is None:
+        return back_text
+
+    for div in _find_all(back, 'div'):
+        back_text += extract_back_matter_from_div(div, bib_dict, ref_dict, cleanup_bracket)
+    _decompose(back)
+    return back_text
+
+
+def extract_back_matter_from_div(div: etree._Element, bib_dict: Dict, ref_dict: Dict, cleanup_bracket: bool) -> List[Dict]:
+    """
+    Parse the divs nested in a div of the back matter, one paragraph each
+    :param div:
+    :param bib_dict:
+    :param ref_dict:
+    :param cleanup_bracket:
+    :return:
+    """
+    back_text = []
+    section_type = div.get('type') or ''
+    for child_div in _find_all(div, 'div'):
+        head = _find(child_div, 'head')
+        if head is not None:
+            section_title = _text(head).strip()
+            section_num = head.get('n', None)
+            _decompose(head)
+        else:
+            section_title = section_type
+            section_num = None
+        if _text(child_div):
+            back_text.append(process_paragraph(
+                child_div, [(section_num, section_title)], bib_dict, ref_dict, cleanup_bracket
+            ))
+    return back_text
+
+
+def parse_tei(tei: Union[str, bytes]) -> etree._Element:
+    """
+    Parse TEI XML, given as text or bytes
+    :param tei:
+    :return:
+    """
+    if isinstance(tei, str):
+        tei = tei.encode('utf-8')
+    root = etree.fromstring(tei, PARSER)
+    if root is None:
+        raise ValueError("Empty TEI XML")
+
+    for el in root.iter():
+        collapse_whitespace(el)
+    return root
+
+
+def collapse_whitespace(el: etree._Element):
+    """
+    Collapse the strings made of whitespace only of the element (its text and the tails of its children)
+    to a newline or a space, as BeautifulSoup does
+    :param el:
+    :return:
+    """
+    if el.text and not el.text.strip(ASCII_SPACES):
+        el.text = '\n' if '\n' in el.text else ' '
+    for child in el:
+        if child.tail and not child.tail.strip(ASCII_SPACES):
+            child.tail = '\n' if '\n' in child.tail else ' '
+
+
+def convert_tei_xml_to_s2orc_json(
+        tei: Union[str, bytes],
+        paper_id: str,
+        pdf_hash: str,
+        link_citations: bool = True
+) -> Paper:
+    """
+    Convert Grobid TEI XML to S2ORC json format, same as tei_to_json.convert_tei_xml_soup_to_s2orc_json
+    :param tei: TEI XML
+    :param paper_id: name of file
+    :param pdf_hash: hash of PDF
+    :param link_citations: parse the bibliography and link citations to it, else citations are left as text
+    :return:
+    """
+    root = parse_tei(tei)
+
+    # extract metadata
+    metadata = extract_paper_metadata(_find(root, 'fileDesc'))
+    # clean metadata authors (remove dupes etc)
+    metadata['authors'] = _clean_empty_and_duplicate_authors_from_grobid_parse(metadata['authors'])
+
+    # parse bibliography entries (removes empty bib entries)
+    if link_citations:
+        biblio_entries = parse_bibliography(root)
+        bibkey_map = {
+            normalize_grobid_id(bib['ref_id']): bib for bib in biblio_entries
+        }
+    else:
+        bibliography = _find(root, 'listBibl')
+        if bibliography is not None:
+            _decompose(bibliography)
+        bibkey_map = None
+
+    # extract figure and table captions
+    refkey_map = extract_figures_and_tables(root)
+
+    # get bracket style
+    is_bracket_style = check_if_citations_are_bracket_style(root) if link_citations else False
+
+    # substitute all note tags with p tags
+    sub_all_note_tags(root)
+
+    abstract_entries = extract_abstract(root, bibkey_map, refkey_map, is_bracket_style)
+    body_entries = extract_body_text(root, bibkey_map, refkey_map, is_bracket_style)
+    # acks, author statements, competing interests, abbrevs etc
+    back_matter = extract_back_matter(root, bibkey_map, refkey_map, is_bracket_style)
+
+    return Paper(
+        paper_id=paper_id,
+        pdf_hash=pdf_hash,
+        metadata=metadata,
+        abstract=abstract_entries,
+        body_text=body_entries,
+        back_matter=back_matter,
+        bib_entries=bibkey_map if bibkey_map is not None else dict(),
+        ref_entries=refkey_map
+    )
+
+
+def convert_tei_xml_file_to_s2orc_json(tei_file: str, pdf_hash: str = "", link_citations: bool = True) -> Paper:
+    """
+    Convert a TEI XML file to S2ORC JSON
+    :param tei_file:
+    :param pdf_hash:
+    :param link_citations:
+    :return:
+    """
+    if not os.path.exists(tei_file):
+        raise FileNotFoundError("Input TEI XML file doesn't exist")
+    paper_id = tei_file.split('/')[-1].split('.')[0]
+    with open(tei_file, "rb") as f:
+        return convert_tei_xml_to_s2orc_json(f.read(), paper_id, pdf_hash, link_citations)
@@ -0,0 +1,370 @@
+"""
+Streaming Grobid TEI XML to S2ORC JSON, for theses and long reports whose whole tree takes too much memory.
+
+The TEI is read twice with `lxml.etree.iterparse` and each element at the top of the body and back matter (usually a
+section `<div>`) is released once read, so the peak memory is bounded by the largest of them, not by the document:
+- `scan_tei` collects what paragraphs refer to: metadata, bibliography, figures and tables, citation style
+- `iter_tei_paragraphs` then converts the paragraphs section by section
+
+The paragraphs go through the functions of tei_to_json_lxml and the output is the same as the one of the other
+engines for the same TEI, quirks included (e.g. a figure without head is numbered by the label following the next
+head of the document, wherever it is).
+"""
+import copy
+import io
+import os
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from lxml import etree
+
+from doc2json.s2orc import Paper
+from doc2json.grobid2json.tei_to_json import normalize_grobid_id
+from doc2json.grobid2json.tei_to_json_lxml import XML_ID, _any_ns, _decompose, _find, _find_all, _find_next, \
+    _local_name, _text, collapse_whitespace, extract_abstract_from_element, extract_back_matter_from_div, \
+    extract_body_text_from_subdiv, extract_body_text_from_tag, extract_paper_metadata, figure_entry, \
+    is_bracket_style, parse_list_bibl, sub_all_note_tags, sub_note_tag, table_entry
+from doc2json.utils.citation_util import _clean_empty_and_duplicate_authors_from_grobid_parse
+
+# elements whose children are released once read
+CONTAINER_TAGS = {'TEI', 'teiHeader', 'text', 'body', 'back'}
+
+TeiSource = Union[str, bytes]
+
+
+class TeiIndex(NamedTuple):
+    metadata: Dict
+    # None when citations are not linked to the bibliography
+    bib_entries: Optional[Dict[str, Dict]]
+    ref_entries: Dict[str, Dict]
+    is_bracket_style: bool
+    # by order of figure in the document, whether the conversion removes it before reading the paragraphs
+    decomposed_figures: List[bool]
+
+
+def _iterparse(source: TeiSource) -> etree.iterparse:
+    """
+    :param source: path of a TEI file, or TEI XML as bytes
+    """
+    return etree.iterparse(
+        io.BytesIO(source) if isinstance(source, bytes) else source, events=('end',),
+        recover=True, remove_comments=True, remove_pis=True, encoding='utf-8'
+    )
+
+
+def _release(el: etree._Element):
+    """ Free an element read by iterparse, and the siblings released before it """
+    el.clear()
+    parent = el.getparent()
+    if parent is not None:
+        while el.getprevious() is not None:
+            del parent[0]
+
+
+class _TeiScanner(object):
+    """
+    First pass of the streaming conversion. Figures are looked up in the same order as
+    tei_to_json_lxml.extract_figures_and_tables, but the head and label of a figure may only be read later in the
+    document: the figure then waits for them.
+
+    iterparse reads ahead, the tree may hold elements after the one of the current event, not completely read yet.
+    Lookups are limited to the element of the event.
+    """
+
+    def __init__(self, link_citations: bool = True):
+        self.link_citations = link_citations
+        self.metadata = None
+        self.has_bibliography = False
+        self.bibliography = None
+        self.body = None
+        self.figures = dict()
+        self.decomposed = []
+        self.ref_entries = []
+        self.errors = []
+        # [ordinal, figure, 'head' or 'label'] of the figures waiting for the head or label following them
+        self.waiting = []
+        self.cite_strings = []
+        # (ordinals of the figures holding a head, [(ordinal of the figure holding it or None, string)]) of the
+        # divs which have a head or not depending on figures still waiting
+        self.waiting_cite_strings = []
+
+    def scan(self, source: TeiSource) -> TeiIndex:
+        for _, el in _iterparse(source):
+            collapse_whitespace(el)
+            name = _local_name(el)
+            parent = el.getparent()
+            if name == 'fileDesc' and self.metadata is None:
+                self.metadata = extract_paper_metadata(el)
+            elif name == 'listBibl' and not self.has_bibliography:
+                self.has_bibliography = True
+                if self.link_citations:
+                    self.bibliography = parse_list_bibl(el)
+            elif name == 'figure':
+                self.on_figure(el)
+            elif name == 'head' and not self.in_bibliography(el):
+                self.on_head(el)
+            elif name == 'label' and not self.in_bibliography(el):
+                self.on_label(el)
+            elif name == 'body' and self.body is None:
+                self.body = el
+
+            parent_name = _local_name(parent) if parent is not None else None
+            if parent_name == 'body' and self.body in (None, parent):
+                self.body = parent
+                if self.link_citations:
+                    self.scan_body_element(el)
+            if parent_name in CONTAINER_TAGS:
+                _release(el)
+                self.figures.clear()
+
+        return self.index()
+
+    def in_bibliography(self, el: etree._Element) -> bool:
+        # the bibliography is removed before looking for the head and label of figures
+        return not self.has_bibliography and next(el.iterancestors(_any_ns('listBibl')), None) is not None
+
+    def on_figure(self, fig: etree._Element):
+        ordinal = len(self.decomposed)
+        self.figures[fig] = ordinal
+        self.decomposed.append(True)
+        if not fig.get(XML_ID):
+            return
+        try:
+            if fig.get('type') == 'table':
+                self.ref_entries.append((ordinal, normalize_grobid_id(fig.get(XML_ID)), table_entry(fig)))
+                return
+            head = _find(fig, 'head')
+        except AttributeError:
+            self.decomposed[ordinal] = False
+            return
+        except Exception as e:
+            self.errors.append((ordinal, e))
+            return
+        if head is None:
+            self.decomposed[ordinal] = None
+            # copied, the figure itself is released with the section holding it
+            self.waiting.append([ordinal, copy.deepcopy(fig), 'head'])
+        else:
+            self.on_figure_head(ordinal, fig, head, fig)
+
+    def on_figure_head(self, ordinal: int, fig: etree._Element, head: etree._Element, read: etree._Element):
+        """
+        :param read: element of the current event, holding the head
+        """
+        label = _find_next(head, 'label')
+        if label is not None and read not in label.iterancestors():
+            label = None
+        if label is None:
+            self.decomposed[ordinal] = None
+            self.waiting.append([ordinal, copy.deepcopy(fig), 'label'])
+        else:
+            self.on_figure_label(ordinal, fig, label)
+
+    def on_figure_label(self, ordinal: int, fig: etree._Element, label: etree._Element):
+        self.decomposed[ordinal] = True
+        try:
+            self.ref_entries.append((ordinal, normalize_grobid_id(fig.get(XML_ID)), figure_entry(fig, label)))
+        except AttributeError:
+            self.decomposed[ordinal] = False
+        except Exception as e:
+            self.errors.append((ordinal, e))
+
+    def on_head(self, head: etree._Element):
+        waiting_head = [waiting for waiting in self.waiting if waiting[2] == 'head']
+        self.waiting = [waiting for waiting in self.waiting if waiting[2] != 'head']
+        for ordinal, fig, _ in waiting_head:
+            self.on_figure_head(ordinal, fig, head, head)
+
+    def on_label(self, label: etree._Element):
+        waiting_label = [waiting for waiting in self.waiting if waiting[2] == 'label']
+        self.waiting = [waiting for waiting in self.waiting if waiting[2] != 'label']
+        for ordinal, fig, _ in waiting_label:
+            self.on_figure_label(ordinal, fig, label)
+
+    def figure_of(self, el: etree._Element) -> Optional[int]:
+        """ Ordinal of the figure holding the element, None if there is none """
+        fig = next(el.iterancestors(_any_ns('figure')), None)
+        return None if fig is None else self.figures[fig]
+
+    def scan_body_element(self, el: etree._Element):
+        """ Citation strings of the divs without head, as tei_to_json_lxml.check_if_citations_are_bracket_style """
+        for div in ([el] if _local_name(el) == 'div' else []) + _find_all(el, 'div'):
+            head_figures = [self.figure_of(head) for head in div.iterdescendants(_any_ns('head'))]
+            # a head outside of the removed figures
+            if any(ordinal is None or self.decomposed[ordinal] is False for ordinal in head_figures):
+                continue
+            cite_strings = []
+            for rtag in _find_all(div, 'ref'):
+                ordinal = self.figure_of(rtag)
+                if rtag.get('type') == 'bibr' and (ordinal is None or not self.decomposed[ordinal]):
+                    cite_strings.append((ordinal if ordinal is not None and self.decomposed[ordinal] is None
+                                         else None, _text(rtag).strip()))
+            waiting_figures = [ordinal for ordinal in head_figures if self.decomposed[ordinal] is None]
+            if waiting_figures or any(ordinal is not None for ordinal, _ in cite_strings):
+                self.waiting_cite_strings.append((waiting_figures, cite_strings))
+            else:
+                self.cite_strings += [cite_str for _, cite_str in cite_strings]
+
+    def index(self) -> TeiIndex:
+        if self.metadata is None:
+            raise AttributeError("No fileDesc in the TEI")
+        for ordinal, fig, waiting_for in self.waiting:
+            if waiting_for == 'head':
+                # no head after the figure, kept in the document
+                self.decomposed[ordinal] = False
+            else:
+                self.errors.append((ordinal, TypeError("'NoneType' object is not iterable")))
+        if self.errors:
+            raise min(self.errors, key=lambda error: error[0])[1]
+
+        ref_entries = dict()
+        for _, ref_id, entry in sorted(self.ref_entries, key=lambda ref_entry: ref_entry[0]):
+            ref_entries[ref_id] = entry
+
+        cite_strings = list(self.cite_strings)
+        for head_figures, div_cite_strings in self.waiting_cite_strings:
+            if all(self.decomposed[ordinal] for ordinal in head_figures):
+                cite_strings += [cite_str for ordinal, cite_str in div_cite_strings
+                                 if ordinal is None or not self.decomposed[ordinal]]
+
+        metadata = self.metadata
+        # clean metadata authors (remove dupes etc)
+        metadata['authors'] = _clean_empty_and_duplicate_authors_from_grobid_parse(metadata['authors'])
+        if not self.link_citations:
+            return TeiIndex(
+                metadata=metadata,
+                bib_entries=None,
+                ref_entries=ref_entries,
+                is_bracket_style=False,
+                decomposed_figures=self.decomposed
+            )
+        return TeiIndex(
+            metadata=metadata,
+            bib_entries={normalize_grobid_id(bib['ref_id']): bib for bib in self.bibliography or []},
+            ref_entries=ref_entries,
+            is_bracket_style=is_bracket_style(cite_strings),
+            decomposed_figures=self.decomposed
+        )
+
+
+def scan_tei(source: TeiSource, link_citations: bool = True) -> TeiIndex:
+    """
+    First pass: everything but the paragraphs
+    :param source: path of a TEI file, or TEI XML as bytes
+    :param link_citations: parse the bibliography and the citation style, else citations are left as text
+    :return:
+    """
+    return _TeiScanner(link_citations).scan(source)
+
+
+def iter_tei_paragraphs(source: TeiSource, index: TeiIndex) -> Iterator[Tuple[str, Dict]]:
+    """
+    Second pass: the paragraphs, with the part of the paper they belong to ('abstract', 'body_text' or
+    'back_matter'). Paragraphs of the body outside of any div come after the others, as with the other engines.
+    :param source: path of a TEI file, or TEI XML as bytes
+    :param index: first pass over the same TEI
+    :return:
+    """
+    bib_dict, ref_dict, bracket = index.bib_entries, index.ref_entries, index.is_bracket_style
+    # by parent, elements removed once their parent is read, their tail is only known then
+    to_decompose = dict()
+    figures = 0
+    has_bibliography = has_abstract = False
+    body = back = None
+    body_paragraphs = []
+
+    for _, el in _iterparse(source):
+        collapse_whitespace(el)
+        for child in to_decompose.pop(el, []):
+            if child.getparent() is el:
+                _decompose(child)
+        name = _local_name(el)
+        parent = el.getparent()
+        parent_name = _local_name(parent) if parent is not None else None
+
+        if name == 'figure':
+            if index.decomposed_figures[figures]:
+                to_decompose.setdefault(parent, []).append(el)
+            figures += 1
+        elif name == 'listBibl' and not has_bibliography:
+            has_bibliography = True
+            to_decompose.setdefault(parent, []).append(el)
+        elif name == 'abstract' and not has_abstract:
+            has_abstract = True
+            sub_all_note_tags(el)
+            for paragraph in extract_abstract_from_element(el, bib_dict, ref_dict, bracket):
+                yield 'abstract', paragraph
+            el.clear()
+        elif name == 'body' and body in (None, el):
+            body = el
+            for paragraph in body_paragraphs:
+                yield 'body_text', paragraph
+            body_paragraphs = []
+
+        if parent_name == 'body' and body in (None, parent):
+            body = parent
+            if name == 'note':
+                el = sub_note_tag(el)
+            sub_all_note_tags(el)
+            for div in ([el] if name == 'div' else []) + _find_all(el, 'div'):
+                for paragraph in extract_body_text_from_subdiv(div, [], bib_dict, ref_dict, bracket):
+                    yield 'body_text', paragraph
+            paragraph = extract_body_text_from_tag(el, [], bib_dict, ref_dict, bracket)
+            if paragraph is not None:
+                body_paragraphs.append(paragraph)
+        elif parent_name == 'back' and back in (None, parent):
+            back = parent
+            sub_all_note_tags(el)
+            for div in ([el] if name == 'div' else []) + _find_all(el, 'div'):
+                for paragraph in extract_back_matter_from_div(div, bib_dict, ref_dict, bracket):
+                    yield 'back_matter', paragraph
+        if parent_name in CONTAINER_TAGS:
+            _release(el)
+
+
+def convert_tei_xml_stream_to_s2orc_json(
+        source: TeiSource,
+        paper_id: str,
+        pdf_hash: str,
+        link_citations: bool = True
+) -> Paper:
+    """
+    Convert Grobid TEI XML to S2ORC json format, same as tei_to_json_lxml.convert_tei_xml_to_s2orc_json
+    :param source: path of a TEI file, or TEI XML as bytes
+    :param paper_id: name of file
+    :param pdf_hash: hash of PDF
+    :param link_citations: parse the bibliography and link citations to it, else citations are left as text
+    :return:
+    """
+    index = scan_tei(source, link_citations)
+    parts = {'abstract': [], 'body_text': [], 'back_matter': []}
+    for part, paragraph in iter_tei_paragraphs(source, index):
+        parts[part].append(paragraph)
+
+    return Paper(
+        paper_id=paper_id,
+        pdf_hash=pdf_hash,
+        metadata=index.metadata,
+        abstract=parts['abstract'],
+        body_text=parts['body_text'],
+        back_matter=parts['back_matter'],
+        bib_entries=index.bib_entries if index.bib_entries is not None else dict(),
+        ref_entries=index.ref_entries
+    )
+
+
+def convert_tei_xml_file_stream_to_s2orc_json(
+        tei_file: str,
+        pdf_hash: str = "",
+        link_citations: bool = True
+) -> Paper:
+    """
+    Convert a TEI XML file to S2ORC JSON, streaming it from disk
+    :param tei_file:
+    :param pdf_hash:
+    :param link_citations:
+    :return:
+    """
+    if not os.path.exists(tei_file):
+        raise FileNotFoundError("Input TEI XML file doesn't exist")
+    paper_id = tei_file.split('/')[-1].split('.')[0]
+    return convert_tei_xml_stream_to_s2orc_json(tei_file, paper_id, pdf_hash, link_citations)
@@ -7,7 +7,7 @@ from typing import List, Dict, Tuple, Optional
 import copy
 import latex2mathml.converter
 
-from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient, get_grobid_client
 from doc2json.utils.grobid_util import parse_bib_entry, get_author_data_from_grobid_xml
 from doc2json.s2orc import Paper, Paragraph
 
@@ -1278,8 +1278,8 @@ def convert_xml_to_s2orc(
     :param grobid_config:
     :return:
     """
-    # create grobid client
-    client = GrobidClient(grobid_config)
+    # shared grobid client, bibliography entries are sent over pooled connections
+    client = get_grobid_client(grobid_config)
 
     # TODO: not sure why but have to run twice
     decompose_tags_before_title(sp)
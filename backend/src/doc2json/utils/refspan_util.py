@@ -1,3 +1,8 @@
+"""
+Span replacement of the upstream s2orc-doc2json converters. No converter of this repo calls it anymore:
+grobid2json replaces the cite and ref tokens of a paragraph in tei_to_json.paragraph_from_tokens, in the scan
+that finds them, see scripts/refspan_benchmark.py for its timing against the baseline.
+"""
 from typing import List, Tuple
 
 
@@ -12,7 +17,9 @@ def replace_refspans(
     For each span within the full string, replace that span with new text
     :param spans_to_replace: list of tuples of form (start_ind, end_ind, span_text, new_substring)
     :param full_string:
-    :param pre_padding:
+    :param pre_padding: with pre or post padding and more than one span kept, spans are applied in series, which
+        is quadratic in the number of spans: no caller pads, and the upstream shifts of padded spans only hold in
+        series
     :param post_padding:
     :param btwn_padding:
     :return:
@@ -27,50 +34,53 @@ def replace_refspans(
     # sort by start index
     spans_to_replace.sort(key=lambda x: x[0])
 
-    # form strings for each span group
-    for i, entry in enumerate(spans_to_replace):
-        start, end, span, new_string = entry
-
+    # form strings for each span group, in one pass: each span is padded once per previous span and shifted by
+    # the shifts of the previous spans
+    padding_shift = len(pre_padding) + len(post_padding)
+    kept = []
+    shift = 0
+    # lowest shift so far, spans shifted to a non positive end are empties
+    min_shift = 0
+    # end of the last span kept and number of spans kept ending there
+    last_end = None
+    abutting = 0
+    for start, end, span, new_string in spans_to_replace:
         # skip empties
-        if end <= 0:
+        if end + min_shift <= 0:
             continue
-
-        # compute shift amount
-        shift_amount = len(new_string) - len(span) + len(pre_padding) + len(post_padding)
-
-        # shift remaining appropriately
-        for ind in range(i + 1, len(spans_to_replace)):
-            next_start, next_end, next_span, next_string = spans_to_replace[ind]
-            # skip empties
-            if next_end <= 0:
+        if last_end is not None:
+            # if overlap between ref span and a previous reference span, remove from replacement
+            if start < last_end:
                 continue
-            # if overlap between ref span and current ref span, remove from replacement
-            if next_start < end:
-                next_start = 0
-                next_end = 0
-                next_string = ""
-            # if ref span abuts previous reference span
-            elif next_start == end:
-                next_start += shift_amount
-                next_end += shift_amount
-                next_string = btwn_padding + pre_padding + next_string + post_padding
-            # if ref span starts after, shift starts and ends
-            elif next_start > end:
-                next_start += shift_amount
-                next_end += shift_amount
-                next_string = pre_padding + next_string + post_padding
-            # save adjusted span
-            spans_to_replace[ind] = (next_start, next_end, next_span, next_string)
-
-    spans_to_replace = [entry for entry in spans_to_replace if entry[1] > 0]
-    spans_to_replace.sort(key=lambda x: x[0])
-
-    # apply shifts in series
-    for start, end, span, new_string in spans_to_replace:
-        assert full_string[start:end] == span
-        full_string = full_string[:start] + new_string + full_string[end:]
-
-    return full_string
+            # padded by every previous span, between padding for the ones it abuts
+            abutted = abutting if start == last_end else 0
+            new_string = (btwn_padding + pre_padding) * abutted + pre_padding * (len(kept) - abutted) + \
+                new_string + post_padding * len(kept)
+        kept.append((start, end, span, new_string, shift))
+        shift += len(new_string) - len(span) + padding_shift
+        min_shift = min(min_shift, shift)
+        if end == last_end:
+            abutting += 1
+        else:
+            last_end = end
+            abutting = 1
+
+    if padding_shift and len(kept) > 1:
+        # the shifts count paddings which the new substrings don't hold, apply them in series (quadratic)
+        for start, end, span, new_string, shift in kept:
+            assert full_string[start + shift:end + shift] == span
+            full_string = full_string[:start + shift] + new_string + full_string[end + shift:]
+        return full_string
+
+    # build the new string from pieces
+    pieces = []
+    position = 0
+    for start, end, span, new_string, _ in kept:
+        pieces.append(full_string[position:start])
+        pieces.append(new_string)
+        position = end
+    pieces.append(full_string[position:])
+    return ''.join(pieces)
 
 
 def sub_spans_and_update_indices(
@@ -96,20 +106,14 @@ def sub_spans_and_update_indices(
     # sort by start index
     spans_to_replace.sort(key=lambda x: x[0])
 
-    # compute offsets for each span
-    new_spans = [[start, end, token, surface, 0] for start, end, token, surface in spans_to_replace]
-    for i, entry in enumerate(spans_to_replace):
-        start, end, token, surface = entry
-        new_end = start + len(surface)
-        offset = new_end - end
-        new_spans[i][1] += offset
-        for new_span_entry in new_spans[i+1:]:
-            new_span_entry[4] += offset
+    # compute offsets for each span, a running sum of the length changes of the previous spans
+    new_spans = []
+    offset = 0
+    for start, end, token, surface in spans_to_replace:
+        new_spans.append((start + offset, start + offset + len(surface), token, surface))
+        offset += len(surface) - (end - start)
 
-    # generate new text and create final spans
+    # generate new text
     new_text = replace_refspans(spans_to_replace, full_string, btwn_padding="")
-    new_spans = [(start + offset, end + offset, token, surface) for start, end, token, surface, offset in new_spans]
 
     return new_text, new_spans
-
-
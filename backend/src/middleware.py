@@ -12,11 +12,12 @@ from database.db import DynamoDBGateway
 from database.users import (DiscordUsersGateway, GuestUsersGateway,
                             UserDoesNotExistException)
 from fastapi import BackgroundTasks, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from utils.constants import (CONTENT_ENDPOINTS, DB_FUNCTION_INVOCATIONS,
                              DISCORD_WHITELIST_ROLENAME, ENVIRONMENT,
-                             HIPPOAI_DISCORD_SERVER_ID, LATEST_COMMIT_ID,
-                             UNAUTHENTICATED_ENDPOINTS)
+                             HIPPOAI_DISCORD_SERVER_ID, LAMBDA_EVENTS_PATH,
+                             LATEST_COMMIT_ID, UNAUTHENTICATED_ENDPOINTS)
 
 
 async def set_body(request: Request, body: bytes):
@@ -34,7 +35,8 @@ async def get_body(request: Request) -> bytes:
 
 
 async def get_id_and_email_from_token(auth_header: str):
-    response = requests.get(
+    response = await run_in_threadpool(
+        requests.get,
         "https://discord.com/api/users/@me",
         headers={'Authorization': auth_header},
         allow_redirects=True)
@@ -54,10 +56,11 @@ async def verify_discord_login(auth_header: Union[str,  None]):
         user_discord_id, discord_email = discord_object['id'], discord_object['email']
         discord_users_gateway = DiscordUsersGateway()
         try:
-            user = discord_users_gateway.get_user_by_email(discord_email)
+            user = await run_in_threadpool(discord_users_gateway.get_user_by_email, discord_email)
         except UserDoesNotExistException as e:
             # todo: should we really be creating the user here?
-            user = discord_users_gateway.create_user(
+            user = await run_in_threadpool(
+                discord_users_gateway.create_user,
                 discord_email, user_discord_id, created_at=str(datetime.datetime.utcnow()))
 
         return user.discord_id
@@ -95,7 +98,7 @@ async def verify_login(request: Request, call_next):
     
     guest_users_gateway = GuestUsersGateway()
     try:
-        if (guest_users_gateway.has_remaining_requests(email)):
+        if (await run_in_threadpool(guest_users_gateway.has_remaining_requests, email)):
             print("Guest user verified")
             response = await call_next(request)
         
@@ -103,13 +106,13 @@ async def verify_login(request: Request, call_next):
                 # TODO, the following logic isn't the best way due to following reasons:
                 # 1. if the user has very low latency, his browser might make several
                 #    requests to ask at once, then he ends up only getting one response or none
-                guest_users_gateway.decrement_remaining_trial_requests(email)
+                await run_in_threadpool(guest_users_gateway.decrement_remaining_trial_requests, email)
 
             return response
         else: 
             return JSONResponse(status_code=401, content={"message": "You're out of trial requests. Join us in discord for full access."})
     except UserDoesNotExistException as e:
-        guest_users_gateway.create_user(email)
+        await run_in_threadpool(guest_users_gateway.create_user, email)
 
     return await call_next(request)
         
@@ -117,6 +120,9 @@ async def verify_login(request: Request, call_next):
 async def log_function_invocation_to_dynamo(request: Request, call_next):
     start = datetime.datetime.utcnow()
     body = await get_body(request)
+    if request.url.path == LAMBDA_EVENTS_PATH and isinstance(body, dict):
+        # don't log the secret of the event
+        body = {key: value for key, value in body.items() if key != 'secret'}
 
     email = body.get('email', request.headers.get('Email', None))
 
@@ -1,20 +1,27 @@
-import concurrent.futures
+import asyncio
+import bisect
+import hashlib
+import itertools
 import json
+import re
 import threading
 import time
 from copy import deepcopy
-from queue import Queue
-from typing import (Any, Callable, Dict, Generator, List, Literal, Optional,
-                    Union)
+from typing import (Any, AsyncGenerator, Callable, Dict, Generator, List,
+                    Literal, Optional, Set, Tuple, Union)
 
 import openai
 import tiktoken
 from bs4 import BeautifulSoup
 from langchain.text_splitter import CharacterTextSplitter
 from pydantic import BaseModel
+from retrieval import BM25Index
 from utils import json_utils
-from utils.constants import (ENVIRONMENT, LLM_MAX_TOKENS, MAX_CONTEXTS,
-                             NOT_ENOUGH_INFO_ANSWER)
+from utils.constants import (ASK_REDUCE_MODE, CHUNK_PLAN_BUDGETS,
+                             COMPLETION_TOKENS, ENVIRONMENT, LLM_MAX_TOKENS,
+                             MAX_CONTEXTS, NOT_ENOUGH_INFO_ANSWER,
+                             NOTHING_TO_ADD_ANSWER,
+                             RETRIEVAL_MAX_CONTEXT_TOKENS, RETRIEVAL_TOP_K)
 
 
 def elapsed_time(func):
@@ -29,10 +36,6 @@ def elapsed_time(func):
     return wrapper
 
 
-def string_as_generator(string):
-    yield string
-
-
 class CiteSpan(BaseModel):
     start: int
     end: int
@@ -88,11 +91,23 @@ class Author(BaseModel):
     email: Optional[str]
 
 
+def encode_section_header(sec_num) -> str:
+    return "#" * (sec_num.count(".") + 1) if sec_num and sec_num[-1] != "." else "-"
+
+
+def block_key(kind: str, text_block: TextBlock) -> str:
+    # content based, so keys survive the section filtering done by the frontend
+    digest = hashlib.sha1(
+        f"{text_block.section}\n{text_block.text}".encode()).hexdigest()[:16]
+    return f"{kind}:{digest}"
+
+
 class Paper(BaseModel):
     abstract: str
     title: str
     authors: Optional[List[Author]]
     pdf_parse: PdfParse
+    hash: Optional[str]
 
     def get_sections(self) -> List[str]:
         sections = set()
@@ -170,6 +185,24 @@ class Paper(BaseModel):
 
         self.__dict__.update(filtered_paper.__dict__)
 
+    def select_sections(self, sections: List[Tuple[str, Optional[str]]]) -> 'Paper':
+        """
+        Returns a copy of the paper with only the text blocks whose (section, sec_num) is in `sections`,
+        which is how the frontend section selector sends its selection. The paper itself is left untouched.
+        """
+        selected = {(section, None if sec_num is None else str(sec_num))
+                    for section, sec_num in sections}
+
+        def is_selected(text_block: TextBlock) -> bool:
+            sec_num = None if text_block.sec_num is None else str(text_block.sec_num)
+            return (text_block.section, sec_num) in selected
+
+        return self.copy(update={'pdf_parse': PdfParse(
+            body_text=[block for block in self.pdf_parse.body_text if is_selected(block)],
+            back_matter=[block for block in self.pdf_parse.back_matter if is_selected(block)],
+            ref_entries=self.pdf_parse.ref_entries
+        )})
+
     def format_authors(self) -> str:
         result = []
         for author in self.authors:
@@ -183,47 +216,87 @@ class Paper(BaseModel):
 
         return "\n".join(result)
 
-    def to_text(self) -> str:
+    def format_ref_entry(self, key: str, ref: Union[FigRef, TabRef]) -> str:
+        if ref.type_str == "figure":
+            fig_num = ref.fig_num if ref.fig_num else key.replace(
+                "FIGREF", "")
+            if fig_num == "0":
+                fig_num = ""
+            return f"Figure {fig_num} caption: \"{ref.text}\""
+        table_num = ref.num if ref.num else key.replace("TABREF", "")
+        if table_num == "0":
+            table_num = ""
+        return f"Table {table_num}: {ref.text}\n{html_table_to_markdown(ref.content)}"
+
+    def context_blocks(self) -> List[Tuple[str, str]]:
+        """
+        Returns (key, text) pairs for every text block and figure/table caption of the paper.
+        The keys can be passed to `to_text` to render only a subset of the paper.
+        """
+        blocks = []
+        for kind, text_blocks in [("body_text", self.pdf_parse.body_text), ("back_matter", self.pdf_parse.back_matter)]:
+            for text_block in text_blocks:
+                blocks.append((block_key(kind, text_block),
+                              f"{text_block.section}\n{text_block.text}"))
+        for key, ref in self.pdf_parse.ref_entries.items():
+            blocks.append((key, self.format_ref_entry(key, ref)))
+        return blocks
+
+    def context_units(self, keys: Optional[Set[str]] = None) -> List[Tuple[str, str]]:
+        """
+        Returns the paper as an ordered list of (key, text) units: title, authors, section headers,
+        text blocks and figure/table captions. Text blocks and captions can be filtered by key.
+        """
         sections = set()
-        result = []
-
-        result.append(f"# {self.title}")
+        units = [("title", f"# {self.title}")]
 
         if self.authors:
-            result.append(f"Authors: {self.format_authors()}")
+            units.append(("authors", f"Authors: {self.format_authors()}"))
 
-        def encode_section_header(
-            x): return "#" * (x.count(".") + 1) if x and x[-1] != "." else "-"
+        text_blocks = [("body_text", text_block) for text_block in self.pdf_parse.body_text] + \
+            [("back_matter", text_block)
+             for text_block in self.pdf_parse.back_matter]
 
-        for text_block in self.pdf_parse.body_text + self.pdf_parse.back_matter:
+        for kind, text_block in text_blocks:
+            key = block_key(kind, text_block)
+            if keys is not None and key not in keys:
+                continue
             section = f"{encode_section_header(str(text_block.sec_num))} {text_block.sec_num or ''} {text_block.section}"
             if section not in sections:
-                result.append(f"{section}\n{text_block.text}")
+                units.append((f"section:{section}", section))
                 sections.add(section)
-            else:
-                result[-1] += f"\n{text_block.text}"
+            units.append((key, text_block.text))
 
         figs_and_tables = []
         for key, ref in self.pdf_parse.ref_entries.items():
-            if ref.type_str == "figure":
-                fig_num = ref.fig_num if ref.fig_num else key.replace(
-                    "FIGREF", "")
-                if fig_num == "0":
-                    fig_num = ""
-                figs_and_tables.append(
-                    f"Figure {fig_num} caption: \"{ref.text}\"")
-            elif ref.type_str == "table":
-                table_num = ref.num if ref.num else key.replace("TABREF", "")
-                if table_num == "0":
-                    table_num = ""
-                figs_and_tables.append(
-                    f"Table {table_num}: {ref.text}\n{html_table_to_markdown(ref.content)}")
+            if keys is not None and key not in keys:
+                continue
+            if ref.type_str in ["figure", "table"]:
+                figs_and_tables.append((key, self.format_ref_entry(key, ref)))
 
         if figs_and_tables != []:
-            result.append(f"#### Figures and Tables")
-            result.extend(figs_and_tables)
+            units.append(("figures_and_tables", f"#### Figures and Tables"))
+            units.extend(figs_and_tables)
+
+        return units
+
+    def to_text(self, keys: Optional[Set[str]] = None) -> str:
+        return render_units(self.context_units(keys))
 
-        return '\n\n'.join(result)
+
+def is_text_block_key(key: str) -> bool:
+    return key.startswith("body_text:") or key.startswith("back_matter:")
+
+
+def render_units(units: List[Tuple[str, str]]) -> str:
+    # text blocks are appended to the section (or previous block) they follow
+    result = []
+    for key, text in units:
+        if is_text_block_key(key) and result:
+            result[-1] += f"\n{text}"
+        else:
+            result.append(text)
+    return '\n\n'.join(result)
 
 
 def html_table_to_markdown(html: str) -> str:
@@ -269,6 +342,76 @@ def split_text(text, chunk_size=3500, separator="\n"):
     return texts
 
 
+def pack_boundaries(prefix_sums: List[int], budget: int) -> List[int]:
+    """
+    Greedily group consecutive units into chunks of at most `budget` tokens.
+    Returns the unit indexes where chunks start, plus the total number of units.
+    A unit bigger than the budget gets a chunk of its own.
+    """
+    boundaries = [0]
+    while boundaries[-1] < len(prefix_sums) - 1:
+        start = boundaries[-1]
+        end = bisect.bisect_right(
+            prefix_sums, prefix_sums[start] + budget) - 1
+        boundaries.append(max(end, start + 1))
+    return boundaries
+
+
+class ChunkPlan(BaseModel):
+    """
+    Token counts of the units of a paper (see `Paper.context_units`), computed once at upload so
+    that asking only needs to slice the paper instead of re-tokenizing it.
+    """
+    keys: List[str]
+    token_counts: List[int]
+    prefix_sums: List[int]
+    boundaries: Dict[int, List[int]]
+
+    @classmethod
+    def build(cls, units: List[Tuple[str, str]]) -> 'ChunkPlan':
+        token_counts = [count_tokens(text) for _, text in units]
+        prefix_sums = list(itertools.accumulate(token_counts, initial=0))
+        return cls(
+            keys=[key for key, _ in units],
+            token_counts=token_counts,
+            prefix_sums=prefix_sums,
+            boundaries={budget: pack_boundaries(
+                prefix_sums, budget) for budget in CHUNK_PLAN_BUDGETS}
+        )
+
+    def unit_tokens(self, units: List[Tuple[str, str]]) -> List[int]:
+        counts = dict(zip(self.keys, self.token_counts))
+        return [counts[key] if key in counts else count_tokens(text) for key, text in units]
+
+    def total_tokens(self, units: List[Tuple[str, str]]) -> int:
+        if [key for key, _ in units] == self.keys:
+            return self.prefix_sums[-1]
+        return sum(self.unit_tokens(units))
+
+    def chunk_boundaries(self, units: List[Tuple[str, str]], budget: int) -> List[int]:
+        if [key for key, _ in units] != self.keys:
+            # e.g. a section filtered paper, pack the known counts on the fly
+            prefix_sums = list(itertools.accumulate(
+                self.unit_tokens(units), initial=0))
+            return pack_boundaries(prefix_sums, budget)
+
+        standard_budgets = [b for b in self.boundaries if b <= budget]
+        if standard_budgets and max(standard_budgets) >= budget * 0.9:
+            return self.boundaries[max(standard_budgets)]
+        return pack_boundaries(self.prefix_sums, budget)
+
+    def split(self, units: List[Tuple[str, str]], budget: int) -> List[str]:
+        boundaries = self.chunk_boundaries(units, budget)
+        unit_tokens = self.unit_tokens(units)
+        contexts = []
+        for start, end in zip(boundaries, boundaries[1:]):
+            if end - start == 1 and unit_tokens[start] > budget:
+                contexts.extend(split_text(units[start][1], budget))
+            else:
+                contexts.append(render_units(units[start:end]))
+        return contexts
+
+
 def ask_json(text, completion_tokens=None) -> dict:
     num_attempts = 3
     message_history = []
@@ -313,27 +456,19 @@ class ChatMessage(BaseModel):  # this should in sync with frontend
         return OpenAIMessage(role=sender, content=self.text)
 
 
-def ask_text_stream_buffered(text, completion_tokens=None, message_history: List[ChatMessage] = [], stream=True) -> Generator[str, None, None]:
-    token_queue = Queue()  # Queue for storing tokens
+async def ask_text_stream_buffered(text, completion_tokens=None, message_history: List[ChatMessage] = [], stream=True) -> AsyncGenerator[str, None]:
+    grouped_tokens = []
 
-    # Create generator from ask_text function
-    token_gen = ask_text(text, completion_tokens, message_history, stream)
+    async for token in ask_text_async(text, completion_tokens, message_history, stream):
+        grouped_tokens.append(token)
 
-    for token in token_gen:
-        token_queue.put(token)  # Add token to queue
+        if len(grouped_tokens) >= 5:  # Group five tokens
+            yield "".join(grouped_tokens)
+            grouped_tokens = []
 
-        if token_queue.qsize() >= 5:  # If queue has 5 or more elements
-            grouped_tokens = ""
-            for _ in range(5):  # Group five tokens
-                grouped_tokens += token_queue.get()
-            yield grouped_tokens  # Yield grouped tokens
-
-    # Group and yield remaining items in the queue (if any)
-    grouped_tokens = ""
-    while not token_queue.empty():
-        grouped_tokens += token_queue.get()
+    # Yield remaining tokens (if any)
     if grouped_tokens:
-        yield grouped_tokens
+        yield "".join(grouped_tokens)
 
 
 @elapsed_time
@@ -377,6 +512,50 @@ def ask_text(text, completion_tokens=None, message_history: List[ChatMessage] =
     return response
 
 
+async def ask_text_async(text, completion_tokens=None, message_history: List[ChatMessage] = [], stream=False) -> AsyncGenerator[str, None]:
+    start_time = time.time()
+    text_size = count_tokens(text)
+    history_size = sum([count_tokens(message.as_openai_message().content) +
+                       3 for message in message_history])
+
+    if completion_tokens is None:
+        completion_tokens = LLM_MAX_TOKENS - text_size - history_size
+
+    retries_remaining = 3
+    while retries_remaining > 0:
+        yielded = False
+        try:
+            response = await openai.ChatCompletion.acreate(
+                max_tokens=int(completion_tokens),
+                model="gpt-3.5-turbo-16k",
+                messages=[
+                    *[dict(message.as_openai_message()) for message in message_history],
+                    {"role": "user", "content": text}
+                ],
+                stream=stream,
+            )
+            if stream:
+                async for chunk in response:
+                    if chunk.choices[0].finish_reason == "stop":
+                        break
+                    if 'content' in chunk.choices[0].delta:
+                        yielded = True
+                        yield chunk.choices[0].delta.content
+            else:
+                yield response.choices[0].message.content
+            print(f"Elapsed time: {time.time() - start_time} seconds")
+            return
+
+        except Exception as e:
+            print("Error: " + str(e))
+            retries_remaining -= 1
+            # a half streamed answer can't be retried without repeating it to the user
+            if retries_remaining == 0 or yielded:
+                raise e
+            else:
+                print("Retrying...")
+
+
 def get_top_k_labels(k, text, labels):
     if len(labels) < k:
         print(f"Already has less than {k} labels, skipping")
@@ -418,70 +597,233 @@ def validate_message_history(message_history: List[ChatMessage]):
     return message_history
 
 
-def ask_context(question: str, full_context: str, message_history: List[ChatMessage] = [], prompt_override: Union[str, None] = None) -> Generator[str, None, None]:
-    def build_prompt(question, context):
-        if prompt_override is None:
-            return f"""
-            You are a smart and helpful assistant that specializes in answering user's questions/requests. For that you may use a given (partial) context.
-            Any question must be answered based only on the given context. The context might come as raw text or markdown.
-            Take into account the following rules:
-            - Your answer must only contain information that is present in the context.
-            - When the context does not contain enough information to answer the question, you must say so.
-            - Your answer must be as detailed as possible 
-            - Your answer must be in markdown format
-
-            The presented context has been split, which means you're only seeing a part of it. You must nevertheless 
-            answer the question based on the context you're given.
+def build_context_prompt(question: str, context: str, prompt_override: Union[str, None] = None) -> str:
+    if prompt_override is None:
+        return f"""
+        You are a smart and helpful assistant that specializes in answering user's questions/requests. For that you may use a given (partial) context.
+        Any question must be answered based only on the given context. The context might come as raw text or markdown.
+        Take into account the following rules:
+        - Your answer must only contain information that is present in the context.
+        - When the context does not contain enough information to answer the question, reply exactly with: {NOT_ENOUGH_INFO_ANSWER}
+        - Your answer must be as detailed as possible 
+        - Your answer must be in markdown format
+
+        The presented context has been split, which means you're only seeing a part of it. You must nevertheless 
+        answer the question based on the context you're given.
+
+        Context:
+        {context}
+        
+        Users's question/request to you: 
+        {question}
+
+        Your Answer:
+        """
+    else:
+        if "{context}" not in prompt_override or "{question}" not in prompt_override:
+            raise ValueError(
+                "Prompt override must contain {context} and {question}")
+
+        return prompt_override.replace("{context}", context).replace("{question}", question)
+
+
+def build_summary_prompt(responses: List[str], question: str) -> str:
+    return f"""
+            You now are a smart assistant specializes in the merging responses task.
+            You will receive a user request and a list of responses, and your job is to merge them into one single response,
+            
+            You must obey the following rules:
+
+            - Do not include any responses that are not clearly related to the user's request.
+            - You should not contradict yourself.
+            - You should not repeat yourself.
+            - Your answer must be sequential (i.e 'Response N+1' contents come after 'Response N').
+            - You must mimic the structure & style of the original responses. (e.g. formal, informal, markdown table, code, json, etc.)
+            - The answer must be directed to the user, not to the original responses.
+            - The user only cares & knows about your given answer, not the original responses.
+            - The user must not know from the answer that it is a merge of multiple responses.
+            - You should not include any information that is not in the original responses (this is very important).
 
-            Context:
-            {context}
             
-            Users's question/request to you: 
+            These responses were generated by someone who only had access to a subset of all information, so they might contradicting.
+            If that's the case, assume the answer that positively answers the user's request is correct.
+
+            Responses to Merge:
+            {responses}
+
+            User Request:
             {question}
 
-            Your Answer:
+            Assistant Merged Response:
             """
+
+
+def build_followup_prompt(answer: str, responses: List[str], question: str) -> str:
+    return f"""
+            You are a smart assistant that specializes in completing answers.
+            The user already received an answer to their request, which was generated by someone who only had access to a subset of all information.
+            You will receive that answer and a list of other responses, generated from the remaining information.
+
+            You must obey the following rules:
+
+            - Only write what the other responses add to the given answer, the user already read the answer.
+            - Do not repeat or rephrase anything that is already in the given answer.
+            - Do not include any responses that are not clearly related to the user's request.
+            - You must mimic the structure & style of the given answer. (e.g. formal, informal, markdown table, code, json, etc.)
+            - The user must not know from your text that it is a merge of multiple responses.
+            - You should not include any information that is not in the responses (this is very important).
+            - If the other responses add nothing to the given answer, reply exactly with {NOTHING_TO_ADD_ANSWER}
+
+            Given Answer:
+            {answer}
+
+            Other Responses:
+            {responses}
+
+            User Request:
+            {question}
+
+            Your Addition:
+            """
+
+
+# the model doesn't always reply with NOT_ENOUGH_INFO_ANSWER verbatim, these catch the usual rephrasings
+NON_ANSWER_PATTERNS = [
+    re.compile(re.escape(NOT_ENOUGH_INFO_ANSWER.lower())),
+    re.compile(r"(does|do) not (contain|provide|include|mention|have) (enough|sufficient|any|specific|relevant) information"),
+    re.compile(r"(no|not enough|insufficient) (relevant )?information (about|on|regarding|to answer)"),
+    re.compile(r"(is|are) not (mentioned|specified|discussed|provided) in the (given |provided )?(context|paper|text)"),
+    re.compile(r"(cannot|can't|can not|unable to) (be )?(answer|determine|find|answered|determined)"),
+]
+# longer answers can open with a caveat and still carry content, only short ones are classified as non-answers
+NON_ANSWER_MAX_LENGTH = 300
+
+
+def is_informative_answer(answer: str) -> bool:
+    answer = answer.strip().lower()
+    if not answer:
+        return False
+    if NOT_ENOUGH_INFO_ANSWER.lower() in answer and len(answer) <= len(NOT_ENOUGH_INFO_ANSWER) + NON_ANSWER_MAX_LENGTH:
+        return False
+    if len(answer) > NON_ANSWER_MAX_LENGTH:
+        return True
+    return not any(pattern.search(answer) for pattern in NON_ANSWER_PATTERNS)
+
+
+def informative_answers(answers: List[Tuple[int, str]]) -> List[Tuple[int, str]]:
+    """
+    Drop the chunk answers that only say the chunk doesn't answer the question.
+    """
+    kept = [(position, answer) for position, answer in answers if is_informative_answer(answer)]
+    print(f"Informative chunk answers: {len(kept)}/{len(answers)}")
+    return kept
+
+
+async def merge_responses(question: str, responses: List[str], message_history: List[ChatMessage] = []) -> AsyncGenerator[str, None]:
+    if ENVIRONMENT == "dev":
+        with open("responses.txt", "w") as f:
+            f.write("\n\n".join(responses))
+
+    print("Question: ", question)
+    async for tokens in ask_text_stream_buffered(build_summary_prompt(responses=responses, question=question), message_history=message_history, stream=True):
+        yield tokens
+
+
+async def progressive_reduce(question: str, tasks: List[asyncio.Future], message_history: List[ChatMessage] = []) -> AsyncGenerator[str, None]:
+    """
+    Stream the first informative chunk answer as soon as it arrives, then, once the slower
+    chunks are done, stream whatever their answers add to it.
+    """
+    first_answer = None
+    other_answers = []
+    for next_answer in asyncio.as_completed(tasks):
+        position, answer = await next_answer
+        if first_answer is None and is_informative_answer(answer):
+            print(f"Streaming answer of chunk {position} first")
+            first_answer = answer
+            yield answer
         else:
-            if "{context}" not in prompt_override or "{question}" not in prompt_override:
-                raise ValueError(
-                    "Prompt override must contain {context} and {question}")
+            other_answers.append((position, answer))
 
-            return prompt_override.replace("{context}", context).replace("{question}", question)
+    if first_answer is None:
+        yield NOT_ENOUGH_INFO_ANSWER
+        return
 
-    def build_summary_prompt(responses, question):
-        return f"""
-                You now are a smart assistant specializes in the merging responses task.
-                You will receive a user request and a list of responses, and your job is to merge them into one single response,
-                
-                You must obey the following rules:
+    other_answers = [answer for _, answer in sorted(informative_answers(other_answers))]
 
-                - Do not include any responses that are not clearly related to the user's request.
-                - You should not contradict yourself.
-                - You should not repeat yourself.
-                - Your answer must be sequential (i.e 'Response N+1' contents come after 'Response N').
-                - You must mimic the structure & style of the original responses. (e.g. formal, informal, markdown table, code, json, etc.)
-                - The answer must be directed to the user, not to the original responses.
-                - The user only cares & knows about your given answer, not the original responses.
-                - The user must not know from the answer that it is a merge of multiple responses.
-                - You should not include any information that is not in the original responses (this is very important).
+    if not other_answers:
+        return
 
-                
-                These responses were generated by someone who only had access to a subset of all information, so they might contradicting.
-                If that's the case, assume the answer that positively answers the user's request is correct.
+    # hold the addition back until we know it isn't just the "nothing to add" marker
+    addition = ""
+    async for tokens in ask_text_stream_buffered(build_followup_prompt(first_answer, other_answers, question), message_history=message_history, stream=True):
+        if addition is None:
+            yield tokens
+            continue
+        addition += tokens
+        if len(addition.strip()) >= len(NOTHING_TO_ADD_ANSWER):
+            if addition.strip().startswith(NOTHING_TO_ADD_ANSWER):
+                return
+            yield "\n\n" + addition
+            addition = None
 
-                Responses to Merge:
-                {responses}
+    if addition and not addition.strip().startswith(NOTHING_TO_ADD_ANSWER):
+        yield "\n\n" + addition
 
-                User Request:
-                {question}
 
-                Assistant Merged Response:
-                """
+async def ask_contexts(question: str, contexts: List[str], message_history: List[ChatMessage] = [], prompt_override: Union[str, None] = None, completion_tokens: int = COMPLETION_TOKENS, reduce_mode: str = ASK_REDUCE_MODE) -> AsyncGenerator[str, None]:
+    """
+    Ask the question on each context (map) and merge the answers (reduce).
+    A single context is answered with one streamed call.
+    With the "progressive" reduce mode the merge starts streaming before all chunks are answered.
+    """
+    print("Contexts to ask: ", len(contexts))
+    if len(contexts) == 1:
+        async for tokens in ask_text_stream_buffered(
+            text=build_context_prompt(question, contexts[0], prompt_override),
+            completion_tokens=completion_tokens,
+            message_history=message_history,
+            stream=True
+        ):
+            yield tokens
+        return
 
+    async def ask_chunk(position, chunk):
+        async for response in ask_text_async(
+            text=build_context_prompt(question, chunk, prompt_override),
+            completion_tokens=completion_tokens,
+            message_history=message_history,
+            stream=False
+        ):
+            return position, response
+
+    tasks = [asyncio.ensure_future(ask_chunk(position, context))
+             for position, context in enumerate(contexts[:MAX_CONTEXTS])]
+    try:
+        if reduce_mode == "progressive":
+            async for tokens in progressive_reduce(question, tasks, message_history):
+                yield tokens
+        else:
+            responses = [response for _, response in informative_answers(await asyncio.gather(*tasks))]
+            if not responses:
+                yield NOT_ENOUGH_INFO_ANSWER
+            elif len(responses) == 1:
+                # nothing to merge, skip the reduce call
+                yield responses[0]
+            else:
+                async for tokens in merge_responses(question, responses, message_history):
+                    yield tokens
+    finally:
+        # the client may go away mid stream, don't keep paying for the remaining chunks
+        for task in tasks:
+            task.cancel()
 
-    completion_tokens = 700
+
+def split_context(question: str, full_context: str, message_history: List[ChatMessage] = [], prompt_override: Union[str, None] = None) -> Tuple[List[str], List[ChatMessage], int]:
+    completion_tokens = COMPLETION_TOKENS
     context_max_tokens = LLM_MAX_TOKENS - completion_tokens - \
-        count_tokens(build_prompt(context="", question=question))
+        count_tokens(build_context_prompt(
+            context="", question=question, prompt_override=prompt_override))
 
     message_history = validate_message_history(message_history)
     history_size = sum([count_tokens(message.text)
@@ -494,8 +836,8 @@ def ask_context(question: str, full_context: str, message_history: List[ChatMess
         context_sizes = [count_tokens(context) for context in contexts]
         print("Context sizes: ", context_sizes)
 
-        sequence_sizes = [count_tokens(build_prompt(
-            question, context)) + history_size + completion_tokens for context in contexts]
+        sequence_sizes = [count_tokens(build_context_prompt(
+            question, context, prompt_override)) + history_size + completion_tokens for context in contexts]
         print("Sequence sizes: ", sequence_sizes)
 
         if max(sequence_sizes) > LLM_MAX_TOKENS:
@@ -511,50 +853,23 @@ def ask_context(question: str, full_context: str, message_history: List[ChatMess
                             context + '\n' for i, context in enumerate(contexts)]))
             break
 
-    print("Contexts to ask: ", len(contexts))
-    if len(contexts) == 1:
-        return ask_text_stream_buffered(
-            text=build_prompt(question, contexts[0]),
-            completion_tokens=completion_tokens,
-            message_history=message_history,
-            stream=True
-        )
-
-    def ask_chunk(chunk):
-        return next(ask_text(
-            text=build_prompt(question, chunk),
-            completion_tokens=completion_tokens,
-            message_history=message_history,
-            stream=False
-        ))
-
-    futures = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for full_context in contexts[:MAX_CONTEXTS]:
-            futures.append(executor.submit(ask_chunk, chunk=full_context))
-
-    responses = [f.result() for f in futures]
-
-    if ENVIRONMENT == "dev":
-        with open("responses.txt", "w") as f:
-            f.write("\n\n".join(responses))
+    return contexts, message_history, completion_tokens
 
-    print("Question: ", question)
-    return ask_text_stream_buffered(build_summary_prompt(responses=responses, question=question), message_history=message_history, stream=True)
 
+async def ask_context(question: str, full_context: str, message_history: List[ChatMessage] = [], prompt_override: Union[str, None] = None) -> AsyncGenerator[str, None]:
+    # tokenizing a long context is CPU bound, keep it off the event loop
+    contexts, message_history, completion_tokens = await asyncio.get_running_loop().run_in_executor(
+        None, split_context, question, full_context, message_history, prompt_override)
 
-def ask_paper(question: str, paper: Paper, message_history: List[ChatMessage] = []) -> Generator[str, None, None]:
-    if "this is a load test" in question.lower():
-        return string_as_generator("This is a load test response")
+    async for tokens in ask_contexts(question, contexts, message_history, prompt_override, completion_tokens):
+        yield tokens
 
-    print("Asking paper")
-    context = paper.to_text()
 
-    prompt_override = """
+ASK_PAPER_PROMPT = """
     Answer the following question based on the given paper context, according to the following rules:
 
     - Do not include any information that is not in the paper.
-    - If the paper context does not contain enough information to clearly answer the question, you must say so.
+    - If the paper context does not contain enough information to clearly answer the question, reply exactly with: """ + NOT_ENOUGH_INFO_ANSWER + """
     - You cannot use any information that is not in the paper context.
     - Backup your answer with quotes from the paper.
     
@@ -567,9 +882,90 @@ def ask_paper(question: str, paper: Paper, message_history: List[ChatMessage] =
     Answer:
     """
 
-    return ask_context(
+
+def context_budget(prompt: str, question: str, message_history: List[ChatMessage] = []) -> int:
+    """ Tokens left for the context, `message_history` is the validated history sent along """
+    history_size = sum([count_tokens(message.text)
+                       for message in message_history])
+    prompt_size = count_tokens(prompt.replace(
+        "{context}", "").replace("{question}", question))
+    return LLM_MAX_TOKENS - COMPLETION_TOKENS - prompt_size - history_size
+
+
+def select_paper_blocks(question: str, paper: Paper, chunk_plan: ChunkPlan, budget: int, index: Optional[BM25Index] = None) -> Optional[Set[str]]:
+    """
+    Pick the keys of the paper blocks that best match the question, so that they fit a single prompt.
+    Returns None when the whole paper should be used instead, either because the question has no
+    lexical match or because the top ranked blocks don't fit together.
+    """
+    blocks = dict(paper.context_blocks())
+    if index is None:
+        print("No stored index for paper, building one")
+        index = BM25Index.build(blocks.items())
+
+    ranked = index.rank(question, keys=set(blocks.keys()))
+    if not ranked:
+        print("No block matches the question, using full paper")
+        return None
+
+    budget = min(budget, RETRIEVAL_MAX_CONTEXT_TOKENS)
+    units = paper.context_units()
+    block_tokens = dict(zip([key for key, _ in units], chunk_plan.unit_tokens(units)))
+
+    selected = []
+    used_tokens = chunk_plan.total_tokens(paper.context_units(keys=set()))
+    for position, (key, score) in enumerate(ranked):
+        tokens = block_tokens.get(key, 0)
+        if used_tokens + tokens > budget:
+            if position < RETRIEVAL_TOP_K:
+                print(f"Top {RETRIEVAL_TOP_K} blocks don't fit in a single prompt, using full paper")
+                return None
+            break
+        selected.append(key)
+        used_tokens += tokens
+
+    # section headers weren't accounted for while packing
+    while chunk_plan.total_tokens(paper.context_units(keys=set(selected))) > budget:
+        selected.pop()
+
+    print(f"Selected {len(selected)} of {len(blocks)} blocks")
+    return set(selected)
+
+
+def paper_contexts(question: str, paper: Paper, message_history: List[ChatMessage] = [], index: Optional[BM25Index] = None, chunk_plan: Optional[ChunkPlan] = None) -> Tuple[List[str], List[ChatMessage]]:
+    """ The contexts to ask the question on, and the validated message history they were sized for """
+    units = paper.context_units()
+    if chunk_plan is None:
+        print("No stored chunk plan for paper, building one")
+        chunk_plan = ChunkPlan.build(units)
+
+    message_history = validate_message_history(message_history)
+    budget = context_budget(ASK_PAPER_PROMPT, question, message_history)
+    if chunk_plan.total_tokens(units) <= budget:
+        return [render_units(units)], message_history
+
+    selected = select_paper_blocks(question, paper, chunk_plan, budget, index)
+    if selected is not None:
+        return [paper.to_text(keys=selected)], message_history
+
+    return chunk_plan.split(units, budget), message_history
+
+
+async def ask_paper(question: str, paper: Paper, message_history: List[ChatMessage] = [], index: Optional[BM25Index] = None, chunk_plan: Optional[ChunkPlan] = None) -> AsyncGenerator[str, None]:
+    if "this is a load test" in question.lower():
+        yield "This is a load test response"
+        return
+
+    print("Asking paper")
+
+    # tokenizing the paper is CPU bound, keep it off the event loop
+    contexts, message_history = await asyncio.get_running_loop().run_in_executor(
+        None, paper_contexts, question, paper, message_history, index, chunk_plan)
+
+    async for tokens in ask_contexts(
         question=question,
-        full_context=context,
+        contexts=contexts,
         message_history=message_history,
-        prompt_override=prompt_override
-    )
+        prompt_override=ASK_PAPER_PROMPT
+    ):
+        yield tokens
@@ -0,0 +1,382 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Optional, Tuple
+
+import aws
+import nlp
+from botocore.exceptions import ClientError
+from database.db import DynamoDBGateway
+from doc2json.conversion_pool import ConversionPool
+from doc2json.grobid2json.process_pdf import ENGINE_LXML_STREAM
+from doc2json.grobid2json.tei_cache import TeiCache
+from utils.constants import (CONVERSION_WORKERS, DB_JSON_PAPERS, GROBID_URL,
+                             PAPER_CACHE_MAX_BYTES,
+                             PAPER_DISK_CACHE_DIR,
+                             PAPER_DISK_CACHE_MAX_FILES,
+                             PAPER_CACHE_TTL_SECONDS,
+                             PAPER_PROCESSING_LEASE_SECONDS,
+                             TEI_CONVERSION_ENGINE, TEI_STREAMING_MIN_CHARS)
+
+PAPER_HASH_REGEX = re.compile(r"[0-9a-f]{64}")
+
+GROBID_CONFIG = {'grobid_url': GROBID_URL}
+
+# TEI to JSON conversions of uploads, out of the process serving requests
+conversion_pool = ConversionPool(CONVERSION_WORKERS)
+
+
+def tei_conversion_engine(tei_text: str) -> str:
+    """
+    TEI to JSON converter of a paper: the configured one, or the streaming one when the TEI is too long for
+    its whole tree to fit in memory.
+    """
+    if TEI_STREAMING_MIN_CHARS and len(tei_text) >= TEI_STREAMING_MIN_CHARS:
+        return ENGINE_LXML_STREAM
+    return TEI_CONVERSION_ENGINE
+
+
+def paper_s3_key(paper_hash: str) -> str:
+    # next to the PDF stored by `aws.store_paper_in_s3`
+    return f"papers/{paper_hash}.json.gz"
+
+
+def store_paper_json(paper_hash: str, paper_json: str) -> dict:
+    """
+    Stores the JSON of a paper in S3, returns the attributes pointing to it in the paper's DynamoDB item.
+    """
+    try:
+        aws.store_json_in_s3(paper_json, paper_s3_key(paper_hash), compress=True)
+        return {'paper_s3_key': paper_s3_key(paper_hash)}
+    except ClientError as e:
+        # still try to keep the paper, which works as long as it fits a dynamo item
+        print(f"ERROR: Failed to store paper in S3, storing it in Dynamo instead: {e}")
+        return {'paper_json': paper_json}
+
+
+def read_paper_json(item: dict) -> Optional[str]:
+    """ JSON of the paper of a DynamoDB item, wherever it is stored. """
+    if 'paper_s3_key' in item:
+        return aws.read_text_from_s3(item['paper_s3_key'])
+    return item.get('paper_json')
+
+
+# stages of a paper being converted, recorded on its processing marker
+STAGE_QUEUED = 'queued'
+# the PDF of an upload job is stored, waiting for a worker to run the job
+STAGE_STORED = 'stored'
+# the PDF is stored and a worker converts it: an upload job it took, or an upload through /upload-paper
+STAGE_RUNNING = 'running'
+STAGE_GROBID_DONE = 'grobid_done'
+STAGE_PARSED = 'parsed'
+STAGE_INDEXED = 'indexed'
+STAGE_FAILED = 'failed'
+# not on a marker: the paper is stored
+STAGE_DONE = 'done'
+
+
+def claim_processing(paper_hash: str, attributes: Optional[dict] = None) -> bool:
+    """
+    Marks the paper as being converted by this worker, unless it's already stored or another worker's
+    claim is still valid. The marker is replaced by the paper item once `PaperStore.put` stores it.
+    :param attributes: kept on the marker, e.g. what an upload job needs to run
+    """
+    try:
+        return DynamoDBGateway(DB_JSON_PAPERS).write_if(
+            {'stage': STAGE_QUEUED, **(attributes or {}), 'id': paper_hash,
+             'processing_until': int(time.time()) + PAPER_PROCESSING_LEASE_SECONDS},
+            'attribute_not_exists(id) OR processing_until < :now',
+            {':now': int(time.time())})
+    except ClientError as e:
+        # better converting the paper twice than not at all
+        print(f"ERROR: Failed to claim paper {paper_hash}: {e}")
+        return True
+
+
+def start_upload_job(paper_hash: str) -> bool:
+    """
+    Takes the upload job of the paper for this worker and renews its lease. A job is only taken once, however
+    many times it is dispatched. Returns False when the job isn't waiting to run.
+    """
+    try:
+        return DynamoDBGateway(DB_JSON_PAPERS).update_if(
+            'id', paper_hash, {'stage': STAGE_RUNNING, 'processing_until': int(time.time()) + PAPER_PROCESSING_LEASE_SECONDS},
+            'attribute_exists(processing_until) AND #stage = :stored', {':stored': STAGE_STORED})
+    except ClientError as e:
+        # the job stays queued, its lease expires and a new upload retries it
+        print(f"ERROR: Failed to take upload job {paper_hash}: {e}")
+        return False
+
+
+def set_processing_stage(paper_hash: str, stage: str):
+    try:
+        DynamoDBGateway(DB_JSON_PAPERS).update_if(
+            'id', paper_hash, {'stage': stage}, 'attribute_exists(processing_until)')
+    except ClientError as e:
+        print(f"ERROR: Failed to record stage {stage} of paper {paper_hash}: {e}")
+
+
+def fail_processing(paper_hash: str, error: str):
+    """ Records why this worker failed to convert the paper, and lets others retry right away. """
+    try:
+        DynamoDBGateway(DB_JSON_PAPERS).write_if(
+            # already past, claims compare it to their current second
+            {'id': paper_hash, 'processing_until': int(time.time()) - 1, 'stage': STAGE_FAILED, 'error': error},
+            'attribute_exists(processing_until)', {})
+    except ClientError as e:
+        print(f"ERROR: Failed to release paper {paper_hash}: {e}")
+
+
+def set_processing_header(paper_hash: str, json_header: dict):
+    """ Keeps the header of a paper being converted on its marker, until the full paper replaces it. """
+    try:
+        DynamoDBGateway(DB_JSON_PAPERS).update_if(
+            'id', paper_hash, {'header_json': json.dumps(json_header)}, 'attribute_exists(processing_until)')
+    except ClientError as e:
+        print(f"ERROR: Failed to store the header of paper {paper_hash}: {e}")
+
+
+def read_header_paper_json(paper_hash: str) -> Optional[dict]:
+    """
+    Partial paper made of the header of a paper still being converted: its title, authors and abstract,
+    with the abstract as body text so that it can already be asked. Marked with `partial`.
+    Not cached, the full paper takes over as soon as it's stored.
+    """
+    if not PAPER_HASH_REGEX.fullmatch(paper_hash):
+        return None
+    item = DynamoDBGateway(DB_JSON_PAPERS).read('id', paper_hash, attributes=['processing_until', 'header_json'])
+    if item is None or not is_processing_marker(item) or 'header_json' not in item:
+        return None
+
+    json_paper = json.loads(item['header_json'])
+    pdf_parse = json_paper['pdf_parse']
+    json_paper['pdf_parse'] = {**pdf_parse, 'body_text': pdf_parse['abstract'], 'back_matter': []}
+    json_paper['partial'] = True
+    return json_paper
+
+
+def processing_status(paper_hash: str) -> Optional[dict]:
+    """
+    Stage of the conversion of a paper (see STAGE_*), whether its header is available (`header`)
+    and the error that stopped it, if any. None when the paper is unknown.
+    """
+    item = DynamoDBGateway(DB_JSON_PAPERS).read(
+        'id', paper_hash, attributes=['processing_until', 'stage', 'error', 'header_json'])
+    if item is None:
+        return None
+    if not is_processing_marker(item):
+        return {'stage': STAGE_DONE}
+    if item.get('stage') != STAGE_FAILED and item['processing_until'] < time.time():
+        return {'stage': STAGE_FAILED, 'error': "Processing timed out"}
+    return {**{key: item[key] for key in ['stage', 'error'] if key in item}, 'header': 'header_json' in item}
+
+
+def is_processing_marker(item: dict) -> bool:
+    return 'processing_until' in item
+
+
+class S3TeiCache(TeiCache):
+    """ Grobid TEI of the uploaded papers, so that converter changes can re-run without Grobid. """
+
+    @staticmethod
+    def s3_key(key: str) -> str:
+        return f"tei/{key}.tei.xml.gz"
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return aws.read_text_from_s3(self.s3_key(key))
+        except Exception as e:
+            print(f"Failed to read cached TEI {key}: {e}")
+            return None
+
+    def put(self, key: str, tei_text: str):
+        try:
+            aws.store_text_in_s3(tei_text, self.s3_key(key), 'application/xml', compress=True)
+        except Exception as e:
+            print(f"Failed to cache TEI {key}: {e}")
+
+
+class CachedPaper:
+    def __init__(self, paper_hash: str, json_paper: dict, paper_json: str, cached_at: Optional[float] = None):
+        self.paper_hash = paper_hash
+        self.json_paper = json_paper
+        self.size = len(paper_json)
+        # changes when the paper is re-converted, answers cached for the previous text are not served again
+        self.content_digest = hashlib.sha256(paper_json.encode()).hexdigest()
+        # when the JSON was read from S3 or written, copies read from disk keep the time of the disk file
+        self.cached_at = cached_at or time.time()
+        self._paper = None
+
+    @property
+    def paper(self) -> nlp.Paper:
+        # parsing is the expensive part, only do it for papers that are actually asked
+        if self._paper is None:
+            self._paper = nlp.Paper(**self.json_paper)
+            self._paper.hash = self.paper_hash
+        return self._paper
+
+
+class PaperStore:
+    """
+    Tiered access to uploaded papers, by hash:
+    1. in-memory LRU of raw and parsed papers, bounded by the size of their JSON
+    2. optional JSON files under `disk_cache_dir`, which survive warm restarts
+    3. the source of truth: gzipped JSON in S3, pointed to by the paper's DynamoDB item.
+       Papers uploaded before that have their JSON inline in the item, in `paper_json`.
+    Hits and misses of every tier are counted in `stats`.
+    Copies older than `ttl_seconds` in the first two tiers are read again from S3, a re-converted paper is
+    served at most that long after it was stored.
+    Papers returned by `get` are shared, use `Paper.select_sections` rather than `Paper.filter_sections` on them.
+    """
+
+    def __init__(self, max_bytes: int = PAPER_CACHE_MAX_BYTES, disk_cache_dir: Optional[str] = PAPER_DISK_CACHE_DIR,
+                 disk_cache_max_files: int = PAPER_DISK_CACHE_MAX_FILES, ttl_seconds: int = PAPER_CACHE_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_cache_dir = disk_cache_dir
+        self.disk_cache_max_files = disk_cache_max_files
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, paper_hash: str) -> Optional[nlp.Paper]:
+        entry = self._get_entry(paper_hash)
+        return entry.paper if entry is not None else None
+
+    def get_with_digest(self, paper_hash: str) -> Tuple[Optional[nlp.Paper], Optional[str]]:
+        """ The paper along with the digest of its stored JSON, (None, None) when it's missing """
+        entry = self._get_entry(paper_hash)
+        return (entry.paper, entry.content_digest) if entry is not None else (None, None)
+
+    def get_json(self, paper_hash: str) -> Optional[dict]:
+        entry = self._get_entry(paper_hash)
+        # shallow copy, so callers can add keys (e.g. `hash`) without touching the cached paper
+        return dict(entry.json_paper) if entry is not None else None
+
+    def put(self, paper_hash: str, json_paper: dict, metadata: dict):
+        """
+        Persist a newly uploaded paper along with its metadata (title, owner, chunk plan...) and cache it.
+        """
+        paper_json = json.dumps(json_paper)
+        item = {'id': paper_hash, **metadata, **store_paper_json(paper_hash, paper_json)}
+        try:
+            DynamoDBGateway(DB_JSON_PAPERS).write(item)
+        except ClientError as e:
+            print(
+                f"ERROR: Failed to write paper to Dynamo: {e.response['Error']['Message']}")
+
+        self._write_to_disk(paper_hash, paper_json)
+        self._remember(CachedPaper(paper_hash, dict(json_paper), paper_json))
+
+    def invalidate(self, paper_hash: str):
+        """ Drops the cached copies of a paper whose stored JSON changed, the next `get` reads it from S3. """
+        with self._lock:
+            entry = self._entries.pop(paper_hash, None)
+            if entry is not None:
+                self._size -= entry.size
+        if self.disk_cache_dir:
+            try:
+                os.remove(self._disk_path(paper_hash))
+            except FileNotFoundError:
+                pass
+
+    def _is_fresh(self, cached_at: float) -> bool:
+        return time.time() - cached_at < self.ttl_seconds
+
+    def _get_entry(self, paper_hash: str) -> Optional[CachedPaper]:
+        if not PAPER_HASH_REGEX.fullmatch(paper_hash):
+            return None
+
+        with self._lock:
+            entry = self._entries.get(paper_hash)
+            if entry is not None and self._is_fresh(entry.cached_at):
+                self._entries.move_to_end(paper_hash)
+                self.stats['memory_hits'] += 1
+                return entry
+            if entry is not None:
+                self.stats['expired'] += 1
+
+        paper_json, cached_at = self._read_from_disk(paper_hash)
+        if paper_json is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            paper_json = self._read_from_source(paper_hash)
+            if paper_json is None:
+                self.stats['misses'] += 1
+                print(f"Paper {paper_hash} not found: {dict(self.stats)}")
+                return None
+            self.stats['source_hits'] += 1
+            self._write_to_disk(paper_hash, paper_json)
+
+        print(f"Paper store stats: {dict(self.stats)}")
+        entry = CachedPaper(paper_hash, json.loads(paper_json), paper_json, cached_at)
+        self._remember(entry)
+        return entry
+
+    def _remember(self, entry: CachedPaper):
+        with self._lock:
+            previous = self._entries.pop(entry.paper_hash, None)
+            if previous is not None:
+                self._size -= previous.size
+            self._entries[entry.paper_hash] = entry
+            self._size += entry.size
+            # always keep the newest paper, even if it's bigger than the whole budget
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.size
+                self.stats['evictions'] += 1
+
+    def _read_from_source(self, paper_hash: str) -> Optional[str]:
+        item = DynamoDBGateway(DB_JSON_PAPERS).read(
+            'id', paper_hash, attributes=['paper_s3_key', 'paper_json'])
+        if item is None:
+            return None
+        return read_paper_json(item)
+
+    def _disk_path(self, paper_hash: str) -> str:
+        return os.path.join(self.disk_cache_dir, f"{paper_hash}.json")
+
+    def _read_from_disk(self, paper_hash: str) -> Tuple[Optional[str], Optional[float]]:
+        """ JSON of the paper cached on disk and when it was written, (None, None) when it's missing or stale """
+        if not self.disk_cache_dir:
+            return None, None
+        try:
+            with open(self._disk_path(paper_hash), 'r') as f:
+                written_at = os.fstat(f.fileno()).st_mtime
+                if not self._is_fresh(written_at):
+                    return None, None
+                return f.read(), written_at
+        except FileNotFoundError:
+            return None, None
+
+    def _write_to_disk(self, paper_hash: str, paper_json: str):
+        if not self.disk_cache_dir:
+            return
+        try:
+            os.makedirs(self.disk_cache_dir, exist_ok=True)
+            # write then rename, so a concurrent reader never sees a partial file
+            temp_path = f"{self._disk_path(paper_hash)}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(paper_json)
+            os.replace(temp_path, self._disk_path(paper_hash))
+            self._prune_disk()
+        except OSError as e:
+            print(f"ERROR: Failed to cache paper {paper_hash} on disk: {e}")
+
+    def _prune_disk(self):
+        files = [os.path.join(self.disk_cache_dir, name)
+                 for name in os.listdir(self.disk_cache_dir) if name.endswith('.json')]
+        if len(files) <= self.disk_cache_max_files:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[:len(files) - self.disk_cache_max_files]:
+            os.remove(path)
+
+
+paper_store = PaperStore()
+tei_cache = S3TeiCache()
@@ -0,0 +1,211 @@
+"""
+Re-converts every stored paper with the current TEI to JSON converter, from the Grobid TEI cached at upload.
+Papers uploaded before the TEI was cached can go through Grobid again from their stored PDF (--grobid-missing).
+
+    python reconvert_papers.py --dry-run
+    python reconvert_papers.py --segments 8 --workers 4
+
+Papers are re-converted with the full profile. `--profile qa` rewrites them without their bibliography entries
+and cite spans, which can only be restored by another full re-conversion.
+
+Answers cached for the previous conversion of a paper are not served again, their keys digest the stored JSON
+of the paper the question was asked on (`answer_cache.stored_paper_key`). Updated papers are dropped from the paper disk cache
+of this host; running API instances read them again from S3 once their copy is older than
+PAPER_CACHE_TTL_SECONDS.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+import aws
+import nlp
+import papers
+import retrieval
+from database.db import DynamoDBGateway
+from doc2json.grobid2json.grobid.grobid_client import get_grobid_client
+from doc2json.grobid2json.process_pdf import PROFILE_FULL, PROFILES, convert_tei_text, process_pdf_stream
+from doc2json.grobid2json.tei_cache import tei_cache_key_for_hash
+from utils.constants import DB_JSON_PAPERS, LATEST_COMMIT_ID, TEI_CONVERSION_ENGINE
+
+GROBID_SERVICE = "processFulltextDocument"
+
+STATUS_UPDATED = 'updated'
+STATUS_CHANGED = 'changed'
+STATUS_UNCHANGED = 'unchanged'
+STATUS_NO_TEI = 'no_tei'
+STATUS_FAILED = 'failed'
+
+
+class ReconvertResult(NamedTuple):
+    paper_hash: str
+    status: str
+    diff: List[str]
+    # DynamoDB item to write, when the paper changed and this is not a dry run
+    item: Optional[dict] = None
+    error: Optional[str] = None
+
+
+def comparable(json_paper: dict) -> dict:
+    # the header only holds the converter name and the conversion date
+    return {key: value for key, value in json_paper.items() if key != 'header'}
+
+
+def paper_diff(old: dict, new: dict) -> List[str]:
+    """
+    Short description of what changed between two conversions of a paper, empty when they are the same.
+    """
+    old, new = comparable(old), comparable(new)
+    diff = []
+    for key in sorted(set(old) | set(new)):
+        if key == 'pdf_parse' or old.get(key) == new.get(key):
+            continue
+        diff.append(f"{key}: {json.dumps(old.get(key))[:80]} -> {json.dumps(new.get(key))[:80]}")
+
+    old_parse, new_parse = old.get('pdf_parse') or {}, new.get('pdf_parse') or {}
+    for key in sorted(set(old_parse) | set(new_parse)):
+        old_value, new_value = old_parse.get(key), new_parse.get(key)
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, (list, dict)) and isinstance(new_value, (list, dict)):
+            if isinstance(old_value, dict):
+                changed = sum(1 for entry in set(old_value) & set(new_value) if old_value[entry] != new_value[entry])
+                changed += len(set(old_value) ^ set(new_value))
+            else:
+                changed = sum(1 for a, b in zip(old_value, new_value) if a != b) + abs(len(old_value) - len(new_value))
+            diff.append(f"pdf_parse.{key}: {len(old_value)} -> {len(new_value)} entries, {changed} changed")
+        else:
+            diff.append(f"pdf_parse.{key}: {json.dumps(old_value)[:80]} -> {json.dumps(new_value)[:80]}")
+    return diff
+
+
+def reconvert_paper(item: dict, tei_key: str, dry_run: bool, grobid_missing: bool,
+                    profile: str = PROFILE_FULL) -> ReconvertResult:
+    """
+    Runs in the process pool: re-converts the paper of a DynamoDB item and, unless `dry_run`, stores its new
+    JSON and index. The item itself is returned to be written in batch by the caller.
+    """
+    paper_hash = item['id']
+    try:
+        old_json = papers.read_paper_json(item)
+        if old_json is None:
+            return ReconvertResult(paper_hash, STATUS_FAILED, [], error="paper JSON not found")
+        old_paper = json.loads(old_json)
+
+        tei_text = papers.tei_cache.get(tei_key)
+        if tei_text:
+            new_paper = convert_tei_text(tei_text, old_paper['paper_id'], paper_hash,
+                                         papers.tei_conversion_engine(tei_text), profile)
+        elif grobid_missing:
+            pdf = aws.read_bytes_from_s3(f"papers/{paper_hash}.pdf")
+            if pdf is None:
+                return ReconvertResult(paper_hash, STATUS_FAILED, [], error="neither TEI nor PDF found")
+            # caches the TEI, the next re-conversion won't need Grobid
+            new_paper = process_pdf_stream(old_paper['paper_id'], paper_hash, pdf, papers.GROBID_CONFIG,
+                                           tei_cache=papers.tei_cache, engine=TEI_CONVERSION_ENGINE,
+                                           profile=profile)
+        else:
+            return ReconvertResult(paper_hash, STATUS_NO_TEI, [])
+
+        diff = paper_diff(old_paper, new_paper)
+        if not diff:
+            return ReconvertResult(paper_hash, STATUS_UNCHANGED, [])
+        if dry_run:
+            return ReconvertResult(paper_hash, STATUS_CHANGED, diff)
+
+        paper = nlp.Paper(**new_paper)
+        retrieval.store_paper_index(paper_hash, retrieval.BM25Index.build(paper.context_blocks()))
+        new_item = {key: value for key, value in item.items() if key not in ['paper_json', 'paper_s3_key']}
+        new_item.update(papers.store_paper_json(paper_hash, json.dumps(new_paper)))
+        new_item.update({
+            'paper_title': new_paper['title'],
+            'chunk_plan': nlp.ChunkPlan.build(paper.context_units()).json(),
+            'latest_commit_id': LATEST_COMMIT_ID,
+        })
+        return ReconvertResult(paper_hash, STATUS_UPDATED, diff, item=new_item)
+    except Exception as e:
+        return ReconvertResult(paper_hash, STATUS_FAILED, [], error=f"{type(e).__name__}: {e}")
+
+
+def reconvert_papers(segments: int = 4, workers: Optional[int] = None, dry_run: bool = False,
+                     grobid_missing: bool = False, profile: str = PROFILE_FULL) -> Counter:
+    """
+    Re-converts every paper of DB_JSON_PAPERS.
+    The table is scanned in `segments` parallel segments, papers are converted in a pool of `workers` processes
+    and their updated items are written back in batches.
+    :param segments: number of parallel DynamoDB scan segments
+    :param workers: size of the conversion process pool, defaults to the number of CPUs
+    :param dry_run: only print what would change
+    :param grobid_missing: process again through Grobid the papers without cached TEI
+    :param profile: conversion profile, one of PROFILES
+    :return: count of papers by status
+    """
+    workers = workers or os.cpu_count()
+    gateway = DynamoDBGateway(DB_JSON_PAPERS)
+    # the flags of the uploads, which are part of the TEI cache key
+    parameters = get_grobid_client(papers.GROBID_CONFIG).grobid_parameters()
+    statuses = Counter()
+    lock = threading.Lock()
+    start_time = time.time()
+
+    # spawned rather than forked, the scan threads are running when the pool starts workers
+    with gateway.batch_writer() as batch, ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        # bounds the items waiting for a worker, a scan page can hold hundreds of them
+        in_flight = threading.BoundedSemaphore(workers * 2)
+
+        def on_done(item: dict, future):
+            in_flight.release()
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker died, e.g. out of memory
+                result = ReconvertResult(item['id'], STATUS_FAILED, [], error=f"{type(e).__name__}: {e}")
+            with lock:
+                statuses[result.status] += 1
+                if result.status == STATUS_FAILED:
+                    print(f"{result.paper_hash}: failed, {result.error}")
+                elif result.diff:
+                    print(f"{result.paper_hash}: {result.status}")
+                    for line in result.diff:
+                        print(f"    {line}")
+                if result.item is not None:
+                    batch.put_item(Item=result.item)
+                    papers.paper_store.invalidate(result.paper_hash)
+                if sum(statuses.values()) % 50 == 0:
+                    print(f"{sum(statuses.values())} papers in {round(time.time() - start_time, 1)}s: {dict(statuses)}")
+
+        def scan(segment: int):
+            for item in gateway.scan(segment, segments):
+                if papers.is_processing_marker(item):
+                    # being uploaded, it will be converted with the current converter anyway
+                    continue
+                tei_key = tei_cache_key_for_hash(item['id'], GROBID_SERVICE, parameters)
+                in_flight.acquire()
+                pool.submit(reconvert_paper, item, tei_key, dry_run, grobid_missing, profile).add_done_callback(
+                    lambda future, item=item: on_done(item, future))
+
+        with ThreadPoolExecutor(max_workers=segments) as scanners:
+            list(scanners.map(scan, range(segments)))
+
+    print(f"Done in {round(time.time() - start_time, 1)}s: {dict(statuses)}")
+    return statuses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-convert the stored papers with the current TEI to JSON converter")
+    parser.add_argument("-s", "--segments", type=int, default=4, help="parallel DynamoDB scan segments")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="conversion processes")
+    parser.add_argument("--dry-run", action='store_true', help="print what would change without writing anything")
+    parser.add_argument("--grobid-missing", action='store_true',
+                        help="send to Grobid again the PDFs of papers without cached TEI")
+    parser.add_argument("--profile", default=PROFILE_FULL, choices=PROFILES,
+                        help="conversion profile, qa drops the bibliography entries and cite spans of the stored papers")
+    args = parser.parse_args()
+
+    reconvert_papers(args.segments, args.workers, args.dry_run, args.grobid_missing, args.profile)
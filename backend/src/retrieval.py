@@ -0,0 +1,99 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import aws
+from pydantic import BaseModel
+
+TOKEN_REGEX = re.compile(r"[a-z0-9]+")
+
+# kept small on purpose: we only want to drop words that carry no signal in a question
+STOPWORDS = {
+    'a', 'about', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'been', 'but', 'by', 'can', 'could',
+    'did', 'do', 'does', 'for', 'from', 'had', 'has', 'have', 'how', 'i', 'if', 'in', 'into', 'is', 'it',
+    'its', 'me', 'my', 'of', 'on', 'or', 'our', 'paper', 'should', 'so', 'than', 'that', 'the', 'their',
+    'them', 'there', 'these', 'they', 'this', 'those', 'to', 'used', 'was', 'we', 'were', 'what', 'when',
+    'where', 'which', 'who', 'why', 'will', 'with', 'would', 'you', 'your'
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in TOKEN_REGEX.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index(BaseModel):
+    """
+    Okapi BM25 index over the blocks of a single paper.
+    Documents are identified by the block keys produced by `nlp.Paper.context_blocks`.
+    """
+    keys: List[str]
+    term_freqs: List[Dict[str, int]]
+    doc_lengths: List[int]
+    doc_freqs: Dict[str, int]
+    k1: float = 1.5
+    b: float = 0.75
+
+    @classmethod
+    def build(cls, documents: Iterable[Tuple[str, str]]) -> 'BM25Index':
+        keys, term_freqs, doc_lengths = [], [], []
+        doc_freqs = Counter()
+        for key, text in documents:
+            tokens = tokenize(text)
+            counts = Counter(tokens)
+            keys.append(key)
+            term_freqs.append(dict(counts))
+            doc_lengths.append(len(tokens))
+            doc_freqs.update(counts.keys())
+
+        return cls(keys=keys, term_freqs=term_freqs, doc_lengths=doc_lengths, doc_freqs=dict(doc_freqs))
+
+    def _idf(self, term: str) -> float:
+        n = len(self.keys)
+        df = self.doc_freqs.get(term, 0)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def score(self, query: str, keys: Optional[Set[str]] = None) -> Dict[str, float]:
+        """
+        Score every document against the query, optionally restricted to a subset of keys.
+        Documents with no query term are left out.
+        """
+        if not self.keys:
+            return {}
+
+        query_terms = set(tokenize(query))
+        avg_length = (sum(self.doc_lengths) / len(self.doc_lengths)) or 1
+        idfs = {term: self._idf(term) for term in query_terms if term in self.doc_freqs}
+
+        scores = {}
+        for key, freqs, length in zip(self.keys, self.term_freqs, self.doc_lengths):
+            if keys is not None and key not in keys:
+                continue
+            score = 0.0
+            for term, idf in idfs.items():
+                freq = freqs.get(term, 0)
+                if freq == 0:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+                score += idf * freq * (self.k1 + 1) / (freq + norm)
+            if score > 0:
+                scores[key] = score
+        return scores
+
+    def rank(self, query: str, keys: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        return sorted(self.score(query, keys).items(), key=lambda x: x[1], reverse=True)
+
+
+def index_s3_key(paper_hash: str) -> str:
+    return f"papers/{paper_hash}.index.json"
+
+
+def store_paper_index(paper_hash: str, index: BM25Index):
+    aws.store_json_in_s3(index.dict(), index_s3_key(paper_hash))
+
+
+def load_paper_index(paper_hash: str) -> Optional[BM25Index]:
+    data = aws.read_json_from_s3(index_s3_key(paper_hash))
+    if data is None:
+        return None
+    return BM25Index(**data)
@@ -7,6 +7,7 @@ from utils.constants import LOCALSTACK_URL
 class AWSResource(Enum):
     S3 = 's3'
     DYNAMODB = 'dynamodb'
+    LAMBDA = 'lambda'
 
 def _dev_resource(resource):
     return boto3.resource(resource.value, endpoint_url=LOCALSTACK_URL)
@@ -14,8 +15,21 @@ def _dev_resource(resource):
 def _resource(resource):
     return boto3.resource(resource.value)
 
+def _dev_client(resource):
+    return boto3.client(resource.value, endpoint_url=LOCALSTACK_URL)
+
+def _client(resource):
+    return boto3.client(resource.value)
+
 aws_resource = {
     'dev': _dev_resource,
     'sandbox': _resource,
     'production': _resource
 }
+
+# for services without a boto3 resource, e.g. Lambda
+aws_client = {
+    'dev': _dev_client,
+    'sandbox': _client,
+    'production': _client
+}
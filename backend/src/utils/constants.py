@@ -17,9 +17,13 @@ DB_JSON_PAPERS = f'{SNAKE_CASE_PREFIX}_json_papers'
 DB_FEEDBACK = f'{SNAKE_CASE_PREFIX}_feedback'
 DB_GUEST_USERS = f'{SNAKE_CASE_PREFIX}_guest_users'
 DB_DISCORD_USERS = f'{SNAKE_CASE_PREFIX}_discord_users'
+DB_ANSWER_CACHE = f'{SNAKE_CASE_PREFIX}_answer_cache'
 
 ASK_PAPER_BANNER_IMG = "https://hippoai-assets.s3.eu-central-1.amazonaws.com/askpaperbanner.png"
 
+# events of invocations that are not HTTP requests are posted there by the Lambda web adapter
+LAMBDA_EVENTS_PATH = os.getenv("AWS_LWA_PASS_THROUGH_PATH", "/events")
+
 UNAUTHENTICATED_ENDPOINTS = [
     '/health',
     '/test',
@@ -27,6 +31,7 @@ UNAUTHENTICATED_ENDPOINTS = [
     '/user-remaining-requests-count',
     '/send-instructions-email',
     '/send-answer-email',
+    LAMBDA_EVENTS_PATH,
 ]
 CONTENT_ENDPOINTS = ['/ask-paper', '/ask-context']
 
@@ -36,11 +41,51 @@ ENVIRONMENT = os.getenv("ENVIRONMENT", 'dev')
 LOCALSTACK_URL = os.getenv("LOCALSTACK_URL", 'http://localhost:4566')
 S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME', f'{KEBAB_CASE_PREFIX}-papers-{ENVIRONMENT}')
 FILESYSTEM_BASE = os.getenv('FILESYSTEM_BASE', '.')
+GROBID_URL = os.getenv('GROBID_URL', 'https://kermitt2-grobid.hf.space')
 EMAIL_SENDER = 'alex@hippoai.dev'
 DISCORD_CLIENT_BOT_TOKEN = os.environ["DISCORD_CLIENT_BOT_TOKEN"]
 HIPPOAI_DISCORD_SERVER_ID=os.environ["HIPPOAI_DISCORD_SERVER_ID"]
 DISCORD_WHITELIST_ROLENAME="Ask Paper Pilot"
 MAX_CONTEXTS = 7
 LLM_MAX_TOKENS = 15700
+COMPLETION_TOKENS = 700
+RETRIEVAL_TOP_K = 8
+RETRIEVAL_MAX_CONTEXT_TOKENS = 8000
+# context sizes for which chunk boundaries are precomputed at upload
+CHUNK_PLAN_BUDGETS = [4000, 8000, 14000]
+# "merge" waits for every chunk answer, "progressive" streams the first one and then what the others add
+ASK_REDUCE_MODE = os.getenv("ASK_REDUCE_MODE", "progressive")
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+ANSWER_CACHE_MAX_ENTRIES = 1024
+# size of the JSON of the papers kept in memory, parsed papers take a few times more
+PAPER_CACHE_MAX_BYTES = int(os.getenv("PAPER_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# set to an empty string to disable the on-disk paper cache
+PAPER_DISK_CACHE_DIR = os.getenv("PAPER_DISK_CACHE_DIR", f"{FILESYSTEM_BASE}/paper_cache")
+PAPER_DISK_CACHE_MAX_FILES = 200
+# how long an instance serves its cached copy of a paper before reading it again from S3, so that papers
+# re-converted by `reconvert_papers.py` are picked up
+PAPER_CACHE_TTL_SECONDS = int(os.getenv("PAPER_CACHE_TTL_SECONDS", 15 * 60))
+# how long a worker may convert an uploaded paper before another worker takes over
+PAPER_PROCESSING_LEASE_SECONDS = 300
+# how often a worker waiting for a paper converted elsewhere checks if it's done
+PAPER_PROCESSING_POLL_SECONDS = 2
+# set by the Lambda runtime, upload jobs are run by invoking the function again rather than in the background
+LAMBDA_FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+# sent along with the events the function sends itself, LAMBDA_EVENTS_PATH rejects the ones without it
+LAMBDA_EVENTS_SECRET = os.getenv("LAMBDA_EVENTS_SECRET", "")
+# how long a client can follow the progress of an upload job over server-sent events
+UPLOAD_JOB_EVENTS_MAX_SECONDS = 120
+# processes converting TEI to JSON, 0 to convert in the request thread
+CONVERSION_WORKERS = int(os.getenv("CONVERSION_WORKERS", 2))
+# TEI to JSON converter, "lxml" or "bs4" (the reference converter, same JSON, several times slower)
+TEI_CONVERSION_ENGINE = os.getenv("TEI_CONVERSION_ENGINE", "lxml")
+# TEI this long (theses, long reports) are converted by "lxml-stream", whose memory doesn't grow with the
+# document, 0 to never stream
+TEI_STREAMING_MIN_CHARS = int(os.getenv("TEI_STREAMING_MIN_CHARS", 5_000_000))
+# what the TEI to JSON conversion of stored papers extracts, "full" or "qa" (what asking the paper uses, faster
+# but the stored JSON has no bibliography entries nor cite spans)
+TEI_CONVERSION_PROFILE = os.getenv("TEI_CONVERSION_PROFILE", "full")
 
-NOT_ENOUGH_INFO_ANSWER = "The paper does not contain enough information for answering your question"
\ No newline at end of file
+NOT_ENOUGH_INFO_ANSWER = "The paper does not contain enough information for answering your question"
+NOTHING_TO_ADD_ANSWER = "NOTHING_TO_ADD"
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# required by utils.constants, the tests call no external service
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("DISCORD_CLIENT_BOT_TOKEN", "test")
+os.environ.setdefault("HIPPOAI_DISCORD_SERVER_ID", "0")
+os.environ.setdefault("ASK_PAPER_BYPASS_AUTH_TOKEN", "test")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+
+@pytest.fixture(autouse=True)
+def offline_token_count(monkeypatch):
+    """ tiktoken downloads its encodings on first use, count words instead """
+    import nlp
+    monkeypatch.setattr(nlp, 'count_tokens', lambda text: 0 if text is None else len(text.split()))
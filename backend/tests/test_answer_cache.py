@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import answer_cache
+import nlp
+from answer_cache import (AnswerCache, PaperContentKeys, answer_cache_key, paper_content_key,
+                          stored_paper_key)
+
+
+def make_paper(texts=("Deep networks work.", "We use ImageNet."), sec_nums=("1", "2"), hash="abc") -> nlp.Paper:
+    body_text = [dict(text=text, section=f"Section {i}", sec_num=sec_num, cite_spans=[], ref_spans=[])
+                 for i, (text, sec_num) in enumerate(zip(texts, sec_nums))]
+    return nlp.Paper(abstract="Abstract", title="Title", authors=[], hash=hash, pdf_parse=dict(
+        body_text=body_text, back_matter=[], ref_entries={}))
+
+
+class FakeGateway(object):
+    def __init__(self):
+        self.items = {}
+        self.reads = 0
+
+    def read(self, key_name, key, attributes=None):
+        self.reads += 1
+        return self.items.get(key)
+
+    def write(self, item):
+        self.items[item['id']] = item
+
+
+def make_cache() -> AnswerCache:
+    cache = AnswerCache(max_entries=10, ttl_seconds=60)
+    cache._gateway = FakeGateway()
+    return cache
+
+
+async def stream(*tokens, error=None):
+    for token in tokens:
+        yield token
+    if error is not None:
+        raise error
+
+
+async def collect(generator):
+    return [token async for token in generator]
+
+
+def test_paper_content_key_follows_the_text():
+    paper = make_paper()
+    assert paper_content_key(paper) == paper_content_key(make_paper())
+    assert paper_content_key(paper).startswith("abc:")
+    # same sections, converted again with a different text
+    assert paper_content_key(paper) != paper_content_key(make_paper(texts=("Deep networks work.", "We use COCO.")))
+    assert paper_content_key(paper) != paper_content_key(make_paper(sec_nums=("1", "3")))
+    assert paper_content_key(paper) != paper_content_key(make_paper(hash="def"))
+    assert paper_content_key(paper) != paper_content_key(paper.select_sections([("Section 0", "1")]))
+    assert ":" not in paper_content_key(make_paper(hash=None))
+
+
+def test_stored_paper_key_follows_the_stored_text_and_selection():
+    key = stored_paper_key("abc", "digest", [("Section 0", "1")])
+    assert key.startswith("abc:")
+    assert key == stored_paper_key("abc", "digest", [("Section 0", "1")])
+    assert key != stored_paper_key("abc", "re-converted", [("Section 0", "1")])
+    assert key != stored_paper_key("abc", "digest", [("Section 1", "2")])
+    assert key != stored_paper_key("abc", "digest", None)
+    assert key != stored_paper_key("def", "digest", [("Section 0", "1")])
+
+
+def test_content_keys_of_full_papers_are_memoized_per_hash(monkeypatch):
+    renders = []
+    monkeypatch.setattr(answer_cache, "paper_content_key", lambda paper: renders.append(paper.hash) or "content")
+    content_keys = PaperContentKeys(max_entries=10, ttl_seconds=60)
+    paper = make_paper()
+
+    assert content_keys.get(paper, "{paper json}") == content_keys.get(paper, "{paper json}") == "content"
+    assert renders == ["abc"]
+    # another text sent under the same hash
+    content_keys.get(paper, "{edited paper json}")
+    assert renders == ["abc", "abc"]
+    # nothing to memoize on
+    content_keys.get(make_paper(hash=None), "{paper json}")
+    content_keys.get(make_paper(hash=None), "{paper json}")
+    assert renders == ["abc", "abc", None, None]
+
+
+def test_answer_cache_key_normalizes_the_question():
+    key = answer_cache_key("paper", "What dataset?", "prompt", [])
+    assert key == answer_cache_key("paper", "  what   dataset ", "prompt", [])
+    assert key != answer_cache_key("paper", "What model?", "prompt", [])
+    assert key != answer_cache_key("paper", "What dataset?", "other prompt", [])
+    assert key != answer_cache_key("other paper", "What dataset?", "prompt", [])
+
+
+def test_miss_then_hit_from_memory_and_dynamo():
+    cache = make_cache()
+    assert asyncio.run(cache.get("key")) is None
+
+    assert asyncio.run(collect(cache.record("key", stream("The answer ", "is 42.")))) == ["The answer ", "is 42."]
+    assert asyncio.run(cache.get("key")) == "The answer is 42."
+    assert cache.gateway.items["key"]["answer"] == "The answer is 42."
+
+    # another process, only dynamo has it
+    other = make_cache()
+    other._gateway = cache.gateway
+    reads = cache.gateway.reads
+    assert asyncio.run(other.get("key")) == "The answer is 42."
+    assert asyncio.run(other.get("key")) == "The answer is 42."
+    assert cache.gateway.reads == reads + 1
+
+
+def test_expired_dynamo_item_is_a_miss():
+    cache = make_cache()
+    cache.gateway.items["key"] = {'id': "key", 'answer': "old", 'expires_at': int(time.time()) - 1}
+    assert asyncio.run(cache.get("key")) is None
+
+
+def test_interrupted_or_empty_stream_is_not_cached():
+    cache = make_cache()
+    tokens = []
+
+    async def consume():
+        try:
+            async for token in cache.record("key", stream("The answer ", error=RuntimeError("LLM failed"))):
+                tokens.append(token)
+        except RuntimeError:
+            pass
+
+    asyncio.run(consume())
+    assert tokens == ["The answer "]
+    assert asyncio.run(cache.get("key")) is None
+
+    asyncio.run(collect(cache.record("key", stream(" ", ""))))
+    assert asyncio.run(cache.get("key")) is None
+
+
+def test_replay_renders_like_a_live_answer():
+    answer = "one two three four five six seven"
+    chunks = asyncio.run(collect(make_cache().replay(answer)))
+    assert "".join(chunks) == answer
+    assert len(chunks) == 2
+
+
+def test_dynamo_failures_are_misses(monkeypatch):
+    cache = make_cache()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("throttled")
+
+    monkeypatch.setattr(cache.gateway, "read", fail)
+    monkeypatch.setattr(cache.gateway, "write", fail)
+    asyncio.run(cache.set("key", "answer"))
+    cache.memory = answer_cache.LRUCache(10, 60)
+    assert asyncio.run(cache.get("key")) is None
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import api
+
+PAPER_HASH = "a" * 64
+
+
+class FakeRequest(object):
+    def __init__(self, body):
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    """ Upload jobs run by `/events`, each run recorded instead of converting the paper """
+    runs = []
+
+    async def run_upload_job(paper_hash, pdf_file_content=None):
+        runs.append(paper_hash)
+
+    monkeypatch.setattr(api, "LAMBDA_EVENTS_SECRET", "event-secret")
+    monkeypatch.setattr(api, "run_upload_job", run_upload_job)
+    return runs
+
+
+@pytest.mark.parametrize("event", [
+    {'upload_job': PAPER_HASH},
+    {'upload_job': PAPER_HASH, 'secret': "guess"},
+    {'upload_job': PAPER_HASH, 'secret': None},
+    {'upload_job': PAPER_HASH, 'secret': "événement"},
+])
+def test_events_without_the_secret_are_rejected(jobs, event):
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(api.lambda_event(FakeRequest(event)))
+    assert error.value.status_code == 403
+    assert jobs == []
+
+
+def test_events_without_a_configured_secret_are_rejected(jobs, monkeypatch):
+    monkeypatch.setattr(api, "LAMBDA_EVENTS_SECRET", "")
+    with pytest.raises(HTTPException):
+        asyncio.run(api.lambda_event(FakeRequest({'upload_job': PAPER_HASH, 'secret': ""})))
+    assert jobs == []
+
+
+def test_event_runs_the_upload_job(jobs):
+    assert asyncio.run(api.lambda_event(FakeRequest({'upload_job': PAPER_HASH, 'secret': "event-secret"}))) == \
+        {'status': 'ok'}
+    assert jobs == [PAPER_HASH]
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(api.lambda_event(FakeRequest({'upload_job': ["not", "a", "hash"], 'secret': "event-secret"})))
+    assert error.value.status_code == 400
+
+
+@pytest.fixture
+def upload_job(monkeypatch):
+    """ An upload job whose marker says whether it can be taken, and the failures recorded on it """
+    job = {'waiting': True, 'failures': [], 'stored_paper': None}
+
+    monkeypatch.setattr(api.papers, "start_upload_job", lambda paper_hash: job['waiting'])
+    monkeypatch.setattr(api.papers, "fail_processing", lambda paper_hash, error: job['failures'].append(error))
+    monkeypatch.setattr(api.papers.paper_store, "get_json", lambda paper_hash: job['stored_paper'])
+
+    class Gateway(object):
+        def __init__(self, table_name):
+            pass
+
+        def read(self, key_name, key_value, attributes=None):
+            return {'id': key_value, 'email': "a@b.c", 'pdf_file_name': "paper.pdf"}
+
+    monkeypatch.setattr(api, "DynamoDBGateway", Gateway)
+    return job
+
+
+def test_job_that_is_not_waiting_is_not_run_or_failed(upload_job, monkeypatch):
+    upload_job['waiting'] = False
+    monkeypatch.setattr(api, "convert_and_store_paper", lambda *args: pytest.fail("converted"))
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(api.run_upload_job(PAPER_HASH, b"%PDF"))
+    assert upload_job['failures'] == []
+
+    upload_job['stored_paper'] = {'title': "Paper"}
+    assert asyncio.run(api.run_upload_job(PAPER_HASH, b"%PDF")) == {'title': "Paper"}
+
+
+def test_taken_job_is_converted_and_its_failure_recorded(upload_job, monkeypatch):
+    conversions = []
+
+    def convert_and_store_paper(pdf_file_content, pdf_file_name, paper_hash, email, with_header):
+        conversions.append((pdf_file_name, email))
+        if len(conversions) > 1:
+            raise RuntimeError("Grobid failed")
+        return {'title': "Paper"}
+
+    monkeypatch.setattr(api, "convert_and_store_paper", convert_and_store_paper)
+
+    assert asyncio.run(api.run_upload_job(PAPER_HASH, b"%PDF")) == {'title': "Paper"}
+    assert conversions == [("paper.pdf", "a@b.c")]
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(api.run_upload_job(PAPER_HASH, b"%PDF"))
+    assert upload_job['failures'] == ["Grobid failed"]
+
+
+def test_paper_id_keeps_dots_of_the_file_name():
+    assert api.paper_id_of("Smith.2021.final.pdf") == "smith.2021.final"
+    assert api.paper_id_of("My Paper.pdf") == "mypaper"
+    assert api.paper_id_of("paper") == "paper"
+
+
+def test_stored_paper_is_keyed_without_rendering_it(monkeypatch):
+    paper = api.nlp.Paper(title="Paper", abstract="Abstract", authors=[], hash=PAPER_HASH, pdf_parse=dict(
+        body_text=[dict(text="Text", section="Intro", sec_num="1", cite_spans=[], ref_spans=[])],
+        back_matter=[], ref_entries={}))
+    monkeypatch.setattr(api.papers.paper_store, "get_with_digest", lambda paper_hash: (paper, "digest"))
+    monkeypatch.setattr(api.answer_cache, "paper_content_key", lambda paper: pytest.fail("rendered"))
+
+    selected, content_key = asyncio.run(api.resolve_paper(
+        {'paper_hash': PAPER_HASH, 'sections': '[["Intro", "1"]]'}))
+
+    assert [block.text for block in selected.pdf_parse.body_text] == ["Text"]
+    assert content_key == api.answer_cache.stored_paper_key(PAPER_HASH, "digest", [("Intro", "1")])
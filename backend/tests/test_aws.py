@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+import aws
+from utils import aws_client
+from utils.constants import LOCALSTACK_URL
+
+
+class FakeLambda(object):
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+
+
+@pytest.mark.parametrize("environment, endpoint_url", [("dev", LOCALSTACK_URL), ("production", None)])
+def test_invoke_lambda_async_uses_the_environment_client(monkeypatch, environment, endpoint_url):
+    fake_lambda = FakeLambda()
+    clients = []
+
+    def client(service, **kwargs):
+        clients.append((service, kwargs.get('endpoint_url')))
+        return fake_lambda
+
+    monkeypatch.setattr(aws_client.boto3, "client", client)
+    monkeypatch.setattr(aws, "ENVIRONMENT", environment)
+
+    aws.invoke_lambda_async("ask-paper", {'job': "abc"})
+
+    assert clients == [("lambda", endpoint_url)]
+    assert fake_lambda.invocations == [
+        {'FunctionName': "ask-paper", 'InvocationType': "Event", 'Payload': json.dumps({'job': "abc"}).encode()}]
@@ -0,0 +1,69 @@
+import operator
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from doc2json.conversion_pool import ConversionPool
+
+
+def test_no_workers_converts_in_calling_thread():
+    pool = ConversionPool(max_workers=0)
+    threads = []
+
+    def convert(a, b):
+        threads.append(threading.current_thread())
+        return a + b
+
+    # not picklable, which only works without worker processes
+    assert pool.convert(convert, 1, b=2) == 3
+    assert threads == [threading.current_thread()]
+    assert pool._executor is None
+    metrics = pool.metrics()
+    assert metrics['workers'] == 0
+    assert metrics['completed'] == 1
+    assert metrics['in_flight'] == 0
+
+
+def test_no_workers_raises_conversion_error():
+    pool = ConversionPool(max_workers=0)
+
+    def convert():
+        raise ValueError("invalid TEI")
+
+    with pytest.raises(ValueError):
+        pool.convert(convert)
+    assert pool.metrics()['failed'] == 1
+
+
+def test_no_process_pool_falls_back_to_calling_thread(monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise OSError("no /dev/shm")
+
+    monkeypatch.setattr("doc2json.conversion_pool.ProcessPoolExecutor", no_pool)
+    pool = ConversionPool(max_workers=2)
+    assert pool.convert(operator.add, 1, 2) == 3
+    assert pool.metrics()['workers'] == 0
+
+
+def test_broken_pool_is_replaced():
+    pool = ConversionPool(max_workers=1)
+    try:
+        assert pool.convert(operator.add, 1, 2) == 3
+        broken = pool._executor
+
+        # the worker dies, as when it runs out of memory
+        with pytest.raises(BrokenProcessPool):
+            pool.convert(os._exit, 1)
+        assert pool._executor is None
+        assert pool.metrics()['pools_broken'] == 1
+
+        assert pool.convert(operator.add, 2, 3) == 5
+        assert pool._executor is not None and pool._executor is not broken
+        metrics = pool.metrics()
+        assert metrics['completed'] == 2
+        assert metrics['failed'] == 1
+        assert metrics['in_flight'] == 0
+    finally:
+        pool.shutdown()
@@ -0,0 +1,74 @@
+"""
+The TEI to JSON engines give the same JSON, byte for byte, with every profile. The TEI fixtures are converted
+as they are. Every PDF fixture of the end to end tests has its TEI in fixtures/tei/pdf, written with the --save-tei
+option of engine_parity, and is also sent to the Grobid server of PARITY_GROBID_URL when it is set.
+"""
+import glob
+import json
+import os
+
+import pytest
+
+from doc2json.grobid2json import engine_parity, tei_to_json
+from doc2json.grobid2json.engine_parity import compare_engines, read_tei
+from doc2json.grobid2json.process_pdf import ENGINES, PROFILES
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TEI_FIXTURES = sorted(glob.glob(os.path.join(FIXTURES_DIR, 'tei', '*.tei.xml')))
+PDF_FIXTURES = sorted(glob.glob(os.path.join(FIXTURES_DIR, '..', '..', '..', 'tests', 'e2e', 'tests', 'fixtures', '*.pdf')))
+PDF_TEI_DIR = os.path.join(FIXTURES_DIR, 'tei', 'pdf')
+GROBID_URL = os.getenv("PARITY_GROBID_URL")
+
+
+@pytest.fixture(autouse=True)
+def verify_spans(monkeypatch):
+    monkeypatch.setattr(tei_to_json, 'VERIFY_SPANS', True)
+
+
+def assert_parity(name: str, tei_text: str, profile: str):
+    result = compare_engines(name, tei_text, ENGINES, profile)
+    assert set(result.results) == set(ENGINES)
+    assert result.difference is None, result.difference
+
+
+@pytest.mark.parametrize('profile', PROFILES)
+@pytest.mark.parametrize('tei_file', TEI_FIXTURES, ids=os.path.basename)
+def test_tei_fixtures(tei_file, profile):
+    with open(tei_file, 'r', encoding='utf8') as f:
+        assert_parity(tei_file, f.read(), profile)
+
+
+@pytest.mark.parametrize('profile', PROFILES)
+@pytest.mark.parametrize('pdf_file', PDF_FIXTURES, ids=os.path.basename)
+def test_pdf_fixtures_tei(pdf_file, profile):
+    tei_file = os.path.join(PDF_TEI_DIR, os.path.splitext(os.path.basename(pdf_file))[0] + '.tei.xml')
+    assert os.path.exists(tei_file), f"no TEI for {pdf_file}, write it with engine_parity --save-tei"
+    assert_parity(tei_file, read_tei(tei_file), profile)
+
+
+@pytest.mark.skipif(not GROBID_URL, reason="PARITY_GROBID_URL is not set")
+@pytest.mark.parametrize('profile', PROFILES)
+@pytest.mark.parametrize('pdf_file', PDF_FIXTURES, ids=os.path.basename)
+def test_pdf_fixtures(pdf_file, profile):
+    assert_parity(pdf_file, read_tei(pdf_file, {'grobid_url': GROBID_URL}), profile)
+
+
+def test_fixtures_exist():
+    assert len(TEI_FIXTURES) >= 2
+    assert PDF_FIXTURES
+
+
+def test_an_engine_raising_is_a_failure():
+    # every engine raises on a TEI without fileDesc, which must not count as parity
+    result = compare_engines('broken', '<TEI xmlns="http://www.tei-c.org/ns/1.0"><text/></TEI>')
+    assert result.difference is not None
+    assert all(f"{engine} raised" in result.difference for engine in ENGINES)
+
+
+def test_a_different_output_is_a_failure(monkeypatch):
+    def convert(tei_text, paper_id, sha, engine, profile):
+        return {'header': {}, 'title': engine}
+
+    monkeypatch.setattr(engine_parity, 'convert_tei_text', convert)
+    result = compare_engines('fake', '<TEI/>', ENGINES)
+    assert result.difference == f"{ENGINES[1]}: /title: {json.dumps(ENGINES[0])} != {json.dumps(ENGINES[1])}"
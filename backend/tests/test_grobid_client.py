@@ -0,0 +1,106 @@
+import threading
+
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.grobid2json.grobid.retry import CircuitBreaker, CircuitOpenError
+
+TEI = '<TEI xmlns="http://www.tei-c.org/ns/1.0"/>'
+
+
+class FakeResponse(object):
+    text = TEI
+
+
+class BurstyGrobid(object):
+    """ Answers 503 to the first `saturated_calls` calls, then processes every PDF """
+
+    def __init__(self, saturated_calls: int):
+        self.saturated_calls = saturated_calls
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def post(self, **kwargs):
+        with self._lock:
+            self.calls += 1
+            saturated = self.calls <= self.saturated_calls
+        return FakeResponse(), 503 if saturated else 200
+
+
+def make_client(grobid: BurstyGrobid, **config) -> GrobidClient:
+    client = GrobidClient({
+        "max_workers": 4,
+        "sleep_time": 0.001,
+        "retry_max_delay": 0.001,
+        "max_attempts": 2,
+        "circuit_failure_threshold": 3,
+        "circuit_reset_timeout": 0.05,
+        "report_every": 1000,
+        **config,
+    })
+    client.post = grobid.post
+    return client
+
+
+def write_pdfs(directory, count: int):
+    pdf_files = []
+    for i in range(count):
+        pdf_file = directory / f"paper{i}.pdf"
+        pdf_file.write_bytes(b"%PDF-1.4 " + str(i).encode())
+        pdf_files.append(str(pdf_file))
+    return pdf_files
+
+
+def test_503_burst_waits_for_the_circuit_instead_of_failing_pdfs(tmp_path):
+    grobid = BurstyGrobid(saturated_calls=6)
+    client = make_client(grobid)
+    pdf_files = write_pdfs(tmp_path, 40)
+    results = []
+
+    throughput = client.process_batch(pdf_files, str(tmp_path), "processFulltextDocument", results.append)
+
+    assert client.circuit_breaker.times_opened >= 1
+    assert client.metrics()['circuit_waits'] > 0
+    # only the PDFs whose own calls all got a 503 fail, not the ones rejected by the open circuit
+    failed = [result for result in results if result.tei_file is None]
+    assert throughput.failed == len(failed) <= 3
+    assert len(results) == throughput.done == 40
+    assert all(result.error is None for result in results if result.tei_file is not None)
+
+
+def test_pdfs_fail_when_grobid_stays_down(tmp_path):
+    grobid = BurstyGrobid(saturated_calls=10 ** 9)
+    client = make_client(grobid, max_circuit_waits=3)
+    results = []
+
+    throughput = client.process_batch(write_pdfs(tmp_path, 8), str(tmp_path), "processFulltextDocument",
+                                      results.append)
+
+    assert throughput.failed == len(results) == 8
+    assert all(result.tei_file is None and result.error for result in results)
+    assert client.metrics()['circuit_gave_up'] > 0
+    assert any("circuit still open" in result.error for result in results)
+
+    # bounded by the retry deadline as well
+    client = make_client(grobid, max_circuit_waits=10 ** 9, retry_deadline=0.2)
+    results = []
+    client.process_batch(write_pdfs(tmp_path, 4), str(tmp_path), "processFulltextDocument", results.append)
+    assert len(results) == 4 and all(result.error for result in results)
+
+
+def test_circuit_retry_after():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    assert breaker.retry_after() == 0
+    breaker.record_failure()
+    assert 9 < breaker.retry_after() <= 10
+    try:
+        breaker.before_call()
+        assert False, "the open circuit let a call through"
+    except CircuitOpenError:
+        pass
+
+    breaker.opened_at -= 10
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # the trial call runs, the other workers poll
+    assert 0 < breaker.retry_after() <= 1
+    breaker.record_success()
+    assert breaker.retry_after() == 0
@@ -0,0 +1,164 @@
+import os
+
+import pytest
+
+from doc2json.grobid2json import process_pdf
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient, tei_file_path
+from doc2json.grobid2json.manifest import STAGE_GROBID, STAGE_JSON, STAGE_TEI, Manifest, file_sha256
+
+TEI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "tei", "fracnet.tei.xml")
+
+
+def test_manifest_records_stages_and_failures(tmp_path):
+    manifest = Manifest(str(tmp_path / "manifest.sqlite"))
+    manifest.start("a.pdf", "sha-a")
+    manifest.tei_done("a.pdf", 2.5)
+    manifest.json_done("a.pdf", 0.5)
+    manifest.start("b.pdf", "sha-b")
+    manifest.failed("b.pdf", "Grobid failed")
+    manifest.start("c.pdf", "sha-c")
+    manifest.tei_done("c.pdf", 1.0)
+    manifest.close()
+
+    # committed right away, a later run sees it all
+    manifest = Manifest(str(tmp_path / "manifest.sqlite"))
+    entry = manifest.get("a.pdf")
+    assert (entry.sha256, entry.stage, entry.grobid_seconds, entry.convert_seconds, entry.error) == \
+        ("sha-a", STAGE_JSON, 2.5, 0.5, None)
+    assert [entry.path for entry in manifest.failures()] == ["b.pdf"]
+    assert manifest.failures(STAGE_TEI) == []
+    assert manifest.summary() == {STAGE_JSON: 1, f"{STAGE_GROBID}_failed": 1, STAGE_TEI: 1}
+    assert manifest.get("d.pdf") is None
+
+    # starting again clears the previous attempt
+    manifest.start("b.pdf", "sha-b")
+    entry = manifest.get("b.pdf")
+    assert (entry.stage, entry.error) == (STAGE_GROBID, None)
+    manifest.close()
+
+
+class FakeResponse(object):
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FlakyGrobid(object):
+    """ Fails the PDFs named in `failing`, returns the fixture TEI for the others """
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.down = False
+        self.calls = []
+        with open(TEI_FILE, encoding='utf8') as f:
+            self.tei_text = f.read()
+
+    def post(self, files, **kwargs):
+        pdf_name = os.path.basename(files['input'][0])
+        self.calls.append(pdf_name)
+        if self.down:
+            return FakeResponse(""), 503
+        if pdf_name in self.failing:
+            return FakeResponse(""), 500
+        return FakeResponse(self.tei_text), 200
+
+
+@pytest.fixture
+def batch(tmp_path, monkeypatch):
+    input_dir = tmp_path / "pdfs"
+    input_dir.mkdir()
+    for name in ["a", "b", "c"]:
+        (input_dir / f"{name}.pdf").write_bytes(b"%PDF-1.4 " + name.encode())
+    grobid = FlakyGrobid()
+
+    def get_grobid_client(config=None) -> GrobidClient:
+        client = GrobidClient({"max_workers": 2, "max_attempts": 1, "report_every": 1000,
+                               "circuit_failure_threshold": 1, "circuit_reset_timeout": 0.01,
+                               "max_circuit_waits": 2})
+        client.post = grobid.post
+        return client
+
+    monkeypatch.setattr(process_pdf, "get_grobid_client", get_grobid_client)
+
+    def run(retry_failed: bool = False):
+        grobid.calls = []
+        return process_pdf.process_pdf_dir(
+            str(input_dir), str(tmp_path / "temp"), str(tmp_path / "output"), conversion_workers=0,
+            manifest_path=str(tmp_path / "manifest.sqlite"), retry_failed=retry_failed)
+
+    def manifest() -> Manifest:
+        return Manifest(str(tmp_path / "manifest.sqlite"))
+
+    return run, grobid, manifest, tmp_path
+
+
+def test_rerun_resumes_and_skips_failures(batch):
+    run, grobid, manifest, tmp_path = batch
+    grobid.failing = {"b.pdf"}
+
+    run()
+    assert sorted(grobid.calls) == ["a.pdf", "b.pdf", "c.pdf"]
+    assert sorted(os.listdir(tmp_path / "output")) == ["a.json", "c.json"]
+    assert manifest().summary() == {STAGE_JSON: 2, f"{STAGE_GROBID}_failed": 1}
+
+    grobid.failing = set()
+    run()
+    assert grobid.calls == []
+    assert manifest().summary() == {STAGE_JSON: 2, f"{STAGE_GROBID}_failed": 1}
+
+    run(retry_failed=True)
+    assert grobid.calls == ["b.pdf"]
+    assert sorted(os.listdir(tmp_path / "output")) == ["a.json", "b.json", "c.json"]
+    assert manifest().summary() == {STAGE_JSON: 3}
+
+
+def test_rerun_converts_pdfs_interrupted_after_grobid(batch):
+    run, grobid, manifest, tmp_path = batch
+    run()
+
+    # interrupted before the conversion of c
+    os.remove(tmp_path / "output" / "c.json")
+    interrupted = manifest()
+    pdf_file = str(tmp_path / "pdfs" / "c.pdf")
+    interrupted.start(pdf_file, file_sha256(pdf_file))
+    interrupted.tei_done(pdf_file, 1.0)
+    interrupted.close()
+    assert os.path.isfile(tei_file_path(pdf_file, str(tmp_path / "temp")))
+
+    run()
+    assert grobid.calls == []
+    assert os.path.isfile(tmp_path / "output" / "c.json")
+    assert manifest().get(pdf_file).stage == STAGE_JSON
+
+
+def test_pdfs_failed_while_grobid_is_down_are_retried(batch):
+    run, grobid, manifest, tmp_path = batch
+    grobid.down = True
+
+    run()
+    assert not os.path.exists(tmp_path / "output") or os.listdir(tmp_path / "output") == []
+    assert manifest().summary() == {f"{STAGE_GROBID}_failed": 3}
+
+    grobid.down = False
+    run(retry_failed=True)
+    assert sorted(grobid.calls) == ["a.pdf", "b.pdf", "c.pdf"]
+    assert manifest().summary() == {STAGE_JSON: 3}
+
+
+def test_rerun_processes_pdfs_replaced_in_place(batch):
+    run, grobid, manifest, tmp_path = batch
+    grobid.failing = {"b.pdf"}
+    run()
+    pdf_file = str(tmp_path / "pdfs" / "a.pdf")
+    converted_at = os.path.getmtime(tmp_path / "output" / "a.json")
+
+    (tmp_path / "pdfs" / "a.pdf").write_bytes(b"%PDF-1.4 a, second version")
+    (tmp_path / "pdfs" / "b.pdf").write_bytes(b"%PDF-1.4 b, second version")
+    os.utime(tmp_path / "output" / "a.json", (converted_at - 10, converted_at - 10))
+    grobid.failing = set()
+    run()
+
+    # the failed b.pdf is not skipped either, it isn't the PDF that failed anymore
+    assert sorted(grobid.calls) == ["a.pdf", "b.pdf"]
+    assert os.path.getmtime(tmp_path / "output" / "a.json") > converted_at - 10
+    assert manifest().get(pdf_file).stage == STAGE_JSON
+    assert manifest().summary() == {STAGE_JSON: 3}
@@ -0,0 +1,178 @@
+import asyncio
+
+import pytest
+
+import nlp
+from nlp import ChatMessage
+
+
+def make_paper(texts=("Deep networks work.", "We use ImageNet.")) -> nlp.Paper:
+    body_text = [dict(text=text, section=f"Section {i}", sec_num=str(i + 1), cite_spans=[], ref_spans=[])
+                 for i, text in enumerate(texts)]
+    return nlp.Paper(abstract="Abstract", title="Title", authors=[], hash="abc", pdf_parse=dict(
+        body_text=body_text, back_matter=[], ref_entries={}))
+
+
+async def collect(generator):
+    return [token async for token in generator]
+
+
+def test_ask_paper_validates_message_history_once(monkeypatch):
+    validated = []
+    asked = {}
+
+    def validate_message_history(message_history):
+        validated.append(message_history)
+        return message_history[-1:]
+
+    async def ask_contexts(question, contexts, message_history, prompt_override):
+        asked.update(contexts=contexts, message_history=message_history)
+        yield "answer"
+
+    monkeypatch.setattr(nlp, "validate_message_history", validate_message_history)
+    monkeypatch.setattr(nlp, "ask_contexts", ask_contexts)
+    history = [ChatMessage(text="first", sender="user"), ChatMessage(text="last", sender="llm")]
+
+    tokens = asyncio.run(collect(nlp.ask_paper("What dataset?", make_paper(), history)))
+
+    assert tokens == ["answer"]
+    assert validated == [history]
+    # the contexts were sized for the history that is sent along
+    assert asked['message_history'] == history[-1:]
+    assert "ImageNet" in asked['contexts'][0]
+
+
+def test_pack_boundaries():
+    # units of 3, 3, 10 and 2 tokens
+    prefix_sums = [0, 3, 6, 16, 18]
+    assert nlp.pack_boundaries(prefix_sums, 8) == [0, 2, 3, 4]
+    assert nlp.pack_boundaries(prefix_sums, 100) == [0, 4]
+    assert nlp.pack_boundaries([0], 8) == [0]
+
+
+def test_chunk_plan_reuses_standard_budgets():
+    units = [(f"body_text:{i}", " ".join(["word"] * 1000)) for i in range(20)]
+    chunk_plan = nlp.ChunkPlan.build(units)
+
+    assert chunk_plan.total_tokens(units) == 20000
+    assert chunk_plan.chunk_boundaries(units, 8500) is chunk_plan.boundaries[8000]
+    assert chunk_plan.chunk_boundaries(units, 8000) == list(range(0, 21, 8)) + [20]
+    # too far from the closest standard budget, packed on the fly
+    assert chunk_plan.chunk_boundaries(units, 5000) == list(range(0, 21, 5))
+
+
+def test_chunk_plan_of_filtered_units(monkeypatch):
+    units = [("title", "# Title"), ("body_text:a", "one two three"), ("body_text:b", "four five")]
+    chunk_plan = nlp.ChunkPlan.build(units)
+    monkeypatch.setattr(nlp, "count_tokens", lambda text: pytest.fail("tokenized again"))
+
+    filtered = [units[0], units[2]]
+    assert chunk_plan.unit_tokens(filtered) == [2, 2]
+    assert chunk_plan.total_tokens(filtered) == 4
+    assert chunk_plan.split(filtered, 3) == ["# Title", "four five"]
+    assert chunk_plan.split(units, 100) == [nlp.render_units(units)]
+
+
+def test_chunk_plan_splits_oversized_unit(monkeypatch):
+    monkeypatch.setattr(nlp, "split_text", lambda text, chunk_size: [text[:9], text[10:]])
+    units = [("title", "# Title"), ("body_text:a", "one two three four five six")]
+
+    contexts = nlp.ChunkPlan.build(units).split(units, 4)
+
+    assert contexts == ["# Title", "one two t", "ree four five six"]
+
+
+def make_long_paper() -> nlp.Paper:
+    texts = [f"Filler paragraph number {i} about unrelated matters." for i in range(30)]
+    texts[12] = "We train on the FracNet dataset."
+    return make_paper(texts=texts)
+
+
+def test_select_paper_blocks_fits_the_best_blocks():
+    paper = make_long_paper()
+    chunk_plan = nlp.ChunkPlan.build(paper.context_units())
+    dataset_key = nlp.block_key("body_text", paper.pdf_parse.body_text[12])
+
+    assert nlp.select_paper_blocks("Which dataset?", paper, chunk_plan, 50) == {dataset_key}
+    assert nlp.select_paper_blocks("Which language?", paper, chunk_plan, 50) is None
+    # not even the best block fits
+    assert nlp.select_paper_blocks("Which dataset?", paper, chunk_plan, 5) is None
+
+
+def test_paper_contexts_uses_retrieval_when_the_paper_does_not_fit(monkeypatch):
+    paper = make_long_paper()
+    total_tokens = nlp.ChunkPlan.build(paper.context_units()).total_tokens(paper.context_units())
+
+    monkeypatch.setattr(nlp, "context_budget", lambda prompt, question, message_history: total_tokens)
+    contexts, _ = nlp.paper_contexts("Which dataset?", paper)
+    assert contexts == [paper.to_text()]
+
+    monkeypatch.setattr(nlp, "context_budget", lambda prompt, question, message_history: 50)
+    contexts, _ = nlp.paper_contexts("Which dataset?", paper)
+    assert len(contexts) == 1
+    assert "FracNet" in contexts[0] and "Filler" not in contexts[0]
+
+
+def test_is_informative_answer():
+    assert nlp.is_informative_answer("The model is trained on FracNet.")
+    assert not nlp.is_informative_answer("  ")
+    assert not nlp.is_informative_answer(nlp.NOT_ENOUGH_INFO_ANSWER + ".")
+    assert not nlp.is_informative_answer("The context does not provide enough information about the dataset.")
+    assert nlp.is_informative_answer("The paper does not mention the batch size. " + "It trains on FracNet. " * 20)
+
+
+def chunk_answers(*answers):
+    """ Tasks answering in the given order, each a (position, answer) pair """
+    async def answer(position, delay, text):
+        await asyncio.sleep(delay)
+        return position, text
+
+    return [asyncio.ensure_future(answer(position, position * 0.01, text)) for position, text in enumerate(answers)]
+
+
+def reduce(monkeypatch, answers, followup=()):
+    followup_prompts = []
+
+    async def ask_text_stream_buffered(text, message_history=[], stream=True, completion_tokens=None):
+        followup_prompts.append(text)
+        for tokens in followup:
+            yield tokens
+
+    monkeypatch.setattr(nlp, "ask_text_stream_buffered", ask_text_stream_buffered)
+
+    async def run():
+        return await collect(nlp.progressive_reduce("Which dataset?", chunk_answers(*answers)))
+
+    return asyncio.run(run()), followup_prompts
+
+
+def test_progressive_reduce_streams_first_informative_answer(monkeypatch):
+    tokens, prompts = reduce(monkeypatch, [nlp.NOT_ENOUGH_INFO_ANSWER, "FracNet.", "Also ImageNet."],
+                             followup=["It is also", " pretrained on ImageNet."])
+
+    assert tokens == ["FracNet.", "\n\nIt is also pretrained on ImageNet."]
+    assert "Also ImageNet." in prompts[0] and nlp.NOT_ENOUGH_INFO_ANSWER not in prompts[0]
+
+
+def test_progressive_reduce_drops_nothing_to_add(monkeypatch):
+    tokens, _ = reduce(monkeypatch, ["FracNet.", "FracNet too."], followup=["NOTHING_", "TO_ADD", "."])
+    assert tokens == ["FracNet."]
+
+    # streamed in small tokens, only held back until it can't be the marker
+    tokens, _ = reduce(monkeypatch, ["FracNet.", "ImageNet."], followup=["Also", " pretrained", " on", " ImageNet."])
+    assert tokens == ["FracNet.", "\n\nAlso pretrained", " on", " ImageNet."]
+
+    # shorter than the marker
+    tokens, _ = reduce(monkeypatch, ["FracNet.", "ImageNet."], followup=["Also", " COCO."])
+    assert tokens == ["FracNet.", "\n\nAlso COCO."]
+
+
+def test_progressive_reduce_without_informative_answers(monkeypatch):
+    tokens, prompts = reduce(monkeypatch, [nlp.NOT_ENOUGH_INFO_ANSWER, nlp.NOT_ENOUGH_INFO_ANSWER])
+    assert tokens == [nlp.NOT_ENOUGH_INFO_ANSWER]
+    assert prompts == []
+
+    # nothing to add to the only informative answer, no followup call
+    tokens, prompts = reduce(monkeypatch, ["FracNet.", nlp.NOT_ENOUGH_INFO_ANSWER])
+    assert tokens == ["FracNet."]
+    assert prompts == []
@@ -0,0 +1,285 @@
+import json
+import os
+import time
+from typing import Tuple
+
+import pytest
+from botocore.exceptions import ClientError
+
+import papers
+from database.db import DynamoDBGateway
+from doc2json.grobid2json.process_pdf import ENGINE_LXML, ENGINE_LXML_STREAM
+from papers import PaperStore
+
+PAPER_HASH = "a" * 64
+
+
+def json_paper(title: str) -> dict:
+    return {'title': title, 'abstract': "", 'authors': [],
+            'pdf_parse': {'body_text': [], 'back_matter': [], 'ref_entries': {}}}
+
+
+class FakeSource(object):
+    """ The stored JSON of the papers, in place of DynamoDB and S3 """
+
+    def __init__(self):
+        self.papers = {}
+        self.reads = 0
+
+    def read(self, paper_hash: str):
+        self.reads += 1
+        paper = self.papers.get(paper_hash)
+        return json.dumps(paper) if paper is not None else None
+
+
+def make_store(tmp_path, **kwargs) -> Tuple[PaperStore, FakeSource]:
+    store = PaperStore(disk_cache_dir=str(tmp_path / "papers"), **kwargs)
+    source = FakeSource()
+    store._read_from_source = source.read
+    return store, source
+
+
+def age(path: str, seconds: float):
+    written_at = os.path.getmtime(path) - seconds
+    os.utime(path, (written_at, written_at))
+
+
+def test_tiers(tmp_path):
+    store, source = make_store(tmp_path)
+    source.papers[PAPER_HASH] = json_paper("First")
+
+    assert store.get(PAPER_HASH).title == "First"
+    assert store.get(PAPER_HASH).hash == PAPER_HASH
+    assert store.stats['source_hits'] == store.stats['memory_hits'] == 1
+
+    # restarted instance, same disk
+    restarted, restarted_source = make_store(tmp_path)
+    assert restarted.get_json(PAPER_HASH)['title'] == "First"
+    assert restarted.stats['disk_hits'] == 1 and restarted_source.reads == 0
+
+    assert store.get("not a hash") is None
+    assert store.get("b" * 64) is None and store.stats['misses'] == 1
+
+
+def test_stale_copies_are_read_again(tmp_path):
+    store, source = make_store(tmp_path, ttl_seconds=60)
+    source.papers[PAPER_HASH] = json_paper("First")
+    store.get(PAPER_HASH)
+
+    # re-converted by another process
+    source.papers[PAPER_HASH] = json_paper("Second")
+    assert store.get(PAPER_HASH).title == "First"
+
+    store._entries[PAPER_HASH].cached_at -= 61
+    age(store._disk_path(PAPER_HASH), 61)
+    assert store.get(PAPER_HASH).title == "Second"
+    assert store.stats['expired'] == 1 and source.reads == 2
+    assert store.get(PAPER_HASH).title == "Second" and source.reads == 2
+
+
+def test_stale_disk_copy_is_read_again(tmp_path):
+    store, source = make_store(tmp_path, ttl_seconds=60)
+    source.papers[PAPER_HASH] = json_paper("First")
+    store.get(PAPER_HASH)
+    source.papers[PAPER_HASH] = json_paper("Second")
+    age(store._disk_path(PAPER_HASH), 61)
+
+    restarted, restarted_source = make_store(tmp_path, ttl_seconds=60)
+    restarted_source.papers = source.papers
+    assert restarted.get(PAPER_HASH).title == "Second"
+    assert restarted.stats['source_hits'] == 1
+
+
+def test_invalidate(tmp_path):
+    store, source = make_store(tmp_path)
+    source.papers[PAPER_HASH] = json_paper("First")
+    store.get(PAPER_HASH)
+    source.papers[PAPER_HASH] = json_paper("Second")
+
+    _, first_digest = store.get_with_digest(PAPER_HASH)
+
+    store.invalidate(PAPER_HASH)
+    assert not os.path.exists(store._disk_path(PAPER_HASH))
+    assert store.get(PAPER_HASH).title == "Second"
+    # the re-converted paper doesn't share the answers of the first one
+    assert store.get_with_digest(PAPER_HASH)[1] != first_digest
+    assert store.get_with_digest("b" * 64) == (None, None)
+    # nothing cached
+    store.invalidate("b" * 64)
+
+
+def test_memory_is_bounded_by_json_size(tmp_path):
+    store, source = make_store(tmp_path)
+    hashes = [str(i) * 64 for i in range(1, 4)]
+    for i, paper_hash in enumerate(hashes):
+        source.papers[paper_hash] = json_paper(f"Paper {i}")
+    store.max_bytes = len(json.dumps(json_paper("Paper 0"))) * 2
+
+    for paper_hash in hashes:
+        store.get(paper_hash)
+    assert list(store._entries) == hashes[1:]
+    assert store.stats['evictions'] == 1
+
+
+def test_tei_conversion_engine(monkeypatch):
+    assert papers.tei_conversion_engine("<TEI/>") == ENGINE_LXML
+    monkeypatch.setattr(papers, 'TEI_STREAMING_MIN_CHARS', 10)
+    assert papers.tei_conversion_engine("<TEI>" + " " * 10 + "</TEI>") == ENGINE_LXML_STREAM
+
+
+def condition_holds(condition: str, item: dict, values: dict, names: dict) -> bool:
+    """ The DynamoDB conditions the processing markers are written with """
+    if " AND " in condition:
+        return all(condition_holds(term, item, values, names) for term in condition.split(" AND "))
+    for term in condition.split(" OR "):
+        if term.startswith("attribute_exists("):
+            holds = term[len("attribute_exists("):-1] in item
+        elif term.startswith("attribute_not_exists("):
+            holds = term[len("attribute_not_exists("):-1] not in item
+        else:
+            attribute, operator, value = term.split()
+            attribute = names.get(attribute, attribute)
+            if operator == "=":
+                holds = item.get(attribute) == values[value]
+            else:
+                assert operator == "<"
+                holds = attribute in item and item[attribute] < values[value]
+        if holds:
+            return True
+    return False
+
+
+class FakeTable(object):
+    """ DynamoDB table keyed by id, in place of DB_JSON_PAPERS """
+    name = "papers"
+
+    def __init__(self):
+        self.items = {}
+        self.error = None
+
+    def _check(self, operation: str, item: dict, condition: str, values: dict, names: dict):
+        if self.error is not None:
+            raise ClientError({'Error': {'Code': self.error, 'Message': self.error}}, operation)
+        if not condition_holds(condition, item, values, names):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ""}}, operation)
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeValues=None):
+        self._check('PutItem', self.items.get(Item['id'], {}), ConditionExpression, ExpressionAttributeValues or {}, {})
+        self.items[Item['id']] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                    ConditionExpression):
+        item = self.items.get(Key['id'], {})
+        self._check('UpdateItem', item, ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames)
+        for name, attribute in ExpressionAttributeNames.items():
+            item[attribute] = ExpressionAttributeValues[f":{name[1:]}"]
+        self.items[Key['id']] = item
+
+    def get_item(self, Key, **projection):
+        item = self.items.get(Key['id'])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def query(self, **kwargs):
+        return {'Items': []}
+
+
+@pytest.fixture
+def papers_table(monkeypatch) -> FakeTable:
+    table = FakeTable()
+
+    def gateway(table_name: str) -> DynamoDBGateway:
+        gateway = DynamoDBGateway.__new__(DynamoDBGateway)
+        gateway.table_name = table_name
+        gateway.table = table
+        return gateway
+
+    monkeypatch.setattr(papers, 'DynamoDBGateway', gateway)
+    return table
+
+
+def expire_lease(table: FakeTable, paper_hash: str):
+    table.items[paper_hash]['processing_until'] = int(time.time()) - 1
+
+
+def test_claim_is_exclusive_until_the_lease_expires(papers_table):
+    assert papers.claim_processing(PAPER_HASH, {'file_name': "paper.pdf"})
+    assert not papers.claim_processing(PAPER_HASH)
+
+    # the worker holding the lease died
+    expire_lease(papers_table, PAPER_HASH)
+    assert papers.claim_processing(PAPER_HASH)
+    assert papers_table.items[PAPER_HASH]['processing_until'] > time.time()
+    assert not papers.claim_processing(PAPER_HASH)
+
+
+def test_processing_stages(papers_table):
+    assert papers.claim_processing(PAPER_HASH)
+    assert papers.processing_status(PAPER_HASH) == {'stage': papers.STAGE_QUEUED, 'header': False}
+    papers.set_processing_stage(PAPER_HASH, papers.STAGE_GROBID_DONE)
+    assert papers.processing_status(PAPER_HASH) == {'stage': papers.STAGE_GROBID_DONE, 'header': False}
+
+    expire_lease(papers_table, PAPER_HASH)
+    assert papers.processing_status(PAPER_HASH) == {'stage': papers.STAGE_FAILED, 'error': "Processing timed out"}
+    # taken over from the start
+    assert papers.claim_processing(PAPER_HASH)
+    assert papers_table.items[PAPER_HASH]['stage'] == papers.STAGE_QUEUED
+
+
+def test_failed_conversion_releases_the_lease(papers_table):
+    assert papers.claim_processing(PAPER_HASH)
+
+    papers.fail_processing(PAPER_HASH, "Grobid failed")
+
+    assert papers.processing_status(PAPER_HASH) == {
+        'stage': papers.STAGE_FAILED, 'error': "Grobid failed", 'header': False}
+    assert papers.claim_processing(PAPER_HASH)
+
+
+def stored_paper(table: FakeTable) -> dict:
+    table.items[PAPER_HASH] = {'id': PAPER_HASH, 'paper_s3_key': papers.paper_s3_key(PAPER_HASH)}
+    return dict(table.items[PAPER_HASH])
+
+
+def test_stored_paper_is_not_claimed(papers_table):
+    item = stored_paper(papers_table)
+    assert not papers.claim_processing(PAPER_HASH)
+    assert papers_table.items[PAPER_HASH] == item
+
+
+def test_stored_paper_is_not_marked(papers_table):
+    item = stored_paper(papers_table)
+    papers.set_processing_stage(PAPER_HASH, papers.STAGE_PARSED)
+    papers.fail_processing(PAPER_HASH, "late failure")
+
+    assert papers_table.items[PAPER_HASH] == item
+    assert papers.processing_status(PAPER_HASH) == {'stage': papers.STAGE_DONE}
+    assert papers.processing_status("b" * 64) is None
+
+
+def test_claim_when_dynamo_fails(papers_table):
+    papers_table.error = 'ProvisionedThroughputExceededException'
+    # better converting the paper twice than not at all
+    assert papers.claim_processing(PAPER_HASH)
+
+
+def test_upload_job_is_taken_once(papers_table):
+    assert papers.claim_processing(PAPER_HASH, {'email': "a@b.c", 'pdf_file_name': "paper.pdf"})
+    # not stored yet
+    assert not papers.start_upload_job(PAPER_HASH)
+    papers.set_processing_stage(PAPER_HASH, papers.STAGE_STORED)
+    expire_lease(papers_table, PAPER_HASH)
+
+    assert papers.start_upload_job(PAPER_HASH)
+    assert papers_table.items[PAPER_HASH]['stage'] == papers.STAGE_RUNNING
+    assert papers_table.items[PAPER_HASH]['processing_until'] > time.time()
+    # delivered again
+    assert not papers.start_upload_job(PAPER_HASH)
+
+
+def test_upload_paper_conversions_are_not_jobs(papers_table):
+    assert papers.claim_processing(PAPER_HASH)
+    papers.set_processing_stage(PAPER_HASH, papers.STAGE_RUNNING)
+    assert not papers.start_upload_job(PAPER_HASH)
+
+    stored_paper(papers_table)
+    assert not papers.start_upload_job(PAPER_HASH)
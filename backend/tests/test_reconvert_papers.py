@@ -0,0 +1,74 @@
+import json
+import os
+
+import papers
+import pytest
+import retrieval
+from doc2json.grobid2json.process_pdf import PROFILE_QA, convert_tei_text
+from reconvert_papers import STATUS_NO_TEI, STATUS_UNCHANGED, STATUS_UPDATED, paper_diff, reconvert_paper
+
+PAPER_HASH = "c" * 64
+TEI_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'tei', 'fracnet.tei.xml')
+
+
+@pytest.fixture
+def tei_text():
+    with open(TEI_FILE, 'r', encoding='utf8') as f:
+        return f.read()
+
+
+@pytest.fixture
+def stored(monkeypatch, tei_text):
+    """ TEI cache and stored JSON of the papers, in place of S3 """
+    teis, jsons = {'tei_key': tei_text}, {}
+    monkeypatch.setattr(papers.tei_cache, 'get', teis.get)
+    monkeypatch.setattr(papers, 'store_paper_json', lambda paper_hash, paper_json: (
+        jsons.__setitem__(paper_hash, json.loads(paper_json)) or {'paper_s3_key': f"papers/{paper_hash}.json.gz"}))
+    monkeypatch.setattr(retrieval, 'store_paper_index', lambda paper_hash, index: None)
+    return jsons
+
+
+def item_of(json_paper: dict) -> dict:
+    return {'id': PAPER_HASH, 'paper_json': json.dumps(json_paper), 'email': 'a@b.c'}
+
+
+def test_unchanged_paper_is_not_rewritten(stored, tei_text):
+    old_paper = convert_tei_text(tei_text, 'fracnet', PAPER_HASH)
+    result = reconvert_paper(item_of(old_paper), 'tei_key', dry_run=False, grobid_missing=False)
+    assert result.status == STATUS_UNCHANGED and result.item is None and not stored
+
+
+def test_changed_paper_keeps_its_bibliography_by_default(stored, tei_text):
+    old_paper = convert_tei_text(tei_text, 'fracnet', PAPER_HASH)
+    old_paper['title'] = "Old title"
+
+    assert reconvert_paper(item_of(old_paper), 'tei_key', dry_run=True, grobid_missing=False).item is None
+    result = reconvert_paper(item_of(old_paper), 'tei_key', dry_run=False, grobid_missing=False)
+    assert result.status == STATUS_UPDATED
+    assert result.diff[0].startswith("title:")
+    assert result.item['email'] == 'a@b.c' and 'paper_json' not in result.item
+    assert stored[PAPER_HASH]['pdf_parse']['bib_entries']
+    assert any(paragraph['cite_spans'] for paragraph in stored[PAPER_HASH]['pdf_parse']['body_text'])
+
+
+def test_qa_profile_is_explicit(stored, tei_text):
+    old_paper = convert_tei_text(tei_text, 'fracnet', PAPER_HASH)
+    result = reconvert_paper(item_of(old_paper), 'tei_key', dry_run=False, grobid_missing=False, profile=PROFILE_QA)
+    assert result.status == STATUS_UPDATED
+    assert stored[PAPER_HASH]['pdf_parse']['bib_entries'] == {}
+
+
+def test_paper_without_tei(stored, tei_text):
+    old_paper = convert_tei_text(tei_text, 'fracnet', PAPER_HASH)
+    assert reconvert_paper(item_of(old_paper), 'other_key', False, False).status == STATUS_NO_TEI
+
+
+def test_paper_diff():
+    old = {'header': {'date': 1}, 'title': "A", 'pdf_parse': {'body_text': [1, 2], 'bib_entries': {'b': 1}}}
+    assert paper_diff(old, {**old, 'header': {'date': 2}}) == []
+    new = {'title': "B", 'pdf_parse': {'body_text': [1, 3, 4], 'bib_entries': {}}}
+    assert paper_diff(old, new) == [
+        'title: "A" -> "B"',
+        'pdf_parse.bib_entries: 1 -> 0 entries, 1 changed',
+        'pdf_parse.body_text: 2 -> 3 entries, 2 changed',
+    ]
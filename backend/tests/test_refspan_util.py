@@ -0,0 +1,39 @@
+from doc2json.utils.refspan_util import replace_refspans, sub_spans_and_update_indices
+
+
+def span(text: str, token: str, surface: str):
+    start = text.index(token)
+    return start, start + len(token), token, surface
+
+
+def test_sub_spans_updates_indices():
+    text = "See CITETOKEN0 and REFTOKEN1CITETOKEN2 here."
+    spans = [span(text, "REFTOKEN1", "Fig. 1"), span(text, "CITETOKEN0", "[1]"),
+             span(text, "CITETOKEN2", "[2, 3]")]
+
+    new_text, new_spans = sub_spans_and_update_indices(spans, text)
+
+    assert new_text == "See [1] and Fig. 1[2, 3] here."
+    assert new_spans == [(4, 7, "CITETOKEN0", "[1]"), (12, 18, "REFTOKEN1", "Fig. 1"),
+                         (18, 24, "CITETOKEN2", "[2, 3]")]
+    for start, end, _, surface in new_spans:
+        assert new_text[start:end] == surface
+
+
+def test_sub_spans_of_many_citations():
+    text = " ".join(f"CITETOKEN{i}." for i in range(500))
+    spans = [span(text, f"CITETOKEN{i}.", f"[{i}]") for i in range(500)]
+
+    new_text, new_spans = sub_spans_and_update_indices(spans, text)
+
+    assert new_text == " ".join(f"[{i}]" for i in range(500))
+    for start, end, _, surface in new_spans:
+        assert new_text[start:end] == surface
+
+
+def test_replace_refspans_pads_abutting_spans():
+    assert replace_refspans([(0, 1, "a", "X"), (1, 2, "b", "Y"), (3, 4, "d", "Z")], "abcd") == "X, YcZ"
+
+
+def test_replace_refspans_drops_overlapping_spans():
+    assert replace_refspans([(0, 4, "a bc", "X"), (2, 4, "bc", "Y"), (5, 6, "d", "Z")], "a bc d") == "X Z"
@@ -0,0 +1,43 @@
+import retrieval
+from retrieval import BM25Index, tokenize
+
+BLOCKS = [
+    ("text:intro", "Deep networks classify fractures in radiographs."),
+    ("text:data", "We train on the FracNet dataset of 900 chest radiographs, with a separate test dataset."),
+    ("text:results", "The model reaches an AUC of 0.94 on the test set."),
+]
+
+
+def test_tokenize_drops_stopwords_and_punctuation():
+    assert tokenize("What is the AUC of the model?") == ["auc", "model"]
+
+
+def test_rank_orders_matching_blocks():
+    index = BM25Index.build(BLOCKS)
+
+    ranked = index.rank("Which dataset was used for training?")
+
+    assert [key for key, _ in ranked] == ["text:data"]
+    assert [key for key, _ in index.rank("test AUC")] == ["text:results", "text:data"]
+
+
+def test_rank_without_match_or_restricted_to_keys():
+    index = BM25Index.build(BLOCKS)
+
+    assert index.rank("transformers") == []
+    assert index.rank("What is this paper about?") == []
+    assert [key for key, _ in index.rank("test AUC", keys={"text:data"})] == ["text:data"]
+    assert BM25Index.build([]).rank("test") == []
+
+
+def test_stored_index_round_trip(monkeypatch):
+    stored = {}
+    monkeypatch.setattr(retrieval.aws, "store_json_in_s3", lambda data, key: stored.update({key: data}))
+    monkeypatch.setattr(retrieval.aws, "read_json_from_s3", lambda key: stored.get(key))
+    index = BM25Index.build(BLOCKS)
+
+    retrieval.store_paper_index("abc", index)
+
+    assert list(stored) == ["papers/abc.index.json"]
+    assert retrieval.load_paper_index("abc").rank("test AUC") == index.rank("test AUC")
+    assert retrieval.load_paper_index("def") is None
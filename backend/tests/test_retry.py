@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from doc2json.grobid2json.grobid import retry
+from doc2json.grobid2json.grobid.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+def test_backoff_is_capped_and_jittered(monkeypatch):
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+
+    assert [policy.backoff(attempt) for attempt in range(1, 6)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+    monkeypatch.undo()
+    delays = [policy.backoff(3) for _ in range(100)]
+    assert all(0 <= delay <= 4.0 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_next_delay_gives_up_after_max_attempts_or_deadline():
+    policy = RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.01, deadline=None)
+    assert policy.start() is None
+    assert policy.next_delay(1, None) is not None
+    assert policy.next_delay(2, None) is not None
+    assert policy.next_delay(3, None) is None
+
+    policy = RetryPolicy(max_attempts=10, base_delay=0.01, max_delay=0.01, deadline=60)
+    assert policy.next_delay(1, policy.start()) is not None
+    assert policy.next_delay(1, time.monotonic()) is None
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.failures == 0
+
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 1
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert 59 < breaker.retry_after() <= 60
+
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # the trial fails, the circuit opens again
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.times_opened == 2
+    time.sleep(0.02)
+
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+    breaker.before_call()
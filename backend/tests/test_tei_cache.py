@@ -0,0 +1,74 @@
+import hashlib
+import os
+
+from doc2json.grobid2json.grobid.grobid_client import GrobidClient
+from doc2json.grobid2json.tei_cache import DiskTeiCache, tei_cache_key, tei_cache_key_for_hash
+
+TEI = '<TEI xmlns="http://www.tei-c.org/ns/1.0"/>'
+PDF = b"%PDF-1.4 paper"
+
+
+class FakeResponse(object):
+    text = TEI
+
+
+class CountingGrobid(object):
+    def __init__(self, status: int = 200):
+        self.status = status
+        self.calls = 0
+
+    def post(self, **kwargs):
+        self.calls += 1
+        return FakeResponse(), self.status
+
+
+def test_key_follows_pdf_service_and_flags():
+    key = tei_cache_key(PDF, "processFulltextDocument", {'consolidateHeader': '1'})
+
+    assert key.startswith(hashlib.sha256(PDF).hexdigest() + ".")
+    assert key == tei_cache_key_for_hash(hashlib.sha256(PDF).hexdigest(), "processFulltextDocument",
+                                         {'consolidateHeader': '1'})
+    assert key != tei_cache_key(PDF + b" ", "processFulltextDocument", {'consolidateHeader': '1'})
+    assert key != tei_cache_key(PDF, "processHeaderDocument", {'consolidateHeader': '1'})
+    assert key != tei_cache_key(PDF, "processFulltextDocument", {'consolidateHeader': '0'})
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskTeiCache(str(tmp_path / "tei"))
+    assert cache.get("key") is None
+
+    cache.put("key", TEI)
+
+    assert cache.get("key") == TEI
+    assert os.listdir(tmp_path / "tei") == ["key.tei.xml"]
+
+
+def test_failing_disk_cache_is_empty(tmp_path):
+    cache = DiskTeiCache(str(tmp_path / "tei"))
+    os.rmdir(tmp_path / "tei")
+    cache.put("key", TEI)
+    assert cache.get("key") is None
+
+
+def test_client_only_calls_grobid_on_a_miss(tmp_path):
+    grobid = CountingGrobid()
+    client = GrobidClient({})
+    client.post = grobid.post
+    cache = DiskTeiCache(str(tmp_path / "tei"))
+
+    for _ in range(2):
+        assert client.process_pdf_stream("paper.pdf", PDF, "", "processFulltextDocument", tei_cache=cache) == TEI
+
+    assert grobid.calls == 1
+    assert client.metrics()['tei_cache_misses'] == 1
+    assert client.metrics()['tei_cache_hits'] == 1
+
+
+def test_client_does_not_cache_failures(tmp_path):
+    grobid = CountingGrobid(status=500)
+    client = GrobidClient({"max_attempts": 1})
+    client.post = grobid.post
+    cache = DiskTeiCache(str(tmp_path / "tei"))
+
+    assert client.process_pdf_stream("paper.pdf", PDF, "", "processFulltextDocument", tei_cache=cache) == ""
+    assert os.listdir(tmp_path / "tei") == []
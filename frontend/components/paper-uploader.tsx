@@ -52,7 +52,12 @@ const PaperUploader = ({ onFinish, alternative }: PaperUploaderProps) => {
     // notice that this 'name' must match the name of the field read in the backend
     formData.append('pdf_file', file);
     try {
-      const res = await uploadPaper(session!.accessToken, session!.user!.email, formData)
+      // the paper can be shown and asked from its abstract until the full paper replaces it
+      const res = await uploadPaper(session!.accessToken, session!.user!.email, formData, (partialPaper: Paper) => {
+        setPdf(file)
+        setUploadedPaper(partialPaper)
+        setStatus('uploaded')
+      })
       setUploadedPaper(res.data as Paper)
       setPdf(file)
       setStatus('uploaded')
@@ -49,6 +49,8 @@ type Author = {
 
 export type Paper = {
   hash: string
+  // only the header and abstract, while the full paper is being converted
+  partial?: boolean
   abstract: string
   title: string
   authors: Author[]
@@ -76,15 +76,35 @@ export function loginAsGuest(email) {
 }
 
 
-export function uploadPaper(accessToken, email, formData) {
-  return axios.post(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/upload-paper`), formData, {
-    headers: {
-      'Content-Type': 'multipart/form-data',
-      'Email': email,
-      // @ts-ignore
-      'Authorization': `Bearer ${accessToken}`,
-    },
-  });
+const UPLOAD_JOB_POLL_MS = 2000
+
+// the paper is converted in the background, waiting for it doesn't hold a request open.
+// `onHeader` gets the partial paper (header and abstract) as soon as it's available
+export async function uploadPaper(accessToken, email, formData, onHeader?: (paper: Paper) => void) {
+  const headers = {
+    'Email': email,
+    // @ts-ignore
+    'Authorization': `Bearer ${accessToken}`,
+  }
+  let job = (await axios.post(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/upload-jobs`), formData, {
+    headers: { ...headers, 'Content-Type': 'multipart/form-data' },
+  })).data
+  let headerSent = false
+  while (job.stage !== 'done') {
+    if (job.stage === 'failed') {
+      throw new Error(`Upload failed: ${job.error}`)
+    }
+    if (job.header && onHeader && !headerSent) {
+      headerSent = true
+      const partial = await axios.get(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/papers/${job.paper_hash}`), { headers })
+      if (partial.data.partial) {
+        onHeader(partial.data as Paper)
+      }
+    }
+    await new Promise(resolve => setTimeout(resolve, UPLOAD_JOB_POLL_MS))
+    job = (await axios.get(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/upload-jobs/${job.job_id}`), { headers })).data
+  }
+  return axios.get(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/papers/${job.paper_hash}`), { headers })
 }
 
 export function sendInstructionsEmail(recipient) {
@@ -122,8 +142,17 @@ interface AskOptions {
   accessToken: string
 }
 
+function paperSections(paper: Paper): [string, string | null][] {
+  const sections = new Map<string, [string, string | null]>()
+  for (const block of [...paper.pdf_parse.body_text, ...paper.pdf_parse.back_matter]) {
+    const section: [string, string | null] = [block.section, block.sec_num]
+    sections.set(JSON.stringify(section), section)
+  }
+  return Array.from(sections.values())
+}
+
 export function askPaper({ question, history, email, paper, accessToken }: AskOptions, options: RequestInit) {
-  return fetch(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/ask-paper`), {
+  const request = (paperData: object) => fetch(normalizeUrl(`${process.env.NEXT_PUBLIC_BACKEND_HTTP_APIURL}/ask-paper`), {
     method: 'POST',
     headers: {
       'Content-Type': 'application/json',
@@ -133,10 +162,23 @@ export function askPaper({ question, history, email, paper, accessToken }: AskOp
     body: JSON.stringify({
       question,
       history: JSON.stringify(history),
-      paper: JSON.stringify(paper)
+      ...paperData
     }),
     ...options
   });
+
+  if (!paper.hash) {
+    return request({ paper: JSON.stringify(paper) })
+  }
+  if (paper.partial) {
+    // no section selection, the backend answers from the full paper as soon as it's converted
+    return request({ paper_hash: paper.hash })
+      .then(response => response.status === 404 ? request({ paper: JSON.stringify(paper) }) : response)
+  }
+
+  // the backend resolves the paper from its hash, only the section selection is sent along
+  return request({ paper_hash: paper.hash, sections: JSON.stringify(paperSections(paper)) })
+    .then(response => response.status === 404 ? request({ paper: JSON.stringify(paper) }) : response)
 }
 
 
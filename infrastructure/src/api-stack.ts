@@ -38,6 +38,10 @@ export class ApiStack extends cdk.Stack {
                 AWS_LAMBDA_EXEC_WRAPPER: '/opt/bootstrap',
                 AWS_LWA_READINESS_CHECK_PATH: '/health',
                 AWS_LWA_INVOKE_MODE: 'response_stream',
+                // upload jobs are run by invoking the function asynchronously, see `dispatch_upload_job`
+                AWS_LWA_PASS_THROUGH_PATH: '/events',
+                // the events path is public, upload job events carry this secret
+                LAMBDA_EVENTS_SECRET: process.env.LAMBDA_EVENTS_SECRET!,
                 PORT: "8000",
             },
             layers: [
@@ -53,6 +57,12 @@ export class ApiStack extends cdk.Stack {
             resources: ['*'],
             effect: iam.Effect.ALLOW,
         }));
+        this.fastApiLambda.addToRolePolicy(new iam.PolicyStatement({
+            actions: ['lambda:InvokeFunction'],
+            // built from the name, referencing the function itself would be a circular dependency
+            resources: [`arn:aws:lambda:${this.region}:${this.account}:function:${CAMEL_CASE_PREFIX}FastAPI${props.environment}`],
+            effect: iam.Effect.ALLOW,
+        }));
 
 
         const lambdaUrl = this.fastApiLambda.addFunctionUrl({
@@ -7,6 +7,7 @@ interface Props {
   name: string;
   indexFields?: string[];
   partitionKey?: {name: string; type: dynamodb.AttributeType};
+  timeToLiveAttribute?: string;
   writableBy?: iam.IGrantable[],
   readableBy?: iam.IGrantable[]
 }
@@ -21,6 +22,7 @@ export class DynamoDbTableConstruct extends Construct {
       tableName: props.name,
       partitionKey: props.partitionKey ?? {name: 'id', type: dynamodb.AttributeType.STRING},
       billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: props.timeToLiveAttribute,
       removalPolicy: cdk.RemovalPolicy.RETAIN
     });
     props?.indexFields?.forEach(field => dynamoTable.addGlobalSecondaryIndex({
@@ -59,5 +59,12 @@ export class DbStack extends cdk.Stack {
       writableBy: props.writableBy,
       readableBy: props.readableBy,
     })
+
+    new DynamoDbTableConstruct(this, 'AnswerCacheTable', {
+      name: `${SNAKE_CASE_PREFIX}_answer_cache_${props.environment}`,
+      timeToLiveAttribute: 'expires_at',
+      writableBy: props.writableBy,
+      readableBy: props.readableBy,
+    })
   }
 }